@@ -0,0 +1,330 @@
+"""
+Incremental world checkpoints for GameController
+
+A checkpoint is a directory holding a manifest and one or more segment files:
+    manifest.json       {'version': 1, 'checkpoint': <n>, 'segments': [<segment name>, ... ],
+                         'objects': {<id>: [<class>, <segment name>, <offset>, <length>, <crc32>], ... }}
+    segment-<n>.dat     SEGMENT_MAGIC, <uint16 version>, then records of <int64 id>, <uint32 length>, <data>
+Each record is one gameobject's attributes, pickled and zlib compressed.  References to other gameobjects and to the
+GameObjectController are pickled as ids, so every record stands on its own and only gameobjects whose record changed
+since the last checkpoint are written, to a new segment.  The manifest is replaced in one rename once the segment is
+on disk, a checkpoint cut short leaves the previous one intact.  Segments no longer referenced are deleted, and once
+there are MAX_SEGMENTS of them every gameobject is rewritten to a single new one.
+
+Checkpointer.start forks, the child process serializes the world as it was at the fork (copy on write) while the tick
+carries on.  Without fork the records are pickled in the tick and written from a thread.
+
+Players are left out, they are saved with their characters and would otherwise be restored as ghosts.
+"""
+import json
+import os
+import pickle
+import struct
+import sys
+import threading
+import traceback
+import zlib
+from io import BytesIO
+from timeit import default_timer
+
+
+FORMAT_VERSION = 1
+SEGMENT_MAGIC = b'LWCP'
+SEGMENT_HEADER = struct.Struct('<4sH')
+RECORD_HEADER = struct.Struct('<qI')
+MANIFEST = 'manifest.json'
+# Segments kept before every gameobject is rewritten into one
+MAX_SEGMENTS = 8
+# zlib level for records, checkpoints are written often so favour speed
+COMPRESS_LEVEL = 1
+
+
+class CheckpointError(Exception):
+    """ Checkpoint missing, damaged or written by an unknown version """
+    pass
+
+
+def class_path(obj):
+    return '{0}.{1}'.format(type(obj).__module__, type(obj).__name__)
+
+
+def load_class(classpath):
+    module, name = classpath.rsplit('.', 1)
+    return getattr(__import__(module, fromlist=[name]), name)
+
+
+def dump_gameobject(gameobject, goc):
+    """ Pickle a gameobject's attributes, with gameobjects and the GOC it refers to pickled as references """
+    # Imported here so mp.server, which saves characters through this module, doesn't pull in the whole game
+    from gameobjects.gameobject import GameObject, Room
+
+    def persistent_id(obj):
+        if obj is goc:
+            return 'goc'
+        if isinstance(obj, GameObject):
+            return 'go:{0}'.format(obj.id)
+        if isinstance(obj, Room):
+            return 'room:{0}'.format(obj.uniquename)
+        return None
+
+    f = BytesIO()
+    pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = persistent_id
+    # __getstate__ copies values out of the GOC's ComponentStore
+    pickler.dump(gameobject.__getstate__() if hasattr(gameobject, '__getstate__') else gameobject.__dict__)
+    return f.getvalue()
+
+
+def restore(gameobject, state):
+    """ Set the attributes of a gameobject created with __new__, as unpickling would """
+    if hasattr(gameobject, '__setstate__'):
+        gameobject.__setstate__(state)
+    else:
+        gameobject.__dict__.update(state)
+
+
+def load_gameobject(data, gameobjects, goc):
+    """ Attributes pickled by dump_gameobject, references resolved against gameobjects and goc """
+    def persistent_load(pid):
+        if pid == 'goc':
+            return goc
+        kind, key = pid.split(':', 1)
+        if kind == 'go':
+            # Gameobjects that were not checkpointed, players and the since removed, come back as None
+            return gameobjects.get(int(key))
+        return goc.rooms.get(key)
+
+    unpickler = pickle.Unpickler(BytesIO(data))
+    unpickler.persistent_load = persistent_load
+    return unpickler.load()
+
+
+def snapshot(goc):
+    """ [(<id>, <class>, <pickled attributes>), ... ] for every gameobject to checkpoint """
+    return [(id, class_path(gameobject), dump_gameobject(gameobject, goc))
+            for id, gameobject in goc.gameobjects.items()
+            if not getattr(gameobject, 'player', False)]
+
+
+def read_manifest(directory):
+    """ Manifest of the checkpoint in directory, None if there is none """
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != FORMAT_VERSION:
+        raise CheckpointError('Unsupported checkpoint version {0} in {1}'.format(manifest.get('version'), path))
+    return manifest
+
+
+def write_checkpoint(directory, records):
+    """
+    Write records from snapshot() as the next checkpoint in directory, only the records that changed since the last
+    :return: (<checkpoint number>, <records written>, <bytes written>)
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    previous = read_manifest(directory) or {'checkpoint': 0, 'segments': [], 'objects': {}}
+    number = previous['checkpoint'] + 1
+    segment = 'segment-{0}.dat'.format(number)
+    # Rewrite everything once there are too many segments
+    full = len(previous['segments']) >= MAX_SEGMENTS
+    old = previous['objects']
+
+    objects = {}
+    written = 0
+    offset = SEGMENT_HEADER.size
+    with open(os.path.join(directory, segment), 'wb') as f:
+        f.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, FORMAT_VERSION))
+        for id, classpath, data in records:
+            crc = zlib.crc32(data) & 0xffffffff
+            entry = old.get(str(id))
+            if not full and entry is not None and entry[0] == classpath and entry[4] == crc:
+                objects[str(id)] = entry
+                continue
+            data = zlib.compress(data, COMPRESS_LEVEL)
+            f.write(RECORD_HEADER.pack(id, len(data)))
+            f.write(data)
+            offset += RECORD_HEADER.size
+            objects[str(id)] = [classpath, segment, offset, len(data), crc]
+            offset += len(data)
+            written += 1
+        f.flush()
+        os.fsync(f.fileno())
+
+    segments = sorted(set(entry[1] for entry in objects.values()), key=lambda name: int(name[8:-4]))
+    if not written:
+        # Nothing changed, keep the empty segment off disk
+        os.remove(os.path.join(directory, segment))
+    manifest = {'version': FORMAT_VERSION, 'checkpoint': number, 'segments': segments, 'objects': objects}
+    path = os.path.join(directory, MANIFEST)
+    temp = '{0}.tmp'.format(path)
+    with open(temp, 'w') as f:
+        json.dump(manifest, f, separators=(',', ':'))
+        f.flush()
+        os.fsync(f.fileno())
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(temp, path)
+
+    for name in previous['segments']:
+        if name not in segments:
+            os.remove(os.path.join(directory, name))
+    return number, written, offset if written else 0
+
+
+def read_checkpoint(directory, goc):
+    """
+    Gameobjects of the checkpoint in directory, restored against goc
+    :return: {<id>: <gameobject>, ... }
+    """
+    manifest = read_manifest(directory)
+    if manifest is None:
+        raise CheckpointError('No checkpoint in {0}'.format(directory))
+    segments = {}
+    for name in manifest['segments']:
+        with open(os.path.join(directory, name), 'rb') as f:
+            data = f.read()
+        magic, version = SEGMENT_HEADER.unpack_from(data)
+        if magic != SEGMENT_MAGIC or version != FORMAT_VERSION:
+            raise CheckpointError('{0} is not a version {1} checkpoint segment'.format(name, FORMAT_VERSION))
+        segments[name] = data
+
+    # Create every gameobject empty first so references between them can be resolved in any order
+    classes = {}
+    gameobjects = {}
+    for id, (classpath, segment, offset, length, crc) in manifest['objects'].items():
+        if classpath not in classes:
+            classes[classpath] = load_class(classpath)
+        cls = classes[classpath]
+        gameobjects[int(id)] = cls.__new__(cls)
+    for id, (classpath, segment, offset, length, crc) in manifest['objects'].items():
+        data = zlib.decompress(segments[segment][offset:offset + length])
+        if zlib.crc32(data) & 0xffffffff != crc:
+            raise CheckpointError('Record for gameobject {0} in {1} is damaged'.format(id, segment))
+        restore(gameobjects[int(id)], load_gameobject(data, gameobjects, goc))
+    return gameobjects
+
+
+class Checkpointer(object):
+    """ Writes checkpoints of a GOC in the background every interval milliseconds of ticks """
+    def __init__(self, directory, interval):
+        """
+        :param directory: checkpoint directory
+        :param interval: milliseconds between checkpoints, None to only checkpoint when start() is called
+        """
+        self.directory = directory
+        self.interval = interval
+        self.timer = interval
+        # Child process or thread writing the current checkpoint
+        self.pid = None
+        self.thread = None
+        self.started = None
+        # Seconds the last checkpoint took from start to finish, and how long it held up the tick
+        self.duration = None
+        self.stall = None
+        self.failures = 0
+
+    @property
+    def busy(self):
+        return self.pid is not None or self.thread is not None
+
+    def update(self, dt, goc):
+        """ Called once per tick, reaps a finished checkpoint and starts the next when it is due """
+        self.poll()
+        if self.interval is None:
+            return
+        self.timer -= dt
+        if self.timer <= 0 and not self.busy:
+            self.timer = self.interval
+            self.start(goc)
+
+    def start(self, goc):
+        """ Begin a checkpoint of goc, returns False if one is already being written or the world couldn't be
+        pickled """
+        if self.busy:
+            return False
+        self.started = default_timer()
+        if hasattr(os, 'fork'):
+            # Anything buffered would be written twice, once by each process
+            sys.stdout.flush()
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    self._write(snapshot(goc))
+                    status = 0
+                except Exception:
+                    traceback.print_exc()
+                finally:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    os._exit(status)
+            self.pid = pid
+        else:
+            try:
+                records = snapshot(goc)
+            except Exception:
+                # Pickled in the tick here, a gameobject that can't be pickled must not stop the game
+                traceback.print_exc()
+                self._failed()
+                return False
+            self.thread = threading.Thread(target=self._write_thread, args=(records,))
+            self.thread.daemon = True
+            self.thread.start()
+        self.stall = default_timer() - self.started
+        return True
+
+    def _write(self, records):
+        number, written, size = write_checkpoint(self.directory, records)
+        print('Checkpoint {0}: {1} of {2} gameobjects changed, {3} bytes written to {4}'.format(
+            number, written, len(records), size, self.directory))
+
+    def _write_thread(self, records):
+        try:
+            self._write(records)
+        except Exception:
+            traceback.print_exc()
+            self._failed()
+
+    def _failed(self):
+        self.failures += 1
+        print('Checkpoint to {0} failed, {1} failures so far'.format(self.directory, self.failures))
+
+    def poll(self):
+        """ Notice a finished checkpoint, returns True while one is still being written """
+        if self.pid is not None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid == 0:
+                return True
+            self.pid = None
+            if status != 0:
+                # The child has printed the traceback
+                self._failed()
+        elif self.thread is not None:
+            if self.thread.is_alive():
+                return True
+            self.thread = None
+        else:
+            return False
+        self.duration = default_timer() - self.started
+        return False
+
+    def wait(self):
+        """ Block until the checkpoint being written is finished """
+        if self.pid is not None:
+            pid, status = os.waitpid(self.pid, 0)
+            self.pid = None
+            if status != 0:
+                self._failed()
+        elif self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        else:
+            return
+        self.duration = default_timer() - self.started
+
+    def restore(self, goc):
+        """ Gameobjects from the latest checkpoint, see read_checkpoint """
+        return read_checkpoint(self.directory, goc)
@@ -16,6 +16,13 @@ FONT = 'graphics/fonts/november.ttf'
 TILE_SIZE = 8
 # define rate that the server is polled, lower number means more polling
 POLL_RATE = 10
+# subscribe to room state pushed by the server, polling get_roomdata is the fallback
+PUSH_UPDATES = True
+# milliseconds between room state pushes, None for the server default.  Remote sprites are interpolated between
+# snapshots (local/interpolation.py) so this can be well above the frame time
+PUSH_INTERVAL = 200
+# ask for room snapshots in the compact array encoding (mp/snapshot.py)
+COMPACT_SNAPSHOTS = True
 # debug messages displayed on screen
 DEBUG_MODE = True
 # Pyscroll default layer
@@ -1,64 +1,138 @@
 from __future__ import division
 
-import pygame
-# from pygame.locals import *
-# from pytmx.util_pygame import load_pygame
+import os
+from timeit import default_timer
 
 from gameobjects.gameobject import *
+from checkpoint import Checkpointer
 from mp.server import GameServer
+from scheduler import TickScheduler
+
+# Room templates loaded at startup
+ROOMS = [START_ROOM]
+# World checkpoints are written here and restored from at startup when the server is run as a script, see
+# checkpoint.py.  GameControllers created elsewhere (tests, loadtest.py) do not checkpoint unless given a directory
+CHECKPOINT_DIR = 'mp/worlds/world1'
+# Milliseconds of ticks between background checkpoints
+CHECKPOINT_INTERVAL = 60000
 
 
 class GameController(object):
     """
     Controls all aspect of the game engine, hosts server, interfaces with clients
     """
-    def __init__(self):
+    def __init__(self, rooms=None, shards=0, checkpoint_dir=None):
         """
-        :param world: wld template file
+        :param rooms: room templates to load, defaults to ROOMS
+        :param shards: simulate the rooms in this many worker processes (see mp/shard.py), 0 simulates them here
+        :param checkpoint_dir: directory world checkpoints are kept in and restored from, None to not checkpoint.
+        Sharded worlds are not checkpointed, the gameobjects live in the shard processes
         """
-        # Instantiate goc and add default starting room
-        self.goc = GameObjectController(self)
-        self.goc.add_room(START_ROOM)
-
+        if rooms is None:
+            rooms = ROOMS
         self.dt = None
-
-        # {'playername': <lifeformid>, 'playername': <lifeformid>, ... }
-        self.gameserver = GameServer(self.goc)
+        self.router = None
+        self.checkpointer = None
+
+        if shards:
+            # Rooms live in the shard processes, this process only routes requests to them
+            from mp.shard import ShardRouter
+            self.goc = None
+            self.gameserver = GameServer()
+            self.router = self.gameserver.router = ShardRouter(self.gameserver, rooms, shards)
+        else:
+            # Instantiate goc and add rooms
+            self.goc = GameObjectController(self)
+            for room in rooms:
+                self.goc.add_room(room)
+            # {'playername': <lifeformid>, 'playername': <lifeformid>, ... }
+            self.gameserver = GameServer(self.goc)
+            if checkpoint_dir is not None:
+                self.checkpointer = Checkpointer(checkpoint_dir, CHECKPOINT_INTERVAL)
+                if os.path.exists(os.path.join(checkpoint_dir, 'manifest.json')):
+                    self.load_game(checkpoint_dir)
+
+        # Fixed timestep loop, network ingest -> simulation -> network flush every tick
+        self.scheduler = TickScheduler()
+        self.scheduler.add_phase('network_ingest', self.gameserver.network_ingest)
+        if not shards:
+            self.scheduler.add_phase('simulation', self.simulate)
+        self.scheduler.add_phase('network_flush', self.gameserver.network_flush)
+        if self.checkpointer:
+            self.scheduler.add_phase('checkpoint', self.checkpoint)
+        self.scheduler.metrics = self.gameserver.metrics
 
         self.running = False
 
     def load_game(self, save_file):
-        """ Load GOC """
-        pass
-
-    def save_game(self, save_file):
-        """ Pickle GOC """
-        pass
+        """ Replace the GOC's gameobjects with those checkpointed in save_file, players online are kept """
+        start = default_timer()
+        gameobjects = Checkpointer(save_file, None).restore(self.goc)
+        gameobjects.update(self.goc.players)
+        self.goc.replace_gameobjects(gameobjects)
+        print('Restored {0} gameobjects from {1} in {2:.3f}s'.format(len(gameobjects), save_file,
+                                                                    default_timer() - start))
+
+    def save_game(self, save_file=None, wait=False):
+        """
+        Checkpoint the GOC in the background
+        :param save_file: checkpoint directory, defaults to the one checkpoints are written to every interval
+        :param wait: block until the checkpoint is on disk
+        :return: False if a checkpoint is already being written to the directory, or the world could not be pickled
+        """
+        if self.goc is None:
+            raise RuntimeError('Sharded worlds cannot be checkpointed')
+        if save_file is None or (self.checkpointer and save_file == self.checkpointer.directory):
+            checkpointer = self.checkpointer
+            if checkpointer is None:
+                raise RuntimeError('No checkpoint directory to save to')
+        else:
+            checkpointer = Checkpointer(save_file, None)
+        started = checkpointer.start(self.goc)
+        if wait:
+            checkpointer.wait()
+        return started
+
+    def checkpoint(self, dt):
+        """ Checkpoint phase of the tick, starts a background checkpoint every CHECKPOINT_INTERVAL """
+        self.checkpointer.update(dt, self.goc)
 
     def update(self, dt):
         self.goc.update(dt)
         self.gameserver.update(dt)
 
+    def simulate(self, dt):
+        """ Simulation phase of the tick """
+        self.dt = dt
+        # Update Gameobjects
+        # GameServer has access to GOC and applies client requests in the network_ingest phase before this
+        self.goc.update(dt)
+
+    def tick_stats(self):
+        """ Tick count, overruns, skipped ticks and per-phase durations in milliseconds, see TickScheduler.stats """
+        return self.scheduler.stats()
+
     def run(self):
         """ Run the game loop """
-        clock = pygame.time.Clock()
         self.running = True
 
         try:
-            while self.running:
-                self.dt = clock.tick(60)
-
-                # Update Gameobjects
-                self.goc.update(self.dt)
-
-                # Listen on server for client requests
-                # GameServer has access to GOC and can change gameobject's attributes directly
-                self.gameserver.listen(self.gameserver.get_clients())
-
+            self.scheduler.run()
         except KeyboardInterrupt:
-            self.running = False
-        pass
+            pass
+        finally:
+            if self.router:
+                self.router.stop()
+            if self.checkpointer:
+                # Last checkpoint before shutting down
+                self.checkpointer.wait()
+                self.save_game(wait=True)
+        self.running = False
+
+    def stop(self):
+        """ Stop the game loop after the current tick """
+        self.scheduler.stop()
 
 if __name__ == '__main__':
-    a = GameController()
+    a = GameController(checkpoint_dir=CHECKPOINT_DIR)
     a.run()
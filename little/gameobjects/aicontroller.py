@@ -36,6 +36,18 @@ class AIController(object):
         #   Status
         #   Random
 
+    def __getstate__(self):
+        """ state is a bound method, which can't be pickled, so it is pickled by name """
+        state = self.__dict__.copy()
+        if state['state'] is not None:
+            state['state'] = state['state'].__name__
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.state is not None:
+            self.state = getattr(self, self.state)
+
     def run(self, dt):
         if self.state:
             self.tick(dt)
@@ -123,8 +135,8 @@ class AIController(object):
         """
         condition = gambit_target[0]
         target_type = gambit_target[1]
-        # The attribute determined from this string has a 1:1 naming with properties in gameobject.Lifeform class
-        return getattr(self.lifeform, '{0}_{1}'.format(condition, target_type))
+        # Answered by the room's spatial hash, see LifeForm.find_lifeform
+        return self.lifeform.find_lifeform(condition, target_type)
 
     def perform_action(self, action, args=None, target=None):
         logging.info('perform_action: Entering state: {0}'.format(action))
@@ -217,6 +229,11 @@ class AIController(object):
                 self.state = None
 
     def attack(self):
+        if self.lifeform.goc.lifeforms.get(self.target.id) is not self.target:
+            # Target died or logged out, its id may already belong to another gameobject
+            logging.info('attack: Target is gone, cancelling current state')
+            self.state = None
+            return
         # Attack target if in range, otherwise move toward it
         if point_distance(self.lifeform.coords, self.target.coords) < (1.7 * TILE_SIZE):
             if self.attack_timer < 0:
@@ -0,0 +1,215 @@
+"""
+Array backed component store for lifeforms
+
+Each lifeform in a GameObjectController with a ComponentStore is given a slot, a row in contiguous NumPy arrays
+holding its coords, room and core stats.  While attached the lifeform's coords property and stats mapping read and
+write those rows, so whole-world passes (all distances from a point, all dead lifeforms) are one array expression
+instead of a loop over objects.  Slots are dense: removing a lifeform moves the last one into its slot, rows
+[0, count) are always the live lifeforms.
+
+Coords and stats are held as floats, whole values read back as ints so lifeforms that only ever held ints still see
+ints.  A lifeform taken out of the store, or pickled, gets its values copied back into plain attributes.
+"""
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+import numpy
+
+
+# Stats held in the arrays, any other stats a lifeform has stay in a dict on its StatBlock
+STATS = ['HP', 'MAXHP', 'MP', 'MAXMP', 'STR', 'STA', 'MND', 'SPD', 'PDEF', 'MDEF']
+STAT_COLUMNS = dict((stat, column) for column, stat in enumerate(STATS))
+# Rows allocated up front, the arrays double in size when they run out
+INITIAL_CAPACITY = 256
+
+
+class StatBlock(MutableMapping):
+    """ A lifeform's stats dictionary, backed by its row in a ComponentStore """
+    def __init__(self, store, lifeform, extra):
+        self.store = store
+        self.lifeform = lifeform
+        # Stats not in STATS, like {<stat>: <value>, ... }
+        self.extra = extra
+
+    def __getitem__(self, stat):
+        column = STAT_COLUMNS.get(stat)
+        if column is None:
+            return self.extra[stat]
+        slot = self.lifeform._slot
+        if not self.store.has_stat[slot, column]:
+            raise KeyError(stat)
+        return _number(self.store.stats[slot, column])
+
+    def __setitem__(self, stat, value):
+        column = STAT_COLUMNS.get(stat)
+        if column is None:
+            self.extra[stat] = value
+            return
+        slot = self.lifeform._slot
+        self.store.stats[slot, column] = value
+        self.store.has_stat[slot, column] = True
+
+    def __delitem__(self, stat):
+        column = STAT_COLUMNS.get(stat)
+        if column is None:
+            del self.extra[stat]
+            return
+        slot = self.lifeform._slot
+        if not self.store.has_stat[slot, column]:
+            raise KeyError(stat)
+        self.store.has_stat[slot, column] = False
+
+    def __iter__(self):
+        has_stat = self.store.has_stat[self.lifeform._slot]
+        for column, stat in enumerate(STATS):
+            if has_stat[column]:
+                yield stat
+        for stat in self.extra:
+            yield stat
+
+    def __len__(self):
+        return int(self.store.has_stat[self.lifeform._slot].sum()) + len(self.extra)
+
+    def __repr__(self):
+        return 'StatBlock({0!r})'.format(dict(self))
+
+
+class ComponentStore(object):
+    """ Coords, room and core stats of lifeforms in contiguous arrays, see the module docstring """
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        self.count = 0
+        # Lifeform in each slot, [<lifeform>, ... ]
+        self.lifeforms = []
+        self.coords = numpy.zeros((capacity, 2), dtype=numpy.float64)
+        # False for lifeforms whose coords are None
+        self.placed = numpy.zeros(capacity, dtype=bool)
+        self.rooms = numpy.zeros(capacity, dtype=numpy.int32)
+        self.stats = numpy.zeros((capacity, len(STATS)), dtype=numpy.float64)
+        self.has_stat = numpy.zeros((capacity, len(STATS)), dtype=bool)
+        # Rooms as the integers held in self.rooms, like {<room uniquename>: <code>, ... }
+        self.room_codes = {}
+
+    def __len__(self):
+        return self.count
+
+    def _grow(self):
+        capacity = 2 * len(self.placed)
+        for name in ('coords', 'placed', 'rooms', 'stats', 'has_stat'):
+            array = getattr(self, name)
+            grown = numpy.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[:self.count] = array[:self.count]
+            setattr(self, name, grown)
+
+    def room_code(self, uniquename):
+        code = self.room_codes.get(uniquename)
+        if code is None:
+            code = self.room_codes[uniquename] = len(self.room_codes)
+        return code
+
+    # Attaching lifeforms
+
+    def attach(self, lifeform):
+        """ Move the lifeform's coords and stats into a new slot """
+        if self.count == len(self.placed):
+            self._grow()
+        slot = self.count
+        self.count += 1
+        self.lifeforms.append(lifeform)
+        coords = lifeform.__dict__.pop('_coords', None)
+        stats = lifeform.__dict__.get('stats') or {}
+        lifeform._slot = slot
+        lifeform._components = self
+        self.set_coords(slot, coords)
+        self.rooms[slot] = self.room_code(lifeform.current_room)
+        self.has_stat[slot] = False
+        extra = {}
+        for stat, value in stats.items():
+            column = STAT_COLUMNS.get(stat)
+            if column is None:
+                extra[stat] = value
+            else:
+                self.stats[slot, column] = value
+                self.has_stat[slot, column] = True
+        lifeform.stats = StatBlock(self, lifeform, extra)
+
+    def detach(self, lifeform):
+        """ Copy the lifeform's values back into plain attributes and free its slot """
+        slot = lifeform._slot
+        lifeform.stats = dict(lifeform.stats)
+        lifeform._coords = self.get_coords(slot)
+        del lifeform.__dict__['_components']
+        del lifeform.__dict__['_slot']
+        last = self.count - 1
+        if slot != last:
+            # Keep the slots dense, the last lifeform takes over the freed row
+            for array in (self.coords, self.placed, self.rooms, self.stats, self.has_stat):
+                array[slot] = array[last]
+            moved = self.lifeforms[slot] = self.lifeforms[last]
+            moved._slot = slot
+        self.lifeforms.pop()
+        self.count = last
+
+    def clear(self):
+        """ Detach every lifeform """
+        while self.lifeforms:
+            self.detach(self.lifeforms[-1])
+        self.room_codes.clear()
+
+    # Views used by GameObject.coords and GameObjectController
+
+    def get_coords(self, slot):
+        if not self.placed[slot]:
+            return None
+        return [_number(self.coords[slot, 0]), _number(self.coords[slot, 1])]
+
+    def set_coords(self, slot, coords):
+        if coords is None:
+            self.placed[slot] = False
+        else:
+            self.coords[slot] = coords[0], coords[1]
+            self.placed[slot] = True
+
+    def set_room(self, slot, uniquename):
+        self.rooms[slot] = self.room_code(uniquename)
+
+    # Vectorised passes
+
+    def mask(self, room=None):
+        """ Boolean array over the live slots, placed lifeforms in room or in any room if it is None """
+        mask = self.placed[:self.count].copy()
+        if room is not None:
+            code = self.room_codes.get(room)
+            if code is None:
+                mask[:] = False
+            else:
+                mask &= self.rooms[:self.count] == code
+        return mask
+
+    def distances(self, coords, room=None):
+        """
+        Distance from coords to every placed lifeform, in room if given
+        :return: (<array of slots>, <array of distances>)
+        """
+        slots = numpy.flatnonzero(self.mask(room))
+        offsets = self.coords[slots] - numpy.asarray(coords, dtype=numpy.float64)
+        return slots, numpy.sqrt((offsets * offsets).sum(axis=1))
+
+    def within(self, coords, radius, room=None):
+        """ Lifeforms closer to coords than radius, in room if given """
+        slots, distances = self.distances(coords, room)
+        return [self.lifeforms[slot] for slot in slots[distances < radius]]
+
+    def dead(self):
+        """ Lifeforms with HP below 1 """
+        column = STAT_COLUMNS['HP']
+        count = self.count
+        slots = numpy.flatnonzero(self.has_stat[:count, column] & (self.stats[:count, column] < 1))
+        return [self.lifeforms[slot] for slot in slots]
+
+
+def _number(value):
+    """ Array value as an int if it is a whole number, a float otherwise """
+    value = float(value)
+    return int(value) if value.is_integer() else value
@@ -1,6 +1,7 @@
 """
 Test based mushy fun!
 """
+import copy
 import logging
 from template_parser import TemplateParser
 
@@ -10,6 +11,10 @@ import pytmx
 
 from functions.game_math import clamp, point_distance, calc_stat
 from gameobjects.aicontroller import AIController
+from gameobjects.components import ComponentStore
+from gameobjects.idallocator import IdAllocator
+from gameobjects.perception import PerceptionCache
+from gameobjects.spatialhash import SpatialHash
 
 from pathfinding.astar2 import *
 
@@ -22,6 +27,9 @@ START_COORDS = [160, 160]
 
 TILE_SIZE = 8
 
+# Keep lifeform coords and core stats in a NumPy ComponentStore (gameobjects/components.py) by default
+COMPONENT_STORE = True
+
 
 class GameObjectController(object):
     """
@@ -30,16 +38,38 @@ class GameObjectController(object):
     Can create rooms from tmx files
     Can terminate gameobjects from its list
     """
-    def __init__(self, gc):
+    def __init__(self, gc, components=COMPONENT_STORE):
+        """ :param components: hold lifeform coords and core stats in a ComponentStore """
         self.tp = TemplateParser()
         self.gc = gc
 
         # Dictionary like {<id>: <gameobject instance>, <id>: <gameobject instance>, ...}
         self._gameobjects = {}
 
+        # Indexes of _gameobjects kept up to date as gameobjects are added, removed, change room or are destroyed,
+        # so the properties below don't have to go through every gameobject.  Like {<id>: <gameobject>, ... }
+        self._lifeforms = {}
+        self._players = {}
+        self._npcs = {}
+        self._destroyed = {}
+        # Like {<player name>: <gameobject>, ... }
+        self._players_by_name = {}
+        # Like {<room uniquename>: {<id>: <gameobject>, ... }, ... }
+        self._room_gameobjects = {}
+        # Lifeforms of each room by position, for neighbour queries, like {<room uniquename>: <SpatialHash>, ... }
+        self._spatial_hashes = {}
+        # What each lifeform sees, worked out once per tick
+        self.perception = PerceptionCache()
+        # Array backed coords and stats of the lifeforms, None to keep them on the lifeforms
+        self.components = ComponentStore() if components else None
+
         # Dictionary like {<room_unique_name>: <room_instance>, <room_unique_name>: <room_instance>, ... }
         self._rooms = {}
 
+        # Hands out ids and reuses those of removed gameobjects.  Room shards (mp/shard.py) each get their own range
+        # of slots so ids stay unique when players move between shards
+        self.ids = IdAllocator()
+
     def add_gameobject(self, template, room=None, coords=None):
         """
         :param template: template file
@@ -55,9 +85,32 @@ class GameObjectController(object):
         gameobject.current_room = room
         gameobject.coords = coords
         gameobject.goc = self
-        self._gameobjects[id] = gameobject
+        self._index(gameobject)
         return gameobject, id
 
+    def add_gameobjects(self, spawns):
+        """
+        Add many gameobjects at once, each template file is only parsed once
+        :param spawns: [(<template>, <room uniquename>, <coords>), ... ]
+        :return: [(<gameobject>, <id>), ... ] in the order of spawns
+        """
+        # Like {<template>: (<class type>, <input data>), ... }
+        parsed = {}
+        added = []
+        for template, room, coords in spawns:
+            if template not in parsed:
+                input_data = self.tp.load_data(template)
+                parsed[template] = self.tp.class_type, input_data
+            class_type, input_data = parsed[template]
+            # Gameobjects keep the lists and dicts they are given, each needs its own copy
+            gameobject, id = self._create_gameobject(class_type, **copy.deepcopy(input_data))
+            gameobject.current_room = room
+            gameobject.coords = coords
+            gameobject.goc = self
+            self._index(gameobject)
+            added.append((gameobject, id))
+        return added
+
     def add_room(self, template):
         """ Add room to game """
         input_data = self.tp.load_data(template)
@@ -67,12 +120,31 @@ class GameObjectController(object):
         self._spawn_room_lifeforms(room)
         return room
 
-    def remove_gameobject(self, id):
-        """ Delete gameobject from game, will not err if object does not exist """
+    def remove_gameobject(self, id, release=True):
+        """ Delete gameobject from game, will not err if object does not exist
+        :param release: let the id be reused, False for a player handed over to another shard, who keeps the id """
         try:
-            del self._gameobjects[id]
+            self._unindex(id)
         except KeyError:
             print('Gameobject with ID: {0}, did not exist, so could not delete'.format(id))
+            return
+        if release:
+            self.ids.release(id)
+
+    def replace_gameobjects(self, gameobjects):
+        """ Swap every gameobject for those in gameobjects, like {<id>: <gameobject>, ... } """
+        for index in (self._gameobjects, self._lifeforms, self._players, self._npcs, self._destroyed,
+                      self._players_by_name, self._room_gameobjects, self._spatial_hashes):
+            index.clear()
+        if self.components is not None:
+            # Gameobjects carried over into gameobjects keep their values
+            self.components.clear()
+        self.perception.advance()
+        self.ids.clear()
+        for gameobject in gameobjects.values():
+            self.ids.reserve(gameobject.id)
+            gameobject.goc = self
+            self._index(gameobject)
 
     def get_object(self, id):
         """ Returns gameobject instance from id """
@@ -80,7 +152,8 @@ class GameObjectController(object):
 
     @property
     def gameobjects(self):
-        """ Dictionary like { <id>: <gameobject>, <id>: <gameobject>, <id>: <gameobject>, ... } """
+        """ Dictionary like { <id>: <gameobject>, <id>: <gameobject>, <id>: <gameobject>, ... }.  This and the other
+        dictionaries below are the GOC's own indexes, not copies, they must not be changed by the caller """
         return self._gameobjects
 
     @property
@@ -91,7 +164,7 @@ class GameObjectController(object):
     @property
     def lifeforms(self):
         """ Only lifeforms { <id>: <gameobject>, <id>: <gameobject>, <id>: <gameobject>, ... } """
-        return {id: go for id, go in self._gameobjects.items() if isinstance(go, LifeForm)}
+        return self._lifeforms
 
     @property
     def props(self):
@@ -106,17 +179,22 @@ class GameObjectController(object):
     @property
     def players(self):
         """ All player gameobjects { <id>: <gameobject>, <id>: <gameobject> """
-        return {id: go for id, go in self.lifeforms.items() if go.player}
+        return self._players
 
     @property
-    def playernames(self):
+    def players_by_name(self):
         """ Players by name { <playername>: <gameobject>, <playername>: <gameobject>, ... } """
-        return [go.name for id, go in self.lifeforms.items() if go.player]
+        return self._players_by_name
+
+    @property
+    def playernames(self):
+        """ Names of all players [<playername>, <playername>, ... ] """
+        return list(self._players_by_name)
 
     @property
     def npcs(self):
         """ All non-player lifeforms { <id>: <lifeform>, <id>: <lifeform>, ...} """
-        return {id: go for id, go in self.lifeforms.items() if not go.player}
+        return self._npcs
 
     @property
     def treasure(self):
@@ -126,31 +204,42 @@ class GameObjectController(object):
     @property
     def destroyed(self):
         """ All destroyed game objects { <id>: <gameobject>, <id>: <gameobject>, ... } """
-        return {id: go for id, go in self._gameobjects.items() if go.destroyed}
+        return self._destroyed
+
+    def room_gameobjects(self, uniquename):
+        """ Gameobjects in the room { <id>: <gameobject>, <id>: <gameobject>, ... } """
+        return self._room_gameobjects.get(uniquename, {})
+
+    def spatial_hash(self, uniquename):
+        """ SpatialHash of the lifeforms in the room, None if there are none """
+        return self._spatial_hashes.get(uniquename)
 
     def coordsmap_for_room(self, uniquename):
         """ Returns: {<id>: [x, y], <id>: [x, y], ... } for each object in current room """
-        coords_map = self.coords_map
-        room_coords = {}
-        for id, coords in coords_map.items():
-            if self.gameobjects[id].current_room == uniquename:
-                room_coords[id] = coords
-        return room_coords
+        return {id: go.coords for id, go in self.room_gameobjects(uniquename).items()}
 
     def coords_sprite_map_for_room(self, uniquename):
         """ Returns: {<id>:(<sprite>,[<coords>]), <id>:(<sprite>,[<coords>]), ... } for each object in current room """
-        coords_map = self.coords_map
-        room_coords = {}
-        for id, coords in coords_map.items():
-            if self.gameobjects[id].current_room == uniquename:
-                room_coords[id] = (self.gameobjects[id].graphic, coords)
-        return room_coords
+        return {id: (go.graphic, go.coords) for id, go in self.room_gameobjects(uniquename).items()}
+
+    def distances_from(self, coords, room):
+        """ Lifeforms in room and how far each is from coords, like [(<distance>, <lifeform>), ... ] """
+        if self.components is not None:
+            slots, distances = self.components.distances(coords, room)
+            lifeforms = self.components.lifeforms
+            return [(distance, lifeforms[slot]) for slot, distance in zip(slots.tolist(), distances.tolist())]
+        return [(point_distance(coords, lifeform.coords), lifeform)
+                for lifeform in self.room_gameobjects(room).values()
+                if isinstance(lifeform, LifeForm) and lifeform.coords is not None]
 
     def dead_check(self):
         """ Cleanup dead lifeforms """
-        for id, lifeform in self.lifeforms.items():
-            if lifeform.dead:
-                self.remove_gameobject(id=id)
+        if self.components is not None:
+            dead = self.components.dead()
+        else:
+            dead = [lifeform for lifeform in self.lifeforms.values() if lifeform.dead]
+        for lifeform in dead:
+            self.remove_gameobject(id=lifeform.id)
 
     def update(self, dt):
         """
@@ -159,8 +248,9 @@ class GameObjectController(object):
         :return:
         """
         self.dead_check()
+        self.perception.advance()
         # Update all game objects
-        for id, lifeform in self.lifeforms.items():
+        for id, lifeform in list(self.lifeforms.items()):
             lifeform.update(dt)
 
 
@@ -178,24 +268,106 @@ class GameObjectController(object):
         with open(filename, 'rb') as f:
             gameobject = pickle.load(f)
             f.close()
-        if self._gameobjects:
-            id = max(self._gameobjects) + 1
+        id = self.insert_gameobject(gameobject, room, coords)
+        return gameobject, id
+
+    def insert_gameobject(self, gameobject, room=None, coords=None, id=None):
+        """ Add an already instantiated gameobject, returns its id
+        :param id: keep this id, e.g. a player handed over from another shard, by default a new id is given """
+        if id is None:
+            id = self.ids.allocate()
         else:
-            id = 0
+            self.ids.reserve(id)
         gameobject.id = id
+        # Before room and coords, an unpickled gameobject may still refer to the controller it was saved from
+        gameobject.goc = self
         gameobject.current_room = room
         gameobject.coords = coords
-        gameobject.goc = self
-        self._gameobjects[id] = gameobject
-        return gameobject, id
+        self._index(gameobject)
+        return id
 
     # Internal methods, not to be called directly
 
-    def _create_gameobject(self, type='GameObject', **input_data):
-        if self._gameobjects:
-            id = max(self._gameobjects) + 1
+    def _index(self, gameobject):
+        """ Add gameobject to _gameobjects and the indexes """
+        id = gameobject.id
+        self._gameobjects[id] = gameobject
+        self._room_gameobjects.setdefault(gameobject.current_room, {})[id] = gameobject
+        if gameobject.destroyed:
+            self._destroyed[id] = gameobject
+        if isinstance(gameobject, LifeForm):
+            self._lifeforms[id] = gameobject
+            if self.components is not None:
+                self.components.attach(gameobject)
+            self._hash_insert(gameobject)
+            if gameobject.player:
+                self._players[id] = gameobject
+                self._players_by_name[gameobject.name] = gameobject
+            else:
+                self._npcs[id] = gameobject
+
+    def _unindex(self, id):
+        """ Remove the gameobject with id from _gameobjects and the indexes, KeyError if there isn't one """
+        gameobject = self._gameobjects.pop(id)
+        self._leave_room(id, gameobject.current_room)
+        if self._lifeforms.pop(id, None) is not None:
+            self._hash_remove(gameobject, gameobject.current_room)
+            if self.components is not None:
+                self.components.detach(gameobject)
+        for index in (self._npcs, self._destroyed):
+            index.pop(id, None)
+        if self._players.pop(id, None) is not None and self._players_by_name.get(gameobject.name) is gameobject:
+            del self._players_by_name[gameobject.name]
+
+    def _leave_room(self, id, uniquename):
+        room = self._room_gameobjects.get(uniquename)
+        if room is not None:
+            room.pop(id, None)
+            if not room:
+                del self._room_gameobjects[uniquename]
+
+    def _room_changed(self, gameobject, previous):
+        """ Called by GameObject.current_room """
+        id = gameobject.id
+        if self._gameobjects.get(id) is not gameobject:
+            # Not added yet, or already removed
+            return
+        self._leave_room(id, previous)
+        self._room_gameobjects.setdefault(gameobject.current_room, {})[id] = gameobject
+        if id in self._lifeforms:
+            if self.components is not None:
+                self.components.set_room(gameobject._slot, gameobject.current_room)
+            self._hash_remove(gameobject, previous)
+            self._hash_insert(gameobject)
+
+    def _coords_changed(self, gameobject):
+        """ Called by GameObject.coords """
+        if self._lifeforms.get(gameobject.id) is gameobject:
+            self._spatial_hashes[gameobject.current_room].move(gameobject)
+
+    def _hash_insert(self, lifeform):
+        spatial_hash = self._spatial_hashes.get(lifeform.current_room)
+        if spatial_hash is None:
+            spatial_hash = self._spatial_hashes[lifeform.current_room] = SpatialHash()
+        spatial_hash.insert(lifeform)
+
+    def _hash_remove(self, lifeform, uniquename):
+        spatial_hash = self._spatial_hashes.get(uniquename)
+        if spatial_hash is not None:
+            spatial_hash.remove(lifeform)
+
+    def _destroyed_changed(self, gameobject):
+        """ Called by GameObject.destroyed """
+        id = gameobject.id
+        if self._gameobjects.get(id) is not gameobject:
+            return
+        if gameobject.destroyed:
+            self._destroyed[id] = gameobject
         else:
-            id = 0
+            self._destroyed.pop(id, None)
+
+    def _create_gameobject(self, type='GameObject', **input_data):
+        id = self.ids.allocate()
         gameobject = eval(type)(id, **input_data)
         gameobject.id = id
         return gameobject, id
@@ -209,10 +381,9 @@ class GameObjectController(object):
         """
         lifeforms = room_instance.lifeforms
         print('Lifeforms loaded from tmx: {0}'.format(lifeforms))
-        for lifeform in lifeforms:
-            # Instantiate each lifeform and add to room
-            coords = [lifeform['x'] * TILE_SIZE, lifeform['y'] * TILE_SIZE]
-            lifeform, id = self.add_gameobject(lifeform['template'], room_instance.uniquename, coords)
+        spawns = [(lifeform['template'], room_instance.uniquename,
+                   [lifeform['x'] * TILE_SIZE, lifeform['y'] * TILE_SIZE]) for lifeform in lifeforms]
+        for lifeform, id in self.add_gameobjects(spawns):
             print('Spawned: {0}'.format(lifeform.name))
 
 
@@ -301,6 +472,67 @@ class GameObject(object):
         # Other attributes
         self.destroyed = False
 
+    def __setstate__(self, state):
+        """ Pickles from before coords, current_room and destroyed were properties hold them under their public
+        names """
+        for name in ('coords', 'current_room', 'destroyed'):
+            if name in state:
+                state['_' + name] = state.pop(name)
+        self.__dict__.update(state)
+
+    def __getstate__(self):
+        """ Attributes to pickle, values held in a ComponentStore are copied out of it """
+        state = self.__dict__.copy()
+        if state.pop('_components', None) is not None:
+            del state['_slot']
+            state['_coords'] = self.coords
+            state['stats'] = dict(self.stats)
+        return state
+
+    @property
+    def coords(self):
+        """ [x, y] in pixels, replace rather than change in place so the GOC's spatial hash and component store keep
+        up """
+        components = self.__dict__.get('_components')
+        if components is None:
+            return self._coords
+        return components.get_coords(self._slot)
+
+    @coords.setter
+    def coords(self, coords):
+        components = self.__dict__.get('_components')
+        if components is None:
+            self._coords = coords
+        else:
+            components.set_coords(self._slot, coords)
+        goc = self.__dict__.get('goc')
+        if goc is not None:
+            goc._coords_changed(self)
+
+    @property
+    def current_room(self):
+        return self._current_room
+
+    @current_room.setter
+    def current_room(self, uniquename):
+        """ Keeps the GOC's room index up to date """
+        previous = self.__dict__.get('_current_room')
+        self._current_room = uniquename
+        goc = self.__dict__.get('goc')
+        if goc is not None and previous != uniquename:
+            goc._room_changed(self, previous)
+
+    @property
+    def destroyed(self):
+        return self._destroyed
+
+    @destroyed.setter
+    def destroyed(self, destroyed):
+        self._destroyed = destroyed
+        goc = self.__dict__.get('goc')
+        if goc is not None:
+            goc._destroyed_changed(self)
+
     @property
     def graphic(self):
         return self._value(self.sprites['main'])
@@ -385,118 +617,98 @@ class LifeForm(GameObject):
         else:
             return True
 
-    # TODO :: None of these seem to work .. ? Fix them - Generators would be ideal
+    # Neighbour queries, answered from this tick's Perception of the lifeform (gameobjects/perception.py), which is
+    # worked out from the spatial hash of its room (gameobjects/spatialhash.py).  Only lifeforms in the same room and
+    # closer than sight are found, queries for a single lifeform return {} if there is none
+
+    @property
+    def perception(self):
+        """ Perception of this lifeform for the current tick, None if it isn't in a GOC """
+        if self.goc is None:
+            return None
+        return self.goc.perception.perceive(self)
+
+    def nearby(self, kind='lifeform'):
+        """
+        Lifeforms of kind in sight { <id>: <lifeform>, ... }
+        :param kind: 'lifeform', 'enemy', 'ally' or 'player'
+        """
+        perception = self.perception
+        if perception is None:
+            return {}
+        return {lf.id: lf for distance, lf in perception.of_kind(kind)}
+
+    def find_lifeform(self, condition, kind='lifeform'):
+        """
+        :param condition: 'nearest', 'farthest' or 'any'
+        :param kind: 'lifeform', 'enemy', 'ally' or 'player'
+        :return: lifeform of kind in sight meeting condition, {} if there is none
+        """
+        perception = self.perception
+        if perception is None:
+            return {}
+        lifeform = perception.find(condition, kind)
+        return {} if lifeform is None else lifeform
 
     @property
     def nearby_lifeforms(self):
-        return {lf.id: lf for id, lf in self.goc.lifeforms.items()
-                if point_distance(self.coords, lf.coords) < self.sight and lf != self}
+        return self.nearby('lifeform')
 
     @property
     def nearby_allies(self):
-        return {lf.id: lf for id, lf in self.nearby_lifeforms.items() if self.is_ally(lf)}
+        return self.nearby('ally')
 
     @property
     def nearby_enemies(self):
-        return {lf.id: lf for id, lf in self.nearby_lifeforms.items() if self.is_enemy(lf)}
+        return self.nearby('enemy')
 
     @property
     def nearby_players(self):
-        return {lf.id: lf for id, lf in self.nearby_lifeforms.items() if lf.player}
+        return self.nearby('player')
 
     @property
     def nearest_lifeform(self):
-        try:
-            return min({point_distance(self.coords, lifeform.coords): lifeform
-                        for key, lifeform in self.nearby_lifeforms.items()}.values())
-        except ValueError:
-            return {}
+        return self.find_lifeform('nearest')
 
     @property
     def farthest_lifeform(self):
-        try:
-            return min({point_distance(self.coords, lifeform.coords): lifeform
-                        for key, lifeform in self.nearby_lifeforms.items()}.values())
-        except ValueError:
-            return {}
+        return self.find_lifeform('farthest')
 
     @property
     def nearest_player(self):
-        try:
-            return min({point_distance(self.coords, lifeform.coords): lifeform
-                        for key, lifeform in self.nearby_players.items()}.values())
-        except ValueError:
-            return {}
+        return self.find_lifeform('nearest', 'player')
 
     @property
     def farthest_player(self):
-        try:
-            return max({point_distance(self.coords, lifeform.coords): lifeform
-                        for key, lifeform in self.nearby_players.items()}.values())
-        except ValueError:
-            return {}
+        return self.find_lifeform('farthest', 'player')
 
     @property
     def nearest_enemy(self):
-        try:
-            return min({point_distance(self.coords, lifeform.coords): lifeform
-                        for key, lifeform in self.nearby_enemies.items()}.values())
-        except ValueError:
-            return {}
+        return self.find_lifeform('nearest', 'enemy')
 
     @property
     def farthest_enemy(self):
-        try:
-            return max({point_distance(self.coords, lifeform.coords): lifeform
-                        for key, lifeform in self.nearby_enemies.items()}.values())
-        except ValueError:
-            return {}
+        return self.find_lifeform('farthest', 'enemy')
 
     @property
     def nearest_ally(self):
-        try:
-            return min({point_distance(self.coords, lifeform.coords): lifeform
-                        for key, lifeform in self.nearby_allies.items()}.values())
-        except ValueError:
-            return {}
+        return self.find_lifeform('nearest', 'ally')
 
     @property
     def farthest_ally(self):
-        try:
-            return max({point_distance(self.coords, lifeform.coords): lifeform
-                        for key, lifeform in self.nearby_allies.items()}.values())
-        except ValueError:
-            return {}
+        return self.find_lifeform('farthest', 'ally')
 
     @property
     def any_ally(self):
-        # This is written in this convoluted way because random.choice(Dict) is currently broken
-        nearby_allies = self.nearby_allies
-        if nearby_allies:
-            keys = nearby_allies.keys()
-            return nearby_allies[random.choice(keys)]
-        else:
-            return {}
+        return self.find_lifeform('any', 'ally')
 
     @property
     def any_player(self):
-        # This is written in this convoluted way because random.choice(Dict) is currently broken
-        nearby_players = self.nearby_players
-        if nearby_players:
-            keys = nearby_players.keys()
-            return nearby_players[random.choice(keys)]
-        else:
-            return {}
+        return self.find_lifeform('any', 'player')
 
     @property
     def any_enemy(self):
-        # This is written in this convoluted way because random.choice(Dict) is currently broken
-        nearby_enemies = self.nearby_enemies
-        if nearby_enemies:
-            keys = nearby_enemies.keys()
-            return nearby_enemies[random.choice(keys)]
-        else:
-            return {}
+        return self.find_lifeform('any', 'enemy')
 
     @property
     def move_time(self):
@@ -597,6 +809,10 @@ class LifeForm(GameObject):
     # Queries
 
     def is_enemy(self, lifeform):
+        if self.goc is not None:
+            # Faction relations are cached for the tick
+            perception = self.goc.perception
+            return perception.primary_faction(lifeform) in perception.hated_factions(self)
         if lifeform.primary_faction in self.hated_factions:
             return True
         else:
@@ -610,8 +826,12 @@ class LifeForm(GameObject):
 
     # Actions
 
-    def change_room(self, roomname):
-        pass
+    def change_room(self, roomname, coords=None):
+        """ Move to another room, the room may be simulated by another shard, see mp/shard.py """
+        self.current_room = roomname
+        if coords is not None:
+            self.coords = coords
+        self.route = []
 
     def change_target(self, targetid):
         self.target = targetid
@@ -0,0 +1,92 @@
+"""
+Gameobject id allocator, hands out ids in O(1) and reuses the ids of removed gameobjects
+
+An id is <generation> * ID_GENERATION_STRIDE + <slot>.  Slots of removed gameobjects go on a free list and are handed
+out again oldest first, with the generation moved on, so a client or gameobject still holding the old id finds nothing
+under it rather than the gameobject that took its slot.  Generations wrap after ID_GENERATIONS reuses of one slot.
+Ids stay below 2 ** 31, the compact snapshot encoding sends them as int32.
+"""
+from collections import deque
+
+
+# Slots an allocator can own, room shards (mp/shard.py) split these between them
+ID_GENERATION_STRIDE = 1 << 24
+ID_GENERATIONS = 1 << 7
+
+
+class IdAllocator(object):
+    """ Owns slots base to base + size, ids with a slot outside them (from other shards) are left alone """
+    def __init__(self, base=0, size=None):
+        if size is None:
+            size = ID_GENERATION_STRIDE - base
+        if base < 0 or size <= 0 or base + size > ID_GENERATION_STRIDE:
+            raise ValueError('Id range {0} to {1} does not fit in {2} slots'.format(base, base + size,
+                                                                                  ID_GENERATION_STRIDE))
+        self.base = base
+        self.size = size
+        # Current generation of every slot handed out so far, by slot - base
+        self.generations = []
+        # Freed slots, oldest first.  A slot in free but not in is_free was reserved since, it is skipped
+        self.free = deque()
+        self.is_free = set()
+
+    def split(self, id):
+        """ (<slot - base>, <generation>) of id, slot is None if this allocator doesn't own it """
+        generation, slot = divmod(id, ID_GENERATION_STRIDE)
+        index = slot - self.base
+        if not 0 <= index < self.size:
+            return None, generation
+        return index, generation
+
+    def allocate(self):
+        """ A new id, RuntimeError once every slot is in use """
+        while self.free:
+            index = self.free.popleft()
+            if index in self.is_free:
+                self.is_free.discard(index)
+                return self.generations[index] * ID_GENERATION_STRIDE + self.base + index
+        index = len(self.generations)
+        if index >= self.size:
+            raise RuntimeError('All {0} gameobject ids from {1} are in use'.format(self.size, self.base))
+        self.generations.append(0)
+        return self.base + index
+
+    def allocate_many(self, count):
+        return [self.allocate() for i in range(count)]
+
+    def release(self, id):
+        """ The gameobject with id is gone, its slot may be reused """
+        index, generation = self.split(id)
+        if index is None or index >= len(self.generations) or index in self.is_free:
+            return
+        if self.generations[index] != generation:
+            # An id from before the slot was last reused
+            return
+        self.generations[index] = (generation + 1) % ID_GENERATIONS
+        self.free.append(index)
+        self.is_free.add(index)
+
+    def reserve(self, id):
+        """ Mark an id chosen elsewhere (restored from a checkpoint, a player returning to this shard) as in use """
+        index, generation = self.split(id)
+        if index is None:
+            return
+        while len(self.generations) <= index:
+            # Slots skipped over are free
+            skipped = len(self.generations)
+            self.generations.append(0)
+            if skipped != index:
+                self.free.append(skipped)
+                self.is_free.add(skipped)
+        self.is_free.discard(index)
+        self.generations[index] = generation
+
+    def is_stale(self, id):
+        """ True if id's slot has been freed, and maybe reused, since id was handed out """
+        index, generation = self.split(id)
+        return index is not None and index < len(self.generations) and self.generations[index] != generation
+
+    def clear(self):
+        del self.generations[:]
+        self.free.clear()
+        self.is_free.clear()
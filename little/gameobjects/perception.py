@@ -0,0 +1,95 @@
+"""
+Per-tick perception cache, what each lifeform can see worked out at most once per tick
+
+An AI pass asks for nearby enemies, then the nearest, then any of them, and every lifeform checks the factions of
+every candidate.  PerceptionCache keeps, for the current tick, each lifeform's lifeforms in sight sorted by distance
+and each lifeform's primary and hated factions.  GameObjectController.update advances the tick, which throws it all
+away, so within a tick lifeforms see each other where they were when first asked.
+"""
+import random
+
+
+# Kinds of lifeform a Perception can be filtered to, see LifeForm.find_lifeform
+KINDS = ['lifeform', 'enemy', 'ally', 'player']
+
+
+class Perception(object):
+    """ Lifeforms one lifeform can see this tick """
+    def __init__(self, lifeform, cache):
+        self.room = lifeform.current_room
+        self.sight = lifeform.sight
+        self.cache = cache
+        self.hated_factions = cache.hated_factions(lifeform)
+        spatial_hash = lifeform.goc.spatial_hash(self.room)
+        if spatial_hash is None:
+            found = []
+        else:
+            found = spatial_hash.query(lifeform.coords, self.sight, lambda lf: lf is not lifeform)
+            found.sort(key=lambda item: item[0])
+        # Like {<kind>: [(<distance>, <lifeform>), ... ] nearest first, ... }, filled in as kinds are asked for
+        self.kinds = {'lifeform': found}
+
+    def of_kind(self, kind):
+        """ [(<distance>, <lifeform>), ... ] of the lifeforms in sight of kind, nearest first """
+        found = self.kinds.get(kind)
+        if found is None:
+            if kind not in KINDS:
+                raise ValueError('Unknown kind of lifeform: {0}'.format(kind))
+            everything = self.kinds['lifeform']
+            if kind == 'player':
+                found = [item for item in everything if item[1].player]
+            else:
+                primary_faction = self.cache.primary_faction
+                hated = self.hated_factions
+                enemy = kind == 'enemy'
+                found = [item for item in everything if (primary_faction(item[1]) in hated) == enemy]
+            self.kinds[kind] = found
+        return found
+
+    def find(self, condition, kind='lifeform'):
+        """ Lifeform of kind meeting condition, 'nearest', 'farthest' or 'any', None if there is none """
+        found = self.of_kind(kind)
+        if not found:
+            return None
+        if condition == 'nearest':
+            return found[0][1]
+        if condition == 'farthest':
+            return found[-1][1]
+        if condition == 'any':
+            return random.choice(found)[1]
+        raise ValueError('Unknown target condition: {0}'.format(condition))
+
+
+class PerceptionCache(object):
+    """ Perceptions and faction relations of the lifeforms in one GameObjectController, for the current tick """
+    def __init__(self):
+        self.tick = 0
+        # Like {<id>: <Perception>, ... }
+        self.perceptions = {}
+        # Like {<id>: (<primary faction>, <frozenset of hated factions>), ... }
+        self.factions = {}
+
+    def advance(self):
+        """ Start a new tick, everything cached so far is out of date """
+        self.tick += 1
+        self.perceptions.clear()
+        self.factions.clear()
+
+    def perceive(self, lifeform):
+        perception = self.perceptions.get(lifeform.id)
+        if perception is None or perception.sight != lifeform.sight or perception.room != lifeform.current_room:
+            # Sight changes between idle and combat, check again with the new range
+            perception = self.perceptions[lifeform.id] = Perception(lifeform, self)
+        return perception
+
+    def _factions(self, lifeform):
+        factions = self.factions.get(lifeform.id)
+        if factions is None:
+            factions = self.factions[lifeform.id] = (lifeform.primary_faction, frozenset(lifeform.hated_factions))
+        return factions
+
+    def primary_faction(self, lifeform):
+        return self._factions(lifeform)[0]
+
+    def hated_factions(self, lifeform):
+        return self._factions(lifeform)[1]
@@ -0,0 +1,83 @@
+"""
+Uniform grid spatial hash, finds the gameobjects near a point without looking at every gameobject in the room
+
+GameObjectController keeps one per room holding its lifeforms, moved as their coords change.  Cells are CELL_SIZE
+pixels square, so a radius query only visits the cells the circle overlaps.
+"""
+import math
+
+
+TILE_SIZE = 8
+# Pixels, about half the default LifeForm sight of 100, so a sight query visits 5 or 6 cells across
+CELL_SIZE = 6 * TILE_SIZE
+
+
+class SpatialHash(object):
+    """ Gameobjects bucketed by the grid cell their coords fall in """
+    def __init__(self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        # Like {(<cell x>, <cell y>): {<id>: <gameobject>, ... }, ... }
+        self.cells = {}
+        # Cell each gameobject is in, like {<id>: (<cell x>, <cell y>), ... }
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, gameobject):
+        return gameobject.id in self.positions
+
+    def cell(self, coords):
+        return int(coords[0] // self.cell_size), int(coords[1] // self.cell_size)
+
+    def insert(self, gameobject):
+        """ Add gameobject at its coords, gameobjects without coords are left out until they have some """
+        if gameobject.coords is None:
+            return
+        cell = self.positions[gameobject.id] = self.cell(gameobject.coords)
+        self.cells.setdefault(cell, {})[gameobject.id] = gameobject
+
+    def remove(self, gameobject):
+        cell = self.positions.pop(gameobject.id, None)
+        if cell is None:
+            return
+        members = self.cells[cell]
+        members.pop(gameobject.id, None)
+        if not members:
+            del self.cells[cell]
+
+    def move(self, gameobject):
+        """ Call after gameobject's coords changed """
+        previous = self.positions.get(gameobject.id)
+        if gameobject.coords is not None and previous == self.cell(gameobject.coords):
+            return
+        self.remove(gameobject)
+        self.insert(gameobject)
+
+    def query(self, coords, radius, predicate=None):
+        """
+        Gameobjects closer to coords than radius
+        :param predicate: only gameobjects for which predicate(gameobject) is True
+        :return: [(<distance>, <gameobject>), ... ] in no particular order
+        """
+        found = []
+        if coords is None:
+            return found
+        x, y = coords
+        first_x, first_y = self.cell((x - radius, y - radius))
+        last_x, last_y = self.cell((x + radius, y + radius))
+        cells = self.cells
+        for cell_x in range(first_x, last_x + 1):
+            for cell_y in range(first_y, last_y + 1):
+                members = cells.get((cell_x, cell_y))
+                if members:
+                    self._collect(members, x, y, radius, predicate, found)
+        return found
+
+    @staticmethod
+    def _collect(members, x, y, radius, predicate, found):
+        for gameobject in members.values():
+            other_x, other_y = gameobject.coords
+            distance = math.sqrt((other_x - x) ** 2 + (other_y - y) ** 2)
+            if distance < radius and (predicate is None or predicate(gameobject)):
+                found.append((distance, gameobject))
@@ -2,6 +2,7 @@
 
 from __future__ import division
 
+import argparse
 import pygame
 from pygame.locals import *
 from pytmx.util_pygame import load_pygame
@@ -14,8 +15,9 @@ import graphics.eztext as eztext
 from graphics.graphictext import draw_lines, draw_text, InputLog, InventoryBox
 
 from functions.game_math import negpos, point_distance, map_pos
-from mp.client import PacketSizeMismatch
+from mp.client import PacketSizeMismatch, ServerResponseError
 from mp.client import GameClient
+from mp.protocol import PORT
 
 from local.remote_gameobject import Hero
 from local.input import PlayerController
@@ -36,9 +38,10 @@ def init_screen(width, height):
 class Game(object):
     """This class is essentially the Wizard of Oz"""
     def __init__(self, charactername='Zaxim', username='ken', password='mypw', ip='127.0.0.1',
-                 current_room=None):
+                 current_room=None, port=PORT):
         # Client for issuing requests to server and receiving responses
-        self.client = GameClient(charactername=charactername, username=username, password=password, ip=ip)
+        self.client = GameClient(charactername=charactername, username=username, password=password, ip=ip,
+                                 port=port)
 
         # Remote sprite controller
         self.rsc = RemoteSpriteController(self)
@@ -95,6 +98,13 @@ class Game(object):
 
         self.rsc.initialize()
 
+        # Have room state pushed to us, keep polling if the server won't
+        if PUSH_UPDATES:
+            try:
+                self.client.subscribe(PUSH_INTERVAL, COMPACT_SNAPSHOTS)
+            except ServerResponseError:
+                self.inputlog.add_line('Server push unavailable, polling instead', SYSTEM_COLOR)
+
     @property
     def screen_size(self):
         return pygame.display.Info().current_w, pygame.display.Info().current_h
@@ -119,11 +129,17 @@ class Game(object):
 
     def poll_server(self, dt=60):
         """ get remotesprite coordinate updates from server and pass to remotesprite controller """
+        # Apply room state the server pushed since last frame
+        if self.client.subscribed:
+            for push in self.client.receive_pushes():
+                self.update_lifeforms({'status': 0, 'response': push})
         self.poll_timer -= dt / 50.
         if self.poll_timer <= 0:
             self.poll_timer = self.poll_frequency
             # Interface with RemoteSpriteController and update all lifeform coords
-            self.update_lifeforms()
+            if not self.client.subscribed:
+                self.client.queue('get_roomdata', {'ack': self.rsc.seq, 'compact': COMPACT_SNAPSHOTS},
+                                  callback=self.update_lifeforms)
             # Update target if hero has one
             self.hero.tgh.update_target()
             # Update our Hero's armor
@@ -131,14 +147,17 @@ class Game(object):
             self.hero.remotesprite.visualequipment.update_sprites(equipment_graphics)
             # TODO: Update remote player's inventory graphics
 
-    def update_lifeforms(self):
+    def update_lifeforms(self, r):
         """Update co-ordinates of all remote sprites with new information from server, also updates chat que and other
-        important information from the server """
+        important information from the server
+        :param r: get_roomdata payload, flushed with the rest of the frame's requests """
+        if r['status'] != 0:
+            return
         # Update data on all lifeforms in room
-        r = self.client.send('get_roomdata')
-        coords_dict = r['response']['coords']
-        if coords_dict:
-            self.rsc.update_coords(coords_dict)
+        if 'snapshot' in r['response']:
+            self.rsc.apply_snapshot(r['response']['snapshot'])
+        elif r['response']['coords']:
+            self.rsc.update_coords(r['response']['coords'])
 
         # Update chat messages
         messages = r['response']['messages']
@@ -162,7 +181,8 @@ class Game(object):
     def update(self, dt):
         """ Tasks that occur over time should be handled here"""
         # self.hero.remotesprite.visualequipment.update()
-        # update all sprites in game world
+        # move remote sprites along their buffered positions, then update all sprites in game world
+        self.rsc.update(dt)
         self.group.update(dt)
         # update camera position (follows player)
         self.hero.camera.update(dt)
@@ -184,9 +204,15 @@ class Game(object):
             if self.hero.move_timer <= 0:
                 self.hero.moving = False
                 self.hero.position = self.hero.target_coords
-                r = self.client.send('update_coords', [self.hero.x, self.hero.y])
-                self.hero.move_time = r['response']['move_time']
-                self.hero.attack_time = r['response']['attack_time']
+                self.client.queue('update_coords', self.hero.predict_move([self.hero.x, self.hero.y]),
+                                  callback=self.update_hero_timers)
+
+    def update_hero_timers(self, r):
+        """ Take move_time and attack_time from the update_coords payload, and correct our predicted position """
+        if r['status'] == 0:
+            self.hero.move_time = r['response']['move_time']
+            self.hero.attack_time = r['response']['attack_time']
+            self.hero.reconcile(r['response']['seq'], r['response']['coords'])
 
     def autoattack(self, dt):
         if self.hero.attacking:
@@ -195,7 +221,7 @@ class Game(object):
                 self.hero.attack_timer = self.hero.attack_time
                 if self.hero.tgh.target:
                     if point_distance(self.hero.coords, self.hero.tgh.coords) < 14:
-                        self.client.send('attack', self.hero.tgh.id)
+                        self.client.queue('attack', self.hero.tgh.id)
 
     def draw(self, surface):
         # center the map/screen on our Hero
@@ -228,6 +254,12 @@ class Game(object):
                 # Handle input and render
                 self.input.handle_input(dt)
                 self.update(dt)
+
+                # Send everything this frame queued for the server as one batch
+                try:
+                    self.client.flush()
+                except PacketSizeMismatch:
+                    self.inputlog.add_line('Packet size mismatch!! Ignoring')
                 self.draw(screen)
 
                 if self.hero.particle:
@@ -279,6 +311,10 @@ class Game(object):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Little client')
+    parser.add_argument('--ip', default='127.0.0.1', help='game server address')
+    parser.add_argument('--port', type=int, default=PORT, help='game server port, or a mp/netem.py proxy')
+    args = parser.parse_args()
     print('Testing Client::: PREALPHA')
     charactername = raw_input('charactername: ')
     username = raw_input('Username: ')
@@ -290,7 +326,7 @@ if __name__ == "__main__":
     pygame.display.set_caption('Little v0.0.1')
 
     try:
-        game = Game(charactername=charactername, username=username, password=password)
+        game = Game(charactername=charactername, username=username, password=password, ip=args.ip, port=args.port)
         game.screen = screen
         game.run()
     except:
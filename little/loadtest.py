@@ -0,0 +1,342 @@
+"""
+Headless bot swarm load test for GameController
+
+    python loadtest.py --bots 10 25 50 100 --duration 30
+    python loadtest.py --bots 25 --netem wan
+
+Starts a GameController in a child process (or targets a running server with --host), then ramps up to each bot
+count in turn.  Bots are GameClients with no pygame window that log in, subscribe to room pushes, walk, chat and
+attack on roughly human schedules.  After each step the server side latency percentiles per request type, tick
+rate and failed requests are printed, so the step where the tick rate drops or latency climbs is the player ceiling.
+
+Bot characters are copies of BOT_TEMPLATE saved as mp/users/Bot<n>.sav, they are removed again when the test ends.
+The server started here keeps characters in a throwaway database, deleted with the bot saves, so the bots never end up
+in mp/users/characters.db.  A server started with --host must already know about the bot accounts (see bot_users) and
+allow the admin account to send 'metrics' requests, the bots are stored in its character database.
+
+With --netem the bots connect through a mp/netem.py proxy emulating the named network profile, the admin account that
+collects metrics connects directly.
+"""
+from __future__ import division
+
+import argparse
+import multiprocessing
+import os
+import pickle
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from mp.client import GameClient, ServerResponseError
+from mp.netem import NetemProxy, PROFILES, NETEM_PORT
+from mp.protocol import ProtocolError, PORT
+from mp.snapshot import unpack_delta
+
+
+# Save file every bot character is copied from
+BOT_TEMPLATE = 'mp/users/Zaxim.sav'
+BOT_PASSWORD = 'botpw'
+# Account used to enable, reset and collect server metrics, must be in mp.server.ADMIN_USERS
+ADMIN_USER = ('ken', 'Zaxim', 'mypw')
+
+TILE_SIZE = 8
+# Milliseconds between frames, each frame a bot sends at most one batch
+FRAME_TIME = 100
+# Mean milliseconds between actions, actual gaps are random around these
+MOVE_TIME = 400
+ATTACK_TIME = 2000
+CHAT_TIME = 20000
+# Bots wander at most this many tiles from where they logged in
+WANDER_TILES = 12
+# Pixels, same as the client's autoattack range
+ATTACK_RANGE = 14
+# Seconds the bots run before metrics are reset at the start of a step, lets logins settle
+WARMUP = 3
+
+CHAT_LINES = ['hello', 'anyone want to group?', 'lol', 'where is the shop', 'brb', 'nice', 'gg']
+
+
+def bot_names(count):
+    return ['Bot{0}'.format(i) for i in range(count)]
+
+
+def bot_users(names):
+    """ Accounts for the bot characters in GameServer.user_data format, one account per bot """
+    return dict((name.lower(), {'password': BOT_PASSWORD, 'characters': {name: '{0}.sav'.format(name)}})
+                for name in names)
+
+
+def make_bot_saves(names):
+    """ Save a copy of BOT_TEMPLATE under each bot's name, returns the files created """
+    with open(BOT_TEMPLATE, 'rb') as f:
+        template = pickle.load(f)
+    created = []
+    for name in names:
+        filename = 'mp/users/{0}.sav'.format(name)
+        if os.path.exists(filename):
+            continue
+        template.settings['name'] = name
+        with open(filename, 'wb') as f:
+            pickle.dump(template, f, protocol=pickle.HIGHEST_PROTOCOL)
+        created.append(filename)
+    return created
+
+
+def run_server(names, character_db, shards=0):
+    """ Child process: GameController with the bot accounts added and metrics switched on
+    :param character_db: character database to use instead of mp.server.CHARACTER_DB """
+    import mp.server
+    from gamecontroller import GameController
+    # Before the GameController, its RequestProcessor (and those of its shards) open the database
+    mp.server.CHARACTER_DB = character_db
+    gc = GameController(shards=shards)
+    gc.gameserver.user_data.update(bot_users(names))
+    gc.gameserver.metrics.enabled = True
+    gc.run()
+
+
+def percentile(samples, percent):
+    """ :param samples: sorted list """
+    if not samples:
+        return 0.
+    return samples[min(len(samples) - 1, int(len(samples) * percent / 100.))]
+
+
+class BotStats(object):
+    """ Client side counters shared by every bot, guarded by a lock as bots run in their own threads """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # Milliseconds per batch round trip
+            self.latencies = []
+            self.batches = 0
+            self.failures = 0
+            self.errors = {}
+
+    def batch(self, latency, payloads):
+        with self.lock:
+            self.batches += 1
+            self.latencies.append(latency)
+            for payload in payloads:
+                if payload.get('status') != 0:
+                    response = payload.get('response')
+                    self._failure(response.get('message') if isinstance(response, dict) else response)
+
+    def failure(self, reason):
+        with self.lock:
+            self._failure(reason)
+
+    def _failure(self, reason):
+        self.failures += 1
+        self.errors[reason] = self.errors.get(reason, 0) + 1
+
+
+class Bot(threading.Thread):
+    """ One headless player, logs in and plays until stop is set """
+    def __init__(self, name, ip, stats, stop, port=PORT):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.client = GameClient(ip=ip, charactername=name, username=name.lower(), password=BOT_PASSWORD,
+                                 verbose=False, port=port)
+        self.stats = stats
+        self.stop = stop
+        self.logged_in = False
+        self.home = None
+        self.coords = None
+        # Room as seen through pushes, like {<id>: [x, y], ... }
+        self.room = {}
+
+        now = time.time()
+        self.next_move = now + random.expovariate(1000. / MOVE_TIME)
+        self.next_attack = now + random.expovariate(1000. / ATTACK_TIME)
+        self.next_chat = now + random.expovariate(1000. / CHAT_TIME)
+
+    def run(self):
+        try:
+            r = self.client.login()
+            self.home = list(r['response']['coords'] or [160, 160])
+            self.coords = list(self.home)
+            self.client.subscribe(compact=True)
+            self.logged_in = True
+        except (ServerResponseError, ProtocolError, socket.error, KeyError, TypeError) as e:
+            self.stats.failure('login: {0}'.format(e))
+            return
+        while not self.stop.is_set():
+            start = time.time()
+            try:
+                self.frame(start)
+            except (ServerResponseError, ProtocolError, socket.error) as e:
+                self.stats.failure('{0}: {1}'.format(type(e).__name__, e))
+            remaining = FRAME_TIME / 1000. - (time.time() - start)
+            if remaining > 0:
+                time.sleep(remaining)
+        try:
+            self.client.logout()
+        except (ServerResponseError, ProtocolError, socket.error):
+            pass
+        self.client.disconnect()
+
+    def frame(self, now):
+        for push in self.client.receive_pushes():
+            self.apply(push['snapshot'])
+        if now >= self.next_move:
+            self.next_move = now + random.expovariate(1000. / MOVE_TIME)
+            self.walk()
+            self.client.queue('update_coords', list(self.coords))
+        if now >= self.next_attack:
+            self.next_attack = now + random.expovariate(1000. / ATTACK_TIME)
+            target = self.nearest()
+            if target is not None:
+                self.client.queue('attack', target)
+                self.client.queue('get_target', [target])
+        if now >= self.next_chat:
+            self.next_chat = now + random.expovariate(1000. / CHAT_TIME)
+            message = '{0}: {1}'.format(self.client.charactername, random.choice(CHAT_LINES))
+            self.client.queue('say', {'message': message, 'id': None})
+        if self.client.batch:
+            start = time.time()
+            payloads = self.client.flush()
+            self.stats.batch((time.time() - start) * 1000., payloads)
+
+    def apply(self, delta):
+        """ Apply a compact snapshot, like RemoteSpriteController.apply_compact without the sprites """
+        unpack_delta(delta)
+        if delta['baseline'] is None:
+            self.room = {}
+        for key in ('added', 'moved'):
+            coords = delta[key]['coords']
+            for i, id in enumerate(delta[key]['ids']):
+                self.room[id] = coords[2 * i:2 * i + 2]
+        for id in delta['removed']:
+            self.room.pop(id, None)
+
+    def walk(self):
+        """ One tile in a random direction, staying within WANDER_TILES of home """
+        for axis in (0, 1):
+            step = random.choice((-TILE_SIZE, 0, TILE_SIZE))
+            if abs(self.coords[axis] + step - self.home[axis]) <= WANDER_TILES * TILE_SIZE:
+                self.coords[axis] += step
+
+    def nearest(self):
+        best, best_distance = None, ATTACK_RANGE ** 2
+        for id, coords in self.room.items():
+            if id == self.client.id:
+                continue
+            distance = (coords[0] - self.coords[0]) ** 2 + (coords[1] - self.coords[1]) ** 2
+            if distance <= best_distance:
+                best, best_distance = id, distance
+        return best
+
+
+def server_metrics(admin, **args):
+    return admin.send('metrics', args)['response']
+
+
+def report(count, seconds, metrics, stats, proxy=None):
+    """ Print the results of one step """
+    tick = metrics['phases'].get('tick', {'count': 0, 'mean': 0., 'p99': 0., 'max': 0.})
+    print('=' * 100)
+    print('{0} bots, {1:.1f}s'.format(count, seconds))
+    print('Server ticks/s: {0:.1f}  tick mean: {1:.2f}ms  p99: {2:.2f}ms  max: {3:.2f}ms'.format(
+        tick['count'] / metrics['seconds'] if metrics['seconds'] else 0., tick['mean'], tick['p99'], tick['max']))
+    for name, phase in sorted(metrics['phases'].items()):
+        if name != 'tick':
+            print('  phase {0:<16} mean: {1:.2f}ms  p99: {2:.2f}ms'.format(name, phase['mean'], phase['p99']))
+    compression = metrics.get('compression')
+    if compression and compression['count']:
+        print('Compressed {0} messages  ratio: {1:.2f}  mean: {2:.3f}ms  p99: {3:.3f}ms'.format(
+            compression['count'], compression['ratio'], compression['latency']['mean'], compression['latency']['p99']))
+    print('{0:<18}{1:>8}{2:>8}{3:>10}{4:>10}{5:>10}{6:>10}{7:>10}'.format(
+        'request', 'count', 'errors', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'bytes'))
+    for name, request in sorted(metrics['requests'].items()):
+        latency = request['latency']
+        print('{0:<18}{1:>8}{2:>8}{3:>10.3f}{4:>10.3f}{5:>10.3f}{6:>10.3f}{7:>10.0f}'.format(
+            name, request['count'], request['errors'], latency['p50'], latency['p90'], latency['p99'],
+            latency['max'], request['mean_bytes']))
+    with stats.lock:
+        latencies = sorted(stats.latencies)
+        print('Client batches: {0}  round trip p50: {1:.2f}ms  p99: {2:.2f}ms  failed requests: {3}'.format(
+            stats.batches, percentile(latencies, 50), percentile(latencies, 99), stats.failures))
+        for reason, count in sorted(stats.errors.items(), key=lambda item: -item[1]):
+            print('  {0} x {1}'.format(count, reason))
+    if proxy is not None:
+        netem = proxy.stats.report()
+        print('Netem frames: {0}  mean delay: {1:.1f}ms  retransmits: {2}  stalls: {3}  reordered: {4}'.format(
+            netem['frames'], netem['mean_delay'], netem['retransmits'], netem['stalls'], netem['reordered']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless bot swarm load test for the little game server')
+    parser.add_argument('--bots', type=int, nargs='+', default=[10, 25, 50, 100],
+                        help='bot counts to step through, bots are added between steps')
+    parser.add_argument('--duration', type=float, default=30, help='seconds measured at each step')
+    parser.add_argument('--host', default=None, help='target a running server instead of starting one')
+    parser.add_argument('--shards', type=int, default=0, help='room shard processes for the server started here')
+    parser.add_argument('--netem', default=None, choices=sorted(PROFILES),
+                        help='connect the bots through a proxy emulating this network profile')
+    args = parser.parse_args()
+
+    names = bot_names(max(args.bots))
+    created = make_bot_saves(names)
+    server = None
+    scratch = None
+    if args.host is None:
+        scratch = tempfile.mkdtemp(prefix='loadtest')
+        server = multiprocessing.Process(target=run_server, name='GameController',
+                                         args=(names, os.path.join(scratch, 'characters.db'), args.shards))
+        server.start()
+        time.sleep(2)
+    ip = args.host or '127.0.0.1'
+    proxy = None
+    port = PORT
+    if args.netem is not None:
+        upstream, downstream = PROFILES[args.netem]
+        proxy = NetemProxy(('127.0.0.1', NETEM_PORT), (ip, PORT), upstream, downstream)
+        proxy.start()
+        ip, port = '127.0.0.1', NETEM_PORT
+
+    admin = GameClient(args.host or '127.0.0.1', ADMIN_USER[1], ADMIN_USER[0], ADMIN_USER[2], verbose=False)
+    stats = BotStats()
+    stop = threading.Event()
+    bots = []
+    try:
+        server_metrics(admin, enable=True)
+        for count in sorted(args.bots):
+            while len(bots) < count:
+                bot = Bot(names[len(bots)], ip, stats, stop, port)
+                bot.start()
+                bots.append(bot)
+            time.sleep(WARMUP)
+            stats.reset()
+            if proxy is not None:
+                proxy.stats.reset()
+            server_metrics(admin, reset=True)
+            start = time.time()
+            time.sleep(args.duration)
+            report(count, time.time() - start, server_metrics(admin), stats, proxy)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        for bot in bots:
+            bot.join(5)
+        admin.disconnect()
+        if proxy is not None:
+            proxy.stop()
+        if server is not None:
+            server.terminate()
+            server.join()
+        for filename in created:
+            os.remove(filename)
+        if scratch is not None:
+            shutil.rmtree(scratch)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Smooth remote sprite movement between room snapshots
+
+Snapshots arrive every push interval (or poll), so setting a sprite's coords from each one makes it jump a tile at a
+time.  Instead every sprite keeps a short buffer of timestamped positions and is drawn a little in the past, between
+the two snapshots either side of the render time.  How far in the past follows the measured gap between snapshots, so
+lowering the push or poll rate only makes remote sprites trail further behind rather than stutter.
+"""
+from __future__ import division
+
+from collections import deque
+
+
+# Snapshot gaps the render time trails the newest snapshot by, two rides out one late or lost snapshot
+INTERPOLATION_SNAPSHOTS = 2
+# Milliseconds, bounds on the interpolation delay whatever the measured snapshot rate
+MIN_INTERPOLATION_DELAY = 50
+MAX_INTERPOLATION_DELAY = 1000
+# Weight of the newest gap in the running mean gap between snapshots
+GAP_SMOOTHING = 0.1
+# Milliseconds a sprite keeps moving past its newest position while the next snapshot is late
+MAX_EXTRAPOLATION = 100
+# Positions kept per sprite
+BUFFER_LENGTH = 8
+# Pixels, a sprite that jumps further than this between snapshots is moved at once (room changes, teleports)
+SNAP_DISTANCE = 64
+
+
+class InterpolationBuffer(object):
+    """ Timestamped positions of one remote sprite, oldest first, all times in milliseconds of client game time """
+    def __init__(self, length=BUFFER_LENGTH):
+        # [(<time>, [x, y]), ... ]
+        self.samples = deque(maxlen=length)
+        # Last sample dropped from the front of the buffer, gives the direction to extrapolate in
+        self.previous = None
+
+    def push(self, time, coords):
+        """ Position the server reported at time, clears the buffer if the sprite jumped """
+        coords = list(coords)
+        samples = self.samples
+        if samples:
+            last_time, last = samples[-1]
+            if abs(coords[0] - last[0]) > SNAP_DISTANCE or abs(coords[1] - last[1]) > SNAP_DISTANCE:
+                self.clear()
+            elif time <= last_time:
+                samples.pop()
+        samples.append((time, coords))
+
+    def hold(self, time):
+        """ The sprite was still at its newest position at time, keeps a later move from being spread out over the
+        whole time the sprite stood still """
+        samples = self.samples
+        if samples and time is not None and samples[-1][0] < time:
+            samples.append((time, samples[-1][1]))
+
+    def clear(self):
+        self.samples.clear()
+        self.previous = None
+
+    def sample(self, time, newest=None):
+        """
+        Position at time, interpolated between the samples either side of it
+        :param time: render time
+        :param newest: time of the newest snapshot, a sprite whose last sample is older than this did not move in it
+        and is not extrapolated
+        :return: [x, y], None if nothing has been pushed yet
+        """
+        samples = self.samples
+        if not samples:
+            return None
+        # Samples before the one at or just before time are not needed again
+        while len(samples) > 1 and samples[1][0] <= time:
+            self.previous = samples.popleft()
+        start_time, start = samples[0]
+        if time <= start_time:
+            return list(start)
+        if len(samples) > 1:
+            end_time, end = samples[1]
+        else:
+            # Past the newest sample, keep going the way the sprite was going for a little while
+            if self.previous is None or (newest is not None and start_time < newest):
+                return list(start)
+            end_time, end = start_time, start
+            start_time, start = self.previous
+            time = min(time, end_time + MAX_EXTRAPOLATION)
+        fraction = (time - start_time) / (end_time - start_time)
+        return [start[0] + (end[0] - start[0]) * fraction, start[1] + (end[1] - start[1]) * fraction]
@@ -2,9 +2,12 @@ import pygame
 from camera import Camera
 from graphics.graphictext import draw_text
 from input import Cursor
+from interpolation import InterpolationBuffer, INTERPOLATION_SNAPSHOTS, GAP_SMOOTHING
+from interpolation import MIN_INTERPOLATION_DELAY, MAX_INTERPOLATION_DELAY
 from functions.game_math import point_distance
 
 from mp.client import ServerResponseError
+from mp.snapshot import unpack_delta, is_compact
 
 import logging
 
@@ -133,21 +136,28 @@ class TargetHandler(object):
         self.hero.attacking = False
 
     def update_target(self, dt=None):
+        """ Queue a get_target request, the target is refreshed when the frame's batch is flushed """
         if self.target:
-            try:
-                r = self.hero.game.client.send('get_target', [self.target['id']])
-                name, stats = r['response']['name'], r['response']['stats']
-                self.target = {'id': self.target['id'], 'name': name, 'stats': stats}
-            except ServerResponseError:
-                self.drop_target()
-            # Change reticle to red or grey depending on attacking or not
-            if self.hero.attacking:
-                self.reticle.image = self.reticle.images['red']
-            else:
-                self.reticle.image = self.reticle.images['grey']
+            self.hero.game.client.queue('get_target', [self.target['id']], callback=self.target_updated)
         else:
             self.reticle.image = self.reticle.images['none']
 
+    def target_updated(self, r):
+        """ Refresh target from get_target payload, drop target if it no longer exists on the server """
+        if not self.target:
+            return
+        if r['status'] == 0:
+            name, stats = r['response']['name'], r['response']['stats']
+            self.target = {'id': self.target['id'], 'name': name, 'stats': stats}
+        else:
+            self.drop_target()
+            return
+        # Change reticle to red or grey depending on attacking or not
+        if self.hero.attacking:
+            self.reticle.image = self.reticle.images['red']
+        else:
+            self.reticle.image = self.reticle.images['grey']
+
     @property
     def level(self):
         if self.target:
@@ -301,6 +311,11 @@ class Hero(object):
         self.moving = False
         self.target_coords = None
 
+        # Moves are made at once and sent to the server afterwards, each update_coords carries a sequence number the
+        # server echoes back with the coords it holds for us.  [(<seq>, [x, y]), ... ] not yet acknowledged
+        self.move_seq = 0
+        self.pending_moves = []
+
         # Target data like: {'remotesprite': <object>, 'name': <gameobject.name>, 'stats': <stats dict>}
         self.tgh = TargetHandler(self)
 
@@ -356,6 +371,29 @@ class Hero(object):
     def update(self, dt):
         pass
 
+    def predict_move(self, coords):
+        """ Record a move already made locally, returns the update_coords args reporting it to the server """
+        self.move_seq += 1
+        self.pending_moves.append((self.move_seq, list(coords)))
+        return {'coords': list(coords), 'seq': self.move_seq}
+
+    def reconcile(self, seq, coords):
+        """
+        Check a predicted move against where the server put us, if they disagree the server wins: moves still in
+        flight were made from the wrong place and are dropped
+        :param seq: seq of the update_coords being acknowledged
+        :param coords: coords the server holds for us after it
+        """
+        predicted = None
+        while self.pending_moves and self.pending_moves[0][0] <= seq:
+            predicted = self.pending_moves.pop(0)[1]
+        if predicted is None or list(coords) == predicted:
+            return
+        self.pending_moves = []
+        self.moving = False
+        self.target_coords = None
+        self.coords = coords
+
     def move_lifeform(self, coords):
         """
         moves lifeform on grid while checking for collision
@@ -416,6 +454,19 @@ class RemoteSpriteController(object):
         self.id = None
         self.group = None
 
+        # seq of the last room snapshot applied, sent back to the server as our ack
+        self.seq = None
+        # Sprite paths by the ids compact snapshots refer to them by, like {<sprite id>: <sprite path>, ... }
+        self.sprite_paths = {}
+
+        # Milliseconds of game time, advanced by update(), remote sprites are drawn at clock - delay
+        self.clock = 0.
+        # When the newest and the one before it snapshot arrived
+        self.snapshot_time = None
+        self.previous_snapshot_time = None
+        # Running mean milliseconds between snapshots
+        self.snapshot_gap = None
+
     def initialize(self):
         self.id = self.game.hero.id
         self.group = self.game.group
@@ -428,6 +479,40 @@ class RemoteSpriteController(object):
     def remove_remotesprite(self, id):
         del self._remotesprites[id]
 
+    def _spawn(self, id, sprite, coords):
+        """ Create a remotesprite and add it to the sprite group """
+        remote_sprite = self.add_remotesprite(id=id, sprite=sprite, coords=coords)
+        remote_sprite.buffer.push(self.snapshot_time, coords)
+        self.group.add(remote_sprite)
+
+    def _move(self, remotesprite, coords):
+        """ Buffer a new position from the newest snapshot, the sprite is moved there by update() """
+        remotesprite.buffer.hold(self.previous_snapshot_time)
+        remotesprite.buffer.push(self.snapshot_time, coords)
+
+    def _received(self):
+        """ Note the arrival of a snapshot """
+        if self.snapshot_time is not None:
+            gap = self.clock - self.snapshot_time
+            if self.snapshot_gap is None:
+                self.snapshot_gap = gap
+            else:
+                self.snapshot_gap += (gap - self.snapshot_gap) * GAP_SMOOTHING
+        self.previous_snapshot_time = self.snapshot_time
+        self.snapshot_time = self.clock
+
+    @property
+    def delay(self):
+        """ Milliseconds remote sprites are drawn behind the newest snapshot """
+        if self.snapshot_gap is None:
+            return MIN_INTERPOLATION_DELAY
+        return min(max(self.snapshot_gap * INTERPOLATION_SNAPSHOTS, MIN_INTERPOLATION_DELAY), MAX_INTERPOLATION_DELAY)
+
+    def _despawn(self, id):
+        """ Remove a remotesprite from the sprite group and forget it """
+        self.group.remove(self.remotesprites[id])
+        self.remove_remotesprite(id)
+
     @property
     def visible(self):
         """ Return all dict {<id>: sprite, ... } of remotesprites which are not stealthed / invisible """
@@ -437,17 +522,34 @@ class RemoteSpriteController(object):
     def remotesprites(self):
         return self._remotesprites
 
+    def update_coords_arrays(self, ids, sprites, coords):
+        """
+        Same as update_coords for a room given as arrays, as found in a full compact snapshot (see mp/snapshot.py)
+        :param ids: array of ids
+        :param sprites: array of sprite ids, same length as ids
+        :param coords: array of x, y pairs, twice the length of ids
+        """
+        remotesprites = self.remotesprites
+        present = set(ids)
+        for i, id in enumerate(ids):
+            if id in remotesprites:
+                self._move(remotesprites[id], coords[2 * i:2 * i + 2])
+            elif id != self.id:
+                self._spawn(id=id, sprite=self.sprite_paths[sprites[i]], coords=coords[2 * i:2 * i + 2])
+        for id in [id for id in remotesprites if id not in present]:
+            self._despawn(id)
+
     def update_coords(self, coords_dict):
         """ Takes a dictionary of coords like {<id>: (<sprite>, <coords>), <id>: <coords>, ... } """
+        self._received()
         for id, spritecoords in coords_dict.items():
             # If this remote sprite is rendered already
             if id in self.remotesprites.keys():
-                self.remotesprites[id].coords = spritecoords[1]
+                self._move(self.remotesprites[id], spritecoords[1])
             # If this sprite is not yet known to client, create it
             else:
                 if id != self.id:
-                    remote_sprite = self.add_remotesprite(id=id, sprite=spritecoords[0], coords=spritecoords[1])
-                    self.group.add(remote_sprite)
+                    self._spawn(id=id, sprite=spritecoords[0], coords=spritecoords[1])
         # If we have a remote sprite locally that no longer exists on remote, remove it
         for id in self.remotesprites.keys():
             if id not in coords_dict.keys():
@@ -455,13 +557,90 @@ class RemoteSpriteController(object):
                 self.group.remove(remote_sprite)
                 self.remove_remotesprite(id)
 
-    def update(self):
-        pass
+    def apply_snapshot(self, delta):
+        """
+        Takes a delta encoded room snapshot like:
+        {'seq': 5, 'baseline': 4, 'added': {<id>: (<sprite>, <coords>), ... }, 'moved': {<id>: <coords>, ... },
+         'removed': [<id>, ... ]}
+        baseline None means a full snapshot, compact snapshots (see mp/snapshot.py) are handed to apply_compact
+        """
+        if is_compact(delta):
+            return self.apply_compact(delta)
+        self._received()
+        if delta['baseline'] is None:
+            # Full snapshot, anything not in it no longer exists on remote
+            for id in list(self.remotesprites):
+                if id not in delta['added']:
+                    self._despawn(id)
+        elif delta['baseline'] != self.seq:
+            # Built on a snapshot we never applied, ask for a full snapshot next poll
+            self.seq = None
+            return
+        for id, spritecoords in delta['added'].items():
+            if id == self.id:
+                continue
+            if id in self.remotesprites:
+                # Sprite changed
+                self._despawn(id)
+            self._spawn(id=id, sprite=spritecoords[0], coords=spritecoords[1])
+        for id, coords in delta['moved'].items():
+            if id in self.remotesprites:
+                self._move(self.remotesprites[id], coords)
+        for id in delta['removed']:
+            if id in self.remotesprites:
+                self._despawn(id)
+        self.seq = delta['seq']
+
+    def apply_compact(self, delta):
+        """ apply_snapshot for a compact snapshot, reads the arrays in place rather than building dictionaries """
+        # Keep sprite paths even if the rest of the delta is of no use to us, they are only sent once
+        self.sprite_paths.update(delta['sprites'])
+        self._received()
+        if delta['baseline'] is not None and delta['baseline'] != self.seq:
+            # Built on a snapshot we never applied, ask for a full snapshot next poll
+            self.seq = None
+            return
+        unpack_delta(delta)
+        added, moved = delta['added'], delta['moved']
+        if delta['baseline'] is None:
+            self.update_coords_arrays(added['ids'], added['sprites'], added['coords'])
+        else:
+            ids, sprites, coords = added['ids'], added['sprites'], added['coords']
+            for i, id in enumerate(ids):
+                if id == self.id:
+                    continue
+                if id in self.remotesprites:
+                    # Sprite changed
+                    self._despawn(id)
+                self._spawn(id=id, sprite=self.sprite_paths[sprites[i]], coords=coords[2 * i:2 * i + 2])
+            remotesprites = self.remotesprites
+            coords = moved['coords']
+            for i, id in enumerate(moved['ids']):
+                if id in remotesprites:
+                    self._move(remotesprites[id], coords[2 * i:2 * i + 2])
+            for id in delta['removed']:
+                if id in remotesprites:
+                    self._despawn(id)
+        self.seq = delta['seq']
+
+    def update(self, dt):
+        """ Move every remote sprite to where its buffered positions put it delay milliseconds ago """
+        self.clock += dt
+        time = self.clock - self.delay
+        newest = self.snapshot_time
+        for remotesprite in self.remotesprites.values():
+            coords = remotesprite.buffer.sample(time, newest)
+            if coords is not None:
+                remotesprite.coords = [int(round(coords[0])), int(round(coords[1]))]
 
     def clear_sprites(self):
         """ Delete all remotesprite objects """
         self._remotesprites = {}
         self.group = pygame.sprite.Group()
+        self.seq = None
+        self.sprite_paths = {}
+        self.snapshot_time = None
+        self.previous_snapshot_time = None
 
 
 class RemoteSprite(pygame.sprite.Sprite):
@@ -486,6 +665,8 @@ class RemoteSprite(pygame.sprite.Sprite):
         self.rect = self.image.get_rect()
         self._coords = coords
         self.group = group
+        # Positions from recent snapshots, see RemoteSpriteController.update
+        self.buffer = InterpolationBuffer()
 
         # Inventory Classes
         if self.group is not None:
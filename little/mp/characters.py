@@ -0,0 +1,160 @@
+"""
+Character store: player characters kept in one SQLite database instead of a pickle file each
+
+Every character is one row holding its LifeForm's attributes, pickled the way checkpoint.py pickles gameobjects and
+zlib compressed, plus a version token that changes on every save.  Characters that logged out recently stay in memory
+as live LifeForms, logging back in takes the cached LifeForm when its version still matches the row, so a login is a
+single indexed lookup rather than a file read and unpickle.
+
+Saves are write-behind: the record is pickled in the tick, which is quick, and a writer thread commits queued records
+in batches.  The version check covers room shards, which are separate processes sharing the database.  Characters not
+in the database yet are loaded from their legacy mp/users/<name>.sav file, and stored on their first save.
+"""
+import binascii
+import os
+import sqlite3
+import threading
+import traceback
+import zlib
+from collections import OrderedDict
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from checkpoint import dump_gameobject, load_gameobject, class_path, load_class, restore
+
+
+# Logged out characters kept in memory
+CACHE_SIZE = 256
+# Seconds a connection waits on another process holding the database lock
+DB_TIMEOUT = 5
+COMPRESS_LEVEL = 1
+
+SCHEMA = ('CREATE TABLE IF NOT EXISTS characters ('
+          'name TEXT PRIMARY KEY, version TEXT NOT NULL, class TEXT NOT NULL, id INTEGER NOT NULL, data BLOB NOT NULL)')
+
+
+class CharacterStore(object):
+    """ Loads and saves player LifeForms, see the module docstring """
+    def __init__(self, path, cache_size=CACHE_SIZE):
+        self.path = path
+        self.cache_size = cache_size
+        # Logged out characters, least recently used first, like {<name>: (<version>, <LifeForm>), ... }
+        self.cache = OrderedDict()
+        # Saved but not yet committed, like {<name>: <version>, ... }.  Guarded by lock, the writer thread clears them
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.queue = Queue()
+        self.writer = None
+        # Connection used by the tick thread, the writer thread opens its own
+        self._db = None
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by another process (a room shard) in the meantime
+                if not os.path.isdir(directory):
+                    raise
+        db = sqlite3.connect(self.path, timeout=DB_TIMEOUT)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute(SCHEMA)
+        db.commit()
+        return db
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = self._connect()
+        return self._db
+
+    def load(self, name, goc):
+        """
+        The character's LifeForm, detached: it still has to be added to goc
+        :return: LifeForm, None if the character has never been saved here
+        """
+        with self.lock:
+            pending = self.pending.get(name)
+        cached = self.cache.pop(name, None)
+        if cached is not None:
+            version, lifeform = cached
+            if version == pending:
+                # Our own save is still on its way to the database, the cached LifeForm is newer than the row
+                self.hits += 1
+                return lifeform
+            row = self.db.execute('SELECT version FROM characters WHERE name = ?', (name,)).fetchone()
+            if row is not None and row[0] == version:
+                self.hits += 1
+                return lifeform
+        self.misses += 1
+        row = self.db.execute('SELECT class, id, data FROM characters WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        classpath, id, data = row
+        cls = load_class(str(classpath))
+        lifeform = cls.__new__(cls)
+        restore(lifeform, load_gameobject(zlib.decompress(bytes(data)), {id: lifeform}, goc))
+        return lifeform
+
+    def save(self, lifeform, goc, logout=False):
+        """
+        Queue the character to be written
+        :param logout: the LifeForm is leaving the world, keep it in the cache for the next login
+        """
+        name = lifeform.name
+        version = binascii.hexlify(os.urandom(8)).decode('ascii')
+        record = (name, version, class_path(lifeform), lifeform.id,
+                  zlib.compress(dump_gameobject(lifeform, goc), COMPRESS_LEVEL))
+        with self.lock:
+            self.pending[name] = version
+        self.queue.put(record)
+        if self.writer is None:
+            self.writer = threading.Thread(target=self._write, name='CharacterStore')
+            self.writer.daemon = True
+            self.writer.start()
+        if logout:
+            lifeform.target = None
+            self.cache[name] = (version, lifeform)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def _write(self):
+        """ Writer thread: commit queued records, everything queued so far in one transaction """
+        db = self._connect()
+        while True:
+            records = [self.queue.get()]
+            while not self.queue.empty():
+                records.append(self.queue.get())
+            stop = None in records
+            records = [record for record in records if record is not None]
+            try:
+                db.executemany('INSERT OR REPLACE INTO characters (name, version, class, id, data) '
+                               'VALUES (?, ?, ?, ?, ?)',
+                               [(name, version, classpath, id, sqlite3.Binary(data))
+                                for name, version, classpath, id, data in records])
+                db.commit()
+            except sqlite3.Error:
+                traceback.print_exc()
+            with self.lock:
+                for record in records:
+                    if self.pending.get(record[0]) == record[1]:
+                        del self.pending[record[0]]
+            if stop:
+                db.close()
+                return
+
+    def close(self):
+        """ Commit everything still queued and stop the writer thread """
+        if self.writer is not None:
+            self.queue.put(None)
+            self.writer.join()
+            self.writer = None
+        if self._db is not None:
+            self._db.close()
+            self._db = None
@@ -1,10 +1,9 @@
-import socket, pickle
+import socket, select
 import atexit
-import sys
+from collections import deque
 
-
-class PacketSizeMismatch(Exception):
-    pass
+from mp.protocol import FrameReader, send_message, ProtocolError, PacketSizeMismatch, PORT, MSG_REQUEST, \
+    MSG_RESPONSE, MSG_PUSH
 
 
 class ServerResponseError(Exception):
@@ -15,16 +14,49 @@ class GameClient(object):
     """
     Request is issued in the following format:
     {'username': <username>, 'charactername': <charactername>, 'password': <password>,
-    'request': <cli_command>, 'args': []}
+    'request': <cli_command>, 'args': [], 'request_id': <int>, 'session': <bool>, 'compress': <bool>}
+    and once logged in, using the session token handed out by the server at login:
+    {'token': <token>, 'request': <cli_command>, 'args': [], 'request_id': <int>, 'session': <bool>,
+     'compress': <bool>}
+
+    With persistent=True (session mode) one connection is kept open for the life of the client and every request
+    is tagged with a request_id, which the server echoes back on the matching response.  With persistent=False the
+    client falls back to opening a fresh connection for every request.
     """
-    def __init__(self, ip='127.0.0.1', charactername='Zaxim', username='ken', password='mypw'):
+    def __init__(self, ip='127.0.0.1', charactername='Zaxim', username='ken', password='mypw', persistent=True,
+                 verbose=True, compress=True, port=PORT):
         self.id = None
+        # Print every request and response
+        self.verbose = verbose
+        # Let the server compress large responses and pushes, see mp/protocol.py
+        self.compress = compress
 
         self.ip = ip
+        # A different port reaches the server through a proxy, e.g. mp/netem.py
+        self.port = port
         self.charactername = charactername
         self.password = password
         self.username = username
         self.server = None
+        # disconnect() is registered to run at exit on the first connect
+        self.exit_registered = False
+        # Session token handed out by the server at login, replaces credentials on every later request
+        self.token = None
+        # Reads framed responses off self.server
+        self.reader = None
+
+        # Session mode keeps self.server open between requests
+        self.persistent = persistent
+        self.request_id = 0
+        # Responses received while waiting on a different request_id, like {<request_id>: <payload>, ... }
+        self.responses = {}
+
+        # Room state pushed by the server while subscribed, like deque([{'snapshot': ..., 'messages': ...}, ... ])
+        self.pushes = deque()
+        self.subscribed = False
+
+        # Requests accumulated by queue() until flush(), like [({'request': 'attack', 'args': 4}, <callback>), ... ]
+        self.batch = []
 
         # Incoming broadcast from server
         self.incoming_broadcast = None
@@ -37,32 +69,71 @@ class GameClient(object):
         {'id': id, 'coords': gameobject.coords, 'sprite': gameobject.graphic}, 'current_room': gameobject.current_room}
         :return:
         """
+        self.token = None
         response = self.send('login')
         try:
             self.id = response['response']['id']
+            self.token = response['response']['token']
         except KeyError:
             pass
-        print('Response from server:\n{0}'.format(response))
+        if self.verbose: print('Response from server:\n{0}'.format(response))
         return response
 
     def logout(self):
         """ Logout character from server """
         response = self.send('logout')
+        self.token = None
+        return response
+
+    def subscribe(self, interval=None, compact=False):
+        """
+        Ask the server to push room state to us rather than us polling get_roomdata, requires session mode
+        :param interval: milliseconds between pushes, None for the server default
+        :param compact: have snapshots pushed in the array encoding from mp/snapshot.py
+        """
+        response = self.send('subscribe', {'interval': interval, 'compact': compact})
+        self.subscribed = True
+        return response
+
+    def unsubscribe(self):
+        response = self.send('unsubscribe')
+        self.subscribed = False
+        self.pushes.clear()
         return response
 
+    def receive_pushes(self):
+        """ Collect every push the server has sent so far without blocking, returns list oldest first """
+        while self.server and select.select([self.server], [], [], 0)[0]:
+            try:
+                self.receive_message()
+            except (socket.error, ProtocolError):
+                self.disconnect()
+                raise
+        pushes = list(self.pushes)
+        self.pushes.clear()
+        return pushes
+
     def _request(self, request, args=None):
         """
-        Form request dictionary to be pickled and sent to server.
+        Form request dictionary to be encoded and sent to server.
         Convert request, and args to:
         {'username': 'someuser', 'password': 'mypw', 'charactername': 'Zorax',
-         'id': id, 'request': request, 'args': args}
+         'id': id, 'request': request, 'args': args, 'request_id': 12, 'session': True}
 
         :param request: string like 'login' or 'attack'
         :param args: list of arguments like [itemid, targetid]
         :return: dictionary like example above
         """
-        request = {'username': self.username, 'password': self.password, 'charactername': self.charactername,
-                   'id': self.id, 'request': request, 'args': args}
+        self.request_id += 1
+        if self.token is not None:
+            request = {'token': self.token, 'request': request, 'args': args, 'request_id': self.request_id,
+                       'session': self.persistent}
+        else:
+            request = {'username': self.username, 'password': self.password, 'charactername': self.charactername,
+                       'id': self.id, 'request': request, 'args': args, 'request_id': self.request_id,
+                       'session': self.persistent}
+        if self.compress:
+            request['compress'] = True
         return request
 
     def send(self, request, args=None):
@@ -75,81 +146,106 @@ class GameClient(object):
         :param request: dictionary like example above
         :return: payload from server
         """
-        # TODO: This change will break things
         request = self._request(request, args)
-        print('Request to be sent: {0}'.format(request))
-        # Bounce the server
-        self.disconnect()
-        print('****** Starting Request   *******')
-        self.connect(ip=self.ip)
-        print('Connected')
-        print('Sending request to server: {0}'.format(str(request)))
-        self.server.send(pickle.dumps(request))
-
-        # Receive buffer size of response from server
+        if self.verbose: print('Request to be sent: {0}'.format(request))
+        if self.verbose: print('****** Starting Request   *******')
+        if not self.persistent:
+            # Bounce the server
+            self.disconnect()
+        if not self.server:
+            self.connect(ip=self.ip)
+            if self.verbose: print('Connected')
+        if self.verbose: print('Sending request to server: {0}'.format(str(request)))
         try:
-            buffer_size = self.receive_packet(128)
-            if buffer_size is not None:
-                print('--Received buffer size from server: {0}'.format(buffer_size))
-            else:
-                raise RuntimeError('Did not receive buffer size from server!')
-        except socket.error:
-            print(socket.error.message)
+            send_message(self.server, MSG_REQUEST, request)
+            payload = self.receive_response(request['request_id'])
+        except socket.error as e:
+            print(e)
             self.disconnect()
             return {'status': -1, 'response': {'message': 'Socket error'}}
-
-        # Send confirmation to server that we are ready to receive payload
-        if isinstance(buffer_size, int):
-            self.server.send(pickle.dumps(buffer_size))
-        else:
-            self.server.send(pickle.dumps(-1))
+        except ProtocolError:
             self.disconnect()
             raise
-
-        # Receive data payload from server
-        print('--Listening for payload...')
-        payload = self.receive_packet(buffer_size, raise_error=True)
-        if not payload:
-            print('--Payload not found, retrying')
-            raise RuntimeError('Did not receive payload from server')
-        else:
+        if not self.persistent:
             self.disconnect()
-            print('****** Request Successful *******')
-            if {'status', 'response'} == set(payload.keys()):
-                if payload['status'] != 0:
-                    raise ServerResponseError(payload['response']['message'])
-                else:
-                    return payload
+        if self.verbose: print('****** Request Successful *******')
+
+        if {'status', 'response'} == set(payload.keys()):
+            if payload['status'] != 0:
+                raise ServerResponseError(payload['response']['message'])
             else:
-                return {'status': -1, 'response': {'message': 'response from server malformed'}}
+                return payload
+        else:
+            return {'status': -1, 'response': {'message': 'response from server malformed'}}
 
-    def receive_packet(self, buffer_size, raise_error=False):
-        print('Expecting packet size: {0}'.format(buffer_size))
-        packet = self.server.recv(buffer_size)
+    def queue(self, request, args=None, callback=None):
+        """
+        Hold a request back to be sent with everything else queued this frame as a single 'batch' request
+        :param request: string like 'get_roomdata' or 'attack'
+        :param args: list of arguments like [itemid, targetid]
+        :param callback: called with the request's own payload {'status': 0, 'response': { ... } } once flushed
+        """
+        self.batch.append(({'request': request, 'args': args}, callback))
 
-        actual_size = sys.getsizeof(packet)
-        print('Actual packet size: {0}'.format(actual_size))
-        if raise_error:
-            if actual_size != buffer_size:
-                self.disconnect()
-                print('Packet size mismatch has occured: Expected {0}, Got: {1}'.format(buffer_size, actual_size))
-                raise PacketSizeMismatch('Expected size: {0}, Actual size: {1}'.format(buffer_size, actual_size))
-        if packet:
-            data = pickle.loads(packet)
-            print('received the following data: {0}'.format(data))
-            return data
-        else:
-            print('Packet empty, returning None')
-            return None
+    def flush(self):
+        """
+        Send every queued request in one message and hand each payload to its callback.  A failed sub-request does
+        not raise, its callback gets a payload with a non-zero status
+        :return: list of payloads in the order the requests were queued
+        """
+        if not self.batch:
+            return []
+        batch, self.batch = self.batch, []
+        try:
+            r = self.send('batch', [sub_request for sub_request, callback in batch])
+        except ServerResponseError as e:
+            r = {'status': -1, 'response': {'message': str(e)}}
+        payloads = r['response']
+        if r['status'] != 0:
+            # Whole batch failed, e.g. socket error or rate limited, give every sub-request the same failure
+            payloads = [r] * len(batch)
+        for (sub_request, callback), payload in zip(batch, payloads):
+            if callback:
+                callback(payload)
+        return payloads
+
+    def receive_response(self, request_id):
+        """
+        Read responses from the server until the one tagged with request_id arrives, any response for a different
+        request is held in self.responses until it is asked for
+        :param request_id: request_id of the request we are waiting on
+        :return: payload with 'request_id' removed, like {'status': 0, 'response': { ... } }
+        """
+        while request_id not in self.responses:
+            msg_type, payload = self.receive_message()
+            if msg_type == MSG_RESPONSE:
+                self.responses[payload.pop('request_id', request_id)] = payload
+        return self.responses.pop(request_id)
+
+    def receive_message(self):
+        """ Receive a single framed message from the server, pushes are put aside in self.pushes """
+        msg_type, payload = self.reader.read_message()
+        if msg_type not in (MSG_RESPONSE, MSG_PUSH) or not isinstance(payload, dict):
+            raise ProtocolError('Unexpected message from server of type {0}'.format(msg_type))
+        if msg_type == MSG_PUSH:
+            self.pushes.append(payload)
+        return msg_type, payload
 
     def connect(self, ip):
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.connect((ip, 4000))
+        server.connect((ip, self.port))
+        server.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.server = server
-        atexit.register(self.disconnect)
+        self.reader = FrameReader(server)
+        if not self.exit_registered:
+            atexit.register(self.disconnect)
+            self.exit_registered = True
 
     def disconnect(self):
         if self.server:
-            print('--Socket closed')
+            if self.verbose: print('--Socket closed')
             self.server.close()
             self.server = None
+            self.reader = None
+            # Subscriptions do not survive the connection
+            self.subscribed = False
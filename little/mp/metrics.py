@@ -0,0 +1,161 @@
+"""
+Server instrumentation: call counts, response sizes and latency histograms per request type, and duration
+histograms per tick phase.
+
+Recording is a method call on a Metrics instance, so code paths that are not being measured pay nothing but an
+'if metrics.enabled' check.
+"""
+from __future__ import division
+
+import json
+import os
+from bisect import bisect_left
+from timeit import default_timer
+
+
+# Upper bound of each latency bucket in milliseconds, anything slower lands in a final overflow bucket
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000]
+
+
+class Histogram(object):
+    """ Counts of samples falling in each of a fixed set of buckets, plus count / total / max """
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def record(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """ Upper bound of the bucket holding the given percentile, max if it falls in the overflow bucket """
+        if not self.count:
+            return 0.
+        rank = self.count * percent / 100.
+        seen = 0
+        for bound, count in zip(self.bounds, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {'count': self.count, 'mean': self.total / self.count if self.count else 0., 'max': self.max,
+                'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99),
+                'buckets': dict(('<={0}'.format(bound), count)
+                                for bound, count in zip(self.bounds, self.buckets) if count),
+                'overflow': self.buckets[-1]}
+
+
+class RequestStats(object):
+    """ Everything recorded for one request type """
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.latency = Histogram()
+
+    def as_dict(self):
+        return {'count': self.count, 'errors': self.errors, 'bytes': self.bytes,
+                'mean_bytes': self.bytes / self.count if self.count else 0., 'latency': self.latency.as_dict()}
+
+
+class CompressionStats(object):
+    """ Bytes in and out of response / push compression and the time it took """
+    def __init__(self):
+        self.raw = 0
+        self.compressed = 0
+        self.latency = Histogram()
+
+    def as_dict(self):
+        return {'count': self.latency.count, 'raw_bytes': self.raw, 'compressed_bytes': self.compressed,
+                'ratio': self.compressed / self.raw if self.raw else 0., 'latency': self.latency.as_dict()}
+
+
+class Metrics(object):
+    """
+    Collects per-request-type and per-tick-phase statistics for GameServer
+
+    dump_file is rewritten with report() every dump_interval milliseconds of ticks, None disables the dump
+    """
+    def __init__(self, enabled=False, dump_file=None, dump_interval=10000, clock=default_timer):
+        self.enabled = enabled
+        self.dump_file = dump_file
+        self.dump_interval = dump_interval
+        self.clock = clock
+        self.dump_timer = dump_interval
+        self.reset()
+
+    def reset(self):
+        # {<request type>: <RequestStats>, ... }
+        self.requests = {}
+        # {<phase name>: <Histogram>, ... }
+        self.phases = {}
+        self.compression = CompressionStats()
+        self.started = self.clock()
+
+    def record_request(self, name, duration, size=None, status=0):
+        """
+        :param name: request type, e.g. 'get_roomdata'
+        :param duration: milliseconds spent handling it
+        :param size: bytes of the encoded response, None if not sent on its own (batched sub-requests)
+        :param status: status of the response, non zero counts as an error
+        """
+        stats = self.requests.get(name)
+        if stats is None:
+            stats = self.requests[name] = RequestStats()
+        stats.count += 1
+        stats.latency.record(duration)
+        if size:
+            stats.bytes += size
+        if status:
+            stats.errors += 1
+
+    def record_phase(self, name, duration):
+        """ :param duration: milliseconds the tick phase took """
+        histogram = self.phases.get(name)
+        if histogram is None:
+            histogram = self.phases[name] = Histogram()
+        histogram.record(duration)
+
+    def record_compression(self, raw, compressed, duration):
+        """
+        :param raw: bytes of the message body before compression
+        :param compressed: bytes after
+        :param duration: milliseconds compressing took
+        """
+        self.compression.raw += raw
+        self.compression.compressed += compressed
+        self.compression.latency.record(duration)
+
+    def report(self):
+        """ All statistics as plain data, ready to be encoded into a response or written as JSON """
+        return {'enabled': self.enabled, 'seconds': self.clock() - self.started,
+                'requests': dict((name, stats.as_dict()) for name, stats in self.requests.items()),
+                'phases': dict((name, histogram.as_dict()) for name, histogram in self.phases.items()),
+                'compression': self.compression.as_dict()}
+
+    def update(self, dt):
+        """ Count down to the next dump, called once per tick """
+        if not self.enabled or self.dump_file is None or dt is None:
+            return
+        self.dump_timer -= dt
+        if self.dump_timer <= 0:
+            self.dump_timer = self.dump_interval
+            self.dump()
+
+    def dump(self, path=None):
+        """ Write report() to path (default dump_file) as JSON, replacing the previous dump in one rename """
+        path = path or self.dump_file
+        temp = '{0}.tmp'.format(path)
+        with open(temp, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(temp, path)
@@ -0,0 +1,395 @@
+"""
+Network condition emulator, a local TCP proxy between GameClients and GameServer
+
+    python -m mp.netem --profile wan                       # listens on 4001, forwards to 127.0.0.1:4000
+    python little.py --port 4001                           # real client through the proxy
+    python loadtest.py --netem mobile                      # bots through a proxy started by the load test
+
+Every frame (see mp/protocol.py) crossing the proxy is held back according to the NetworkConditions of its direction:
+    latency      one way milliseconds, plus a random jitter with a standard deviation of jitter milliseconds
+    bandwidth    bytes per second, frames queue behind each other on the link
+    loss         chance a TCP segment is lost, the frame and everything after it waits for the retransmission
+    stall_rate   link freezes per second, each lasting stall_time milliseconds (wifi scans, cell handovers)
+    reorder      chance a frame is delivered after the one that follows it
+TCP delivers in order, so jitter and loss show up as head of line blocking rather than reordering.  reorder is there
+to test what a client makes of pushes and responses arriving out of order, compressed frames are never reordered as
+they must be decompressed in the order they were sent.
+"""
+from __future__ import division
+
+import argparse
+import errno
+import math
+import random
+import select
+import socket
+import threading
+from collections import deque
+from timeit import default_timer
+
+from mp.protocol import HEADER, HEADER_SIZE, COMPRESSED, PORT
+
+
+# Port the proxy listens on by default
+NETEM_PORT = 4001
+# Bytes per TCP segment, loss is decided per segment
+SEGMENT_SIZE = 1460
+# Milliseconds, shortest wait for a lost segment to be retransmitted
+MIN_RETRANSMIT = 200
+# Milliseconds a frame picked for reordering waits for a frame to overtake it before it is sent anyway
+REORDER_HOLD = 50
+# Longest the proxy loop sleeps in select, seconds
+MAX_WAIT = 0.01
+RECV_SIZE = 65536
+
+
+class NetworkConditions(object):
+    """ How one direction of a connection behaves, see the module docstring """
+    def __init__(self, latency=0, jitter=0, bandwidth=None, loss=0., stall_rate=0., stall_time=0, reorder=0.):
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.stall_rate = stall_rate
+        self.stall_time = stall_time
+        self.reorder = reorder
+
+    def copy(self, **changes):
+        conditions = NetworkConditions(**self.__dict__)
+        conditions.__dict__.update((key, value) for key, value in changes.items() if value is not None)
+        return conditions
+
+    def __repr__(self):
+        return 'NetworkConditions({0})'.format(', '.join('{0}={1!r}'.format(key, value)
+                                                         for key, value in sorted(self.__dict__.items())))
+
+
+# Named conditions, like {<name>: (<client to server>, <server to client>)}
+PROFILES = {
+    'lan': (NetworkConditions(latency=1), NetworkConditions(latency=1)),
+    'dsl': (NetworkConditions(latency=25, jitter=3, bandwidth=128 * 1024, loss=0.001),
+            NetworkConditions(latency=25, jitter=3, bandwidth=1024 * 1024, loss=0.001)),
+    'wan': (NetworkConditions(latency=60, jitter=10, bandwidth=256 * 1024, loss=0.005),
+            NetworkConditions(latency=60, jitter=10, bandwidth=2 * 1024 * 1024, loss=0.005)),
+    'mobile': (NetworkConditions(latency=90, jitter=35, bandwidth=64 * 1024, loss=0.02, stall_rate=0.05,
+                                 stall_time=500),
+               NetworkConditions(latency=90, jitter=35, bandwidth=512 * 1024, loss=0.02, stall_rate=0.05,
+                                 stall_time=500)),
+    'bad': (NetworkConditions(latency=150, jitter=80, bandwidth=32 * 1024, loss=0.05, stall_rate=0.1,
+                              stall_time=1000),
+            NetworkConditions(latency=150, jitter=80, bandwidth=128 * 1024, loss=0.05, stall_rate=0.1,
+                              stall_time=1000)),
+}
+
+
+class NetemStats(object):
+    """ Counters for one proxy, both directions together """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.connections = 0
+        self.frames = 0
+        self.bytes = 0
+        self.retransmits = 0
+        self.stalls = 0
+        self.reordered = 0
+        # Milliseconds frames were held in the proxy
+        self.delay = 0.
+
+    def report(self):
+        return {'connections': self.connections, 'frames': self.frames, 'bytes': self.bytes,
+                'retransmits': self.retransmits, 'stalls': self.stalls, 'reordered': self.reordered,
+                'mean_delay': self.delay / self.frames if self.frames else 0.}
+
+
+class Direction(object):
+    """ Frames travelling one way through the proxy, held until their delivery time """
+    def __init__(self, conditions, stats, rng):
+        self.conditions = conditions
+        self.stats = stats
+        self.rng = rng
+        # Bytes received that don't make up a whole frame yet
+        self.incoming = bytearray()
+        # Frames waiting for their delivery time, like deque([(<seconds>, <arrived>, <frame>), ... ])
+        self.scheduled = deque()
+        # Frame held back to be overtaken, (<seconds>, <arrived>, <frame>)
+        self.held = None
+        # Bytes due and not yet accepted by the socket
+        self.outgoing = bytearray()
+        # When the emulated link has finished sending everything scheduled so far
+        self.link_free = 0.
+        self.last_delivery = 0.
+        self.stalled_until = 0.
+        self.last_poll = None
+
+    def feed(self, data, now):
+        """ Bytes read from the sending side """
+        self.incoming += data
+        offset = 0
+        while len(self.incoming) - offset >= HEADER_SIZE:
+            length, msg_type = HEADER.unpack_from(self.incoming, offset)
+            end = offset + HEADER_SIZE + length
+            if len(self.incoming) < end:
+                break
+            self.schedule(bytes(self.incoming[offset:end]), msg_type, now)
+            offset = end
+        del self.incoming[:offset]
+
+    def schedule(self, frame, msg_type, now):
+        conditions = self.conditions
+        stats = self.stats
+        stats.frames += 1
+        stats.bytes += len(frame)
+        start = max(now, self.link_free)
+        if conditions.bandwidth:
+            start += len(frame) / conditions.bandwidth
+        self.link_free = start
+        delivery = start + max(0., self.rng.gauss(conditions.latency, conditions.jitter)) / 1000.
+        if conditions.loss:
+            segments = int(math.ceil(len(frame) / SEGMENT_SIZE))
+            if self.rng.random() < 1. - (1. - conditions.loss) ** segments:
+                stats.retransmits += 1
+                delivery += max(MIN_RETRANSMIT, 3 * conditions.latency) / 1000.
+        delivery = max(delivery, self.last_delivery, self.stalled_until)
+        self.last_delivery = delivery
+
+        if self.held is not None:
+            # Overtakes the frame being held
+            self.scheduled.append((delivery, now, frame))
+            self.scheduled.append((delivery, self.held[1], self.held[2]))
+            self.held = None
+            stats.reordered += 1
+        elif conditions.reorder and not msg_type & COMPRESSED and self.rng.random() < conditions.reorder:
+            self.held = (delivery, now, frame)
+        else:
+            self.scheduled.append((delivery, now, frame))
+
+    def poll(self, now):
+        """ Move frames whose time has come to self.outgoing """
+        conditions = self.conditions
+        if self.last_poll is not None and conditions.stall_rate and now >= self.stalled_until:
+            if self.rng.random() < 1. - math.exp(-conditions.stall_rate * (now - self.last_poll)):
+                self.stats.stalls += 1
+                self.stalled_until = now + conditions.stall_time / 1000.
+        self.last_poll = now
+        if now < self.stalled_until:
+            return
+        if self.held is not None and now >= self.held[0] + REORDER_HOLD / 1000.:
+            # Nothing came along to overtake it
+            self.scheduled.append(self.held)
+            self.held = None
+        scheduled = self.scheduled
+        while scheduled and scheduled[0][0] <= now:
+            delivery, arrived, frame = scheduled.popleft()
+            self.stats.delay += (now - arrived) * 1000.
+            self.outgoing += frame
+
+    def next_delivery(self):
+        """ Seconds of the next frame to deliver, None if there is nothing waiting """
+        times = [self.scheduled[0][0]] if self.scheduled else []
+        if self.held is not None:
+            times.append(self.held[0] + REORDER_HOLD / 1000.)
+        if not times:
+            return None
+        return max(min(times), self.stalled_until)
+
+    @property
+    def idle(self):
+        return not (self.scheduled or self.held or self.outgoing)
+
+
+class ProxyConnection(object):
+    """ One client connection and the proxy's own connection to the server """
+    def __init__(self, client, server, upstream, downstream):
+        self.client = client
+        self.server = server
+        # Frames from the client to the server, and from the server to the client
+        self.upstream = upstream
+        self.downstream = downstream
+        self.closing = False
+
+    def direction_from(self, sock):
+        """ (<Direction of frames read from sock>, <socket they are written to>) """
+        if sock is self.client:
+            return self.upstream, self.server
+        return self.downstream, self.client
+
+
+class NetemProxy(object):
+    """ Forwards connections on listen to target, see the module docstring """
+    def __init__(self, listen=('127.0.0.1', NETEM_PORT), target=('127.0.0.1', PORT), upstream=None, downstream=None,
+                 seed=None):
+        """
+        :param upstream: NetworkConditions from client to server
+        :param downstream: NetworkConditions from server to client, defaults to the same as upstream
+        """
+        self.listen = listen
+        self.target = target
+        self.upstream = upstream or NetworkConditions()
+        self.downstream = downstream or self.upstream
+        self.rng = random.Random(seed)
+        self.stats = NetemStats()
+        self.server = None
+        # Like {<socket>: <ProxyConnection>, ... }, both sockets of every connection
+        self.connections = {}
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """ Run the proxy in a background thread, returns once it is listening """
+        self.bind()
+        self.thread = threading.Thread(target=self.run, name='NetemProxy')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def bind(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(self.listen)
+        server.listen(16)
+        server.setblocking(0)
+        self.server = server
+
+    def run(self):
+        if self.server is None:
+            self.bind()
+        self.running = True
+        try:
+            while self.running:
+                self.step()
+        finally:
+            for sock in list(self.connections):
+                self.close(sock)
+            self.server.close()
+            self.server = None
+
+    def step(self):
+        """ One pass of the proxy loop: accept, read, deliver what is due and write """
+        now = default_timer()
+        wait = MAX_WAIT
+        writable = []
+        for sock, connection in self.connections.items():
+            direction, destination = connection.direction_from(sock)
+            direction.poll(now)
+            if direction.outgoing:
+                writable.append(destination)
+            next_delivery = direction.next_delivery()
+            if next_delivery is not None:
+                wait = min(wait, max(0., next_delivery - now))
+        # Connections being closed are not read from again, a socket that hung up stays readable
+        reading = [sock for sock, connection in self.connections.items() if not connection.closing]
+        readable, writable, exceptional = select.select([self.server] + reading, writable, [], wait)
+        now = default_timer()
+        for sock in readable:
+            if sock is self.server:
+                self.accept()
+            elif sock in self.connections:
+                self.receive(sock, now)
+        for sock in writable:
+            if sock in self.connections:
+                self.send(sock)
+        for sock, connection in list(self.connections.items()):
+            if connection.closing and connection.upstream.idle and connection.downstream.idle:
+                self.close(sock)
+
+    def accept(self):
+        client, address = self.server.accept()
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            server.connect(self.target)
+        except socket.error as e:
+            print('Netem proxy could not reach {0}: {1}'.format(self.target, e))
+            client.close()
+            return
+        for sock in (client, server):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.setblocking(0)
+        connection = ProxyConnection(client, server, Direction(self.upstream, self.stats, self.rng),
+                                     Direction(self.downstream, self.stats, self.rng))
+        self.connections[client] = self.connections[server] = connection
+        self.stats.connections += 1
+
+    def receive(self, sock, now):
+        connection = self.connections[sock]
+        try:
+            data = sock.recv(RECV_SIZE)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = b''
+        if not data:
+            # Either side hanging up ends the connection once what is in flight has been delivered
+            connection.closing = True
+            return
+        connection.direction_from(sock)[0].feed(data, now)
+
+    def send(self, sock):
+        connection = self.connections[sock]
+        # Frames written to sock come from the other side
+        direction = connection.downstream if sock is connection.client else connection.upstream
+        try:
+            sent = sock.send(direction.outgoing)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            connection.closing = True
+            direction.outgoing = bytearray()
+            direction.scheduled.clear()
+            direction.held = None
+            return
+        del direction.outgoing[:sent]
+
+    def close(self, sock):
+        connection = self.connections.pop(sock, None)
+        if connection is None:
+            return
+        for other in (connection.client, connection.server):
+            self.connections.pop(other, None)
+            other.close()
+
+
+def parse_address(address, port):
+    """ 'host:port', 'host' or ':port' as (host, port) """
+    host, _, given = address.rpartition(':') if ':' in address else (address, None, None)
+    return host or '127.0.0.1', int(given) if given else port
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Emulate network conditions between little clients and server')
+    parser.add_argument('--listen', default=':{0}'.format(NETEM_PORT), help='address to accept clients on')
+    parser.add_argument('--target', default='127.0.0.1:{0}'.format(PORT), help='game server address')
+    parser.add_argument('--profile', default='lan', choices=sorted(PROFILES))
+    parser.add_argument('--latency', type=float, help='one way milliseconds, overrides the profile')
+    parser.add_argument('--jitter', type=float, help='milliseconds standard deviation')
+    parser.add_argument('--bandwidth', type=float, help='bytes per second each way')
+    parser.add_argument('--loss', type=float, help='chance a TCP segment is lost')
+    parser.add_argument('--stall-rate', type=float, help='link freezes per second')
+    parser.add_argument('--stall-time', type=float, help='milliseconds each freeze lasts')
+    parser.add_argument('--reorder', type=float, help='chance a frame is overtaken by the next')
+    parser.add_argument('--seed', type=int, help='random seed, for repeatable runs')
+    args = parser.parse_args()
+
+    changes = dict(latency=args.latency, jitter=args.jitter, bandwidth=args.bandwidth, loss=args.loss,
+                   stall_rate=args.stall_rate, stall_time=args.stall_time, reorder=args.reorder)
+    upstream, downstream = [conditions.copy(**changes) for conditions in PROFILES[args.profile]]
+    proxy = NetemProxy(parse_address(args.listen, NETEM_PORT), parse_address(args.target, PORT), upstream,
+                       downstream, seed=args.seed)
+    print('Forwarding {0} to {1}'.format(proxy.listen, proxy.target))
+    print('  client to server: {0}'.format(upstream))
+    print('  server to client: {0}'.format(downstream))
+    try:
+        proxy.run()
+    except KeyboardInterrupt:
+        pass
+    print(proxy.stats.report())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+"""
+Wire protocol shared by GameClient and GameServer
+
+Every message on the wire is a single frame:
+    | body length (uint32) | message type (uint8) | body (<body length> bytes) |
+
+The body is a request / response dictionary packed with encode(), a compact tagged binary format that only knows
+about the types requests and responses are built from (None, bool, int, float, str, unicode, list, tuple, dict).
+
+A client that sends 'compress': True in its requests may have large responses and pushes sent zlib compressed, the
+message type then has the COMPRESSED bit set.  Compressed bodies from one connection form a single zlib stream, each
+one sync flushed so it can be decompressed on arrival, they must be decompressed in the order they were sent.
+"""
+import struct
+import zlib
+
+
+# TCP port GameServer listens on
+PORT = 4000
+
+HEADER = struct.Struct('!IB')
+HEADER_SIZE = HEADER.size
+# Initial size of the receive buffer, grows to fit the largest frame seen
+BUFFER_SIZE = 4096
+# Refuse frames larger than this, a corrupt header should not make us allocate gigabytes
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# Refuse lists, tuples and dicts nested deeper than this rather than recursing until the interpreter gives up
+MAX_DEPTH = 64
+
+# Message types
+MSG_REQUEST = 1
+MSG_RESPONSE = 2
+# Sent by the server unprompted, e.g. room state for subscribed clients
+MSG_PUSH = 3
+# Set in the message type of a frame whose body is compressed
+COMPRESSED = 0x80
+
+# Bodies smaller than this are sent as they are, compressing them costs more time than the bytes saved are worth
+COMPRESS_THRESHOLD = 512
+# zlib level, the lowest levels get most of the saving on these payloads for a fraction of the CPU
+COMPRESS_LEVEL = 1
+# A connection stops compressing if, after this many bytes, compressed bodies are still over COMPRESS_MAX_RATIO of
+# their original size
+COMPRESS_SAMPLE = 64 * 1024
+COMPRESS_MAX_RATIO = 0.9
+
+try:
+    text_type = unicode
+    integer_types = (int, long)
+except NameError:
+    # Python 3
+    text_type = str
+    integer_types = (int,)
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class PacketSizeMismatch(ProtocolError):
+    """ Peer hung up part way through a frame """
+    pass
+
+
+class ConnectionClosed(ProtocolError):
+    """ Peer hung up cleanly between frames """
+    pass
+
+
+# Codec
+
+_INT8 = struct.Struct('!b')
+_INT16 = struct.Struct('!h')
+_INT32 = struct.Struct('!i')
+_INT64 = struct.Struct('!q')
+_DOUBLE = struct.Struct('!d')
+_LENGTH = struct.Struct('!I')
+
+_NONE = b'N'
+_TRUE = b'T'
+_FALSE = b'F'
+_INT8_TAG = b'b'
+_INT16_TAG = b'h'
+_INT32_TAG = b'i'
+_INT64_TAG = b'q'
+_DOUBLE_TAG = b'd'
+_BYTES_TAG = b's'
+_TEXT_TAG = b'u'
+_LIST_TAG = b'l'
+_TUPLE_TAG = b't'
+_DICT_TAG = b'm'
+
+
+def encode(obj):
+    """ Pack obj into a byte string, raises ProtocolError if obj contains an unsupported type """
+    chunks = []
+    _encode(obj, chunks.append)
+    return b''.join(chunks)
+
+
+def decode(data, start=0, end=None):
+    """
+    Unpack a byte string created by encode()
+    :param data: str, bytearray or buffer holding the encoded object
+    :param start: offset of the encoded object in data
+    :param end: only decode data[start:end], allows decoding straight out of a larger preallocated buffer
+    :return: decoded object
+    """
+    if end is None:
+        end = len(data)
+    try:
+        obj, offset = _decode(data, start, end, 0)
+    except (TypeError, ValueError, RuntimeError) as e:
+        # An unhashable dict key, text that is not utf-8, or (RecursionError is a RuntimeError) nesting beyond what
+        # the interpreter can recurse through
+        raise ProtocolError('Malformed data: {0!r}'.format(e))
+    if offset != end:
+        raise ProtocolError('{0} trailing bytes after decoded object'.format(end - offset))
+    return obj
+
+
+def _encode(obj, write):
+    if obj is None:
+        write(_NONE)
+    elif obj is True:
+        write(_TRUE)
+    elif obj is False:
+        write(_FALSE)
+    elif isinstance(obj, integer_types):
+        if -0x80 <= obj < 0x80:
+            write(_INT8_TAG + _INT8.pack(obj))
+        elif -0x8000 <= obj < 0x8000:
+            write(_INT16_TAG + _INT16.pack(obj))
+        elif -0x80000000 <= obj < 0x80000000:
+            write(_INT32_TAG + _INT32.pack(obj))
+        elif -0x8000000000000000 <= obj < 0x8000000000000000:
+            write(_INT64_TAG + _INT64.pack(obj))
+        else:
+            raise ProtocolError('Integer out of range: {0}'.format(obj))
+    elif isinstance(obj, float):
+        write(_DOUBLE_TAG + _DOUBLE.pack(obj))
+    elif isinstance(obj, text_type):
+        data = obj.encode('utf-8')
+        write(_TEXT_TAG + _LENGTH.pack(len(data)))
+        write(data)
+    elif isinstance(obj, bytes):
+        write(_BYTES_TAG + _LENGTH.pack(len(obj)))
+        write(obj)
+    elif isinstance(obj, list):
+        write(_LIST_TAG + _LENGTH.pack(len(obj)))
+        for item in obj:
+            _encode(item, write)
+    elif isinstance(obj, tuple):
+        write(_TUPLE_TAG + _LENGTH.pack(len(obj)))
+        for item in obj:
+            _encode(item, write)
+    elif isinstance(obj, dict):
+        write(_DICT_TAG + _LENGTH.pack(len(obj)))
+        for key, value in obj.items():
+            _encode(key, write)
+            _encode(value, write)
+    elif hasattr(obj, '__index__'):
+        # numpy integers and the like
+        _encode(obj.__index__(), write)
+    else:
+        raise ProtocolError('Cannot encode object of type {0}'.format(type(obj).__name__))
+
+
+def _decode(data, offset, end, depth):
+    if offset >= end:
+        raise ProtocolError('Unexpected end of data')
+    tag = bytes(data[offset:offset + 1])
+    offset += 1
+    if tag == _NONE:
+        return None, offset
+    elif tag == _TRUE:
+        return True, offset
+    elif tag == _FALSE:
+        return False, offset
+    elif tag == _INT8_TAG:
+        return _unpack(_INT8, data, offset, end)
+    elif tag == _INT16_TAG:
+        return _unpack(_INT16, data, offset, end)
+    elif tag == _INT32_TAG:
+        return _unpack(_INT32, data, offset, end)
+    elif tag == _INT64_TAG:
+        return _unpack(_INT64, data, offset, end)
+    elif tag == _DOUBLE_TAG:
+        return _unpack(_DOUBLE, data, offset, end)
+    elif tag in (_BYTES_TAG, _TEXT_TAG):
+        length, offset = _unpack(_LENGTH, data, offset, end)
+        if offset + length > end:
+            raise ProtocolError('Unexpected end of data')
+        value = bytes(data[offset:offset + length])
+        if tag == _TEXT_TAG:
+            value = value.decode('utf-8')
+        return value, offset + length
+    elif depth >= MAX_DEPTH and tag in (_LIST_TAG, _TUPLE_TAG, _DICT_TAG):
+        raise ProtocolError('Nested deeper than {0}'.format(MAX_DEPTH))
+    elif tag in (_LIST_TAG, _TUPLE_TAG):
+        length, offset = _unpack(_LENGTH, data, offset, end)
+        items = []
+        for i in range(length):
+            item, offset = _decode(data, offset, end, depth + 1)
+            items.append(item)
+        if tag == _TUPLE_TAG:
+            return tuple(items), offset
+        return items, offset
+    elif tag == _DICT_TAG:
+        length, offset = _unpack(_LENGTH, data, offset, end)
+        obj = {}
+        for i in range(length):
+            key, offset = _decode(data, offset, end, depth + 1)
+            value, offset = _decode(data, offset, end, depth + 1)
+            obj[key] = value
+        return obj, offset
+    else:
+        raise ProtocolError('Unknown type tag: {0!r}'.format(tag))
+
+
+def _unpack(packer, data, offset, end):
+    if offset + packer.size > end:
+        raise ProtocolError('Unexpected end of data')
+    return packer.unpack_from(data, offset)[0], offset + packer.size
+
+
+# Compression
+
+class Compressor(object):
+    """ Outgoing zlib stream of one connection, the history window carries over between messages so the keys, names
+    and sprite paths every response repeats compress to almost nothing after the first """
+    def __init__(self, threshold=COMPRESS_THRESHOLD, level=COMPRESS_LEVEL):
+        self.threshold = threshold
+        self.stream = zlib.compressobj(level)
+        # Bytes compressed so far, and what they compressed to
+        self.raw = 0
+        self.compressed = 0
+
+    def wanted(self, body):
+        """ True if body should be compressed """
+        if len(body) < self.threshold:
+            return False
+        # Give up on connections whose traffic doesn't compress
+        return self.raw < COMPRESS_SAMPLE or self.compressed < self.raw * COMPRESS_MAX_RATIO
+
+    def compress(self, body):
+        data = self.stream.compress(body) + self.stream.flush(zlib.Z_SYNC_FLUSH)
+        self.raw += len(body)
+        self.compressed += len(data)
+        return data
+
+
+class Decompressor(object):
+    """ Incoming end of a Compressor's stream """
+    def __init__(self):
+        self.stream = zlib.decompressobj()
+
+    def decompress(self, data):
+        try:
+            return self.stream.decompress(data)
+        except zlib.error as e:
+            raise ProtocolError('Compressed message could not be decompressed: {0}'.format(e))
+
+
+# Framing
+
+def pack_frame(msg_type, body):
+    """ Header and body as a single string, so a frame always goes out in one write """
+    if len(body) > MAX_FRAME_SIZE:
+        raise ProtocolError('Frame of {0} bytes is larger than {1}'.format(len(body), MAX_FRAME_SIZE))
+    return HEADER.pack(len(body), msg_type) + body
+
+
+def send_frame(sock, msg_type, body):
+    sock.sendall(pack_frame(msg_type, body))
+
+
+def send_message(sock, msg_type, obj):
+    """ Encode obj and send it as one frame """
+    send_frame(sock, msg_type, encode(obj))
+
+
+class FrameReader(object):
+    """ Reads whole frames off a blocking socket with recv_into, reusing one preallocated buffer """
+    def __init__(self, sock, buffer_size=BUFFER_SIZE):
+        self.sock = sock
+        self.buffer = bytearray(buffer_size)
+        # Created with the first compressed frame
+        self.decompressor = None
+
+    def read_frame(self):
+        """
+        Block until one whole frame has been read
+        :return: (message type, body length), the body is left in self.buffer[:body length]
+        """
+        self._read_into(HEADER_SIZE, frame_start=True)
+        length, msg_type = HEADER.unpack_from(self.buffer)
+        if length > MAX_FRAME_SIZE:
+            raise ProtocolError('Frame of {0} bytes is larger than {1}'.format(length, MAX_FRAME_SIZE))
+        if length > len(self.buffer):
+            self.buffer = bytearray(max(length, 2 * len(self.buffer)))
+        self._read_into(length)
+        return msg_type, length
+
+    def read_message(self):
+        """ Block until one whole frame has been read, return (message type, decoded body) """
+        msg_type, length = self.read_frame()
+        if msg_type & COMPRESSED:
+            if self.decompressor is None:
+                self.decompressor = Decompressor()
+            return msg_type & ~COMPRESSED, decode(self.decompressor.decompress(bytes(self.buffer[:length])))
+        return msg_type, decode(self.buffer, end=length)
+
+    def _read_into(self, size, frame_start=False):
+        view = memoryview(self.buffer)
+        received = 0
+        while received < size:
+            count = self.sock.recv_into(view[received:size], size - received)
+            if not count:
+                if frame_start and not received:
+                    raise ConnectionClosed('Connection closed by peer')
+                raise PacketSizeMismatch('Expected size: {0}, Actual size: {1}'.format(size, received))
+            received += count
+
+
+class FrameDecoder(object):
+    """ Splits bytes read off a non-blocking socket into whole frames, reusing one preallocated buffer """
+    def __init__(self, buffer_size=BUFFER_SIZE):
+        self.buffer = bytearray(buffer_size)
+        # Bytes currently held in self.buffer
+        self.size = 0
+
+    def recv_from(self, sock):
+        """ Read whatever is waiting on sock into the buffer, returns bytes read, 0 means the peer hung up """
+        if self.size == len(self.buffer):
+            self._grow(2 * len(self.buffer))
+        count = sock.recv_into(memoryview(self.buffer)[self.size:])
+        self.size += count
+        return count
+
+    def read_messages(self):
+        """ Pop every whole frame held in the buffer, returns list of (message type, decoded body) """
+        messages = []
+        offset = 0
+        while self.size - offset >= HEADER_SIZE:
+            length, msg_type = HEADER.unpack_from(self.buffer, offset)
+            if length > MAX_FRAME_SIZE:
+                raise ProtocolError('Frame of {0} bytes is larger than {1}'.format(length, MAX_FRAME_SIZE))
+            start = offset + HEADER_SIZE
+            if self.size - start < length:
+                # Rest of this frame has not arrived yet, make sure it will fit when it does
+                if HEADER_SIZE + length > len(self.buffer):
+                    self._compact(offset)
+                    offset = 0
+                    self._grow(HEADER_SIZE + length)
+                break
+            messages.append((msg_type, decode(self.buffer, start, start + length)))
+            offset = start + length
+        self._compact(offset)
+        return messages
+
+    def _compact(self, offset):
+        """ Drop the first offset bytes of the buffer """
+        if offset:
+            remaining = self.size - offset
+            self.buffer[:remaining] = self.buffer[offset:self.size]
+            self.size = remaining
+
+    def _grow(self, size):
+        buffer = bytearray(size)
+        buffer[:self.size] = self.buffer[:self.size]
+        self.buffer = buffer
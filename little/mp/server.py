@@ -1,5 +1,7 @@
-import socket, select, pickle
+import socket, select, errno
 import atexit
+import os, binascii
+from collections import deque
 # from gameobjects.gameobject import get_object_by_id
 # from gameobjects.gameobject import load_user
 
@@ -8,96 +10,452 @@ import sys
 import pytmx
 
 from game_locals import *
+from mp.characters import CharacterStore
+from mp.protocol import FrameDecoder, Compressor, encode, pack_frame, ProtocolError, PORT, MSG_REQUEST, MSG_RESPONSE, \
+    MSG_PUSH, COMPRESSED
+from mp.metrics import Metrics
+from mp.snapshot import SpriteTable, pack_delta, is_compact
+from timeit import default_timer
 
 # constants
 USER_LIST = 'mp/users/users.json'
+# Player characters are loaded from and saved to this database, see mp/characters.py.  Kept with the user's data
+# rather than in the package, the directory is created when the database is first opened
+CHARACTER_DB = os.path.join(os.path.expanduser('~'), '.little', 'characters.db')
+# Milliseconds between saves of every character logged in, on top of the save at logout
+CHARACTER_SAVE_INTERVAL = 60000
 TILE_SIZE = 8
-BUFFER_SIZE = 1024
 VERBOSE = False
 OBJECT_LAYER = 2
 
 START_ROOM = 'template_room'
 START_COORDS = [160, 160]
 
+# Most broadcast messages / payloads held for one client, and what happens to new ones once it is full
+MAILBOX_SIZE = 256
+MAILBOX_OVERFLOW = 'drop_oldest'
+
+# Room snapshots kept per client waiting to be acknowledged, a client further behind than this gets a full snapshot
+SNAPSHOT_HISTORY = 32
+
+# Gameobjects further than this from a player (in pixels) are left out of the room data sent to them, None sends
+# the whole room.  The client's view at the default resolution and zoom is about 21 x 12 tiles
+INTEREST_RADIUS = 16 * TILE_SIZE
+# A gameobject already sent to a player is only dropped once it is this much further out than INTEREST_RADIUS, so
+# gameobjects walking along the edge don't flicker in and out
+INTEREST_HYSTERESIS = 4 * TILE_SIZE
+
+# Default milliseconds between room state pushes to a subscribed client, 0 pushes every tick
+PUSH_INTERVAL = 100
+
+# Record per request type / per tick phase statistics, see mp/metrics.py.  Can also be switched on at runtime with
+# the 'metrics' request
+METRICS_ENABLED = False
+# While metrics are enabled they are written here as JSON every METRICS_DUMP_INTERVAL milliseconds, None to not dump
+METRICS_FILE = 'mp/metrics.json'
+METRICS_DUMP_INTERVAL = 10000
+# Users allowed to send admin requests like 'metrics'
+ADMIN_USERS = ['leif', 'ken', 'nat']
+
+# Request types clients may send, each the name of the RequestProcessor method that handles it
+REQUESTS = ['batch', 'inventory_update', 'inventory_equip', 'inventory_unequip', 'ooc', 'tell', 'say', 'attack',
+            'get_target', 'get_roomdata', 'subscribe', 'unsubscribe', 'update_coords', 'change_room', 'login', 'logout',
+            'test', 'metrics', 'evaluate']
+
+# Requests GameServer answers itself when rooms are sharded, everything else goes to the shard holding the player
+ROUTER_REQUESTS = ['metrics', 'test']
+
+# Requests that change the client's session, these must be sent on their own rather than inside a batch
+UNBATCHABLE_REQUESTS = ['batch', 'login', 'logout', 'subscribe', 'unsubscribe']
+
+# Token bucket limits per session and request type, (<requests per second>, <burst>).  Sub-requests of a batch count
+# against their own type too.  Request types not listed share one DEFAULT_RATE_LIMIT bucket.  Requests over the limit
+# are answered with an error without being processed
+RATE_LIMITS = {'batch': (75, 150), 'update_coords': (20, 40), 'get_roomdata': (30, 60), 'say': (3, 10),
+               'tell': (3, 10), 'ooc': (3, 10), 'login': (1, 5), 'evaluate': (5, 10), 'metrics': (2, 5)}
+DEFAULT_RATE_LIMIT = (60, 120)
+# Most requests held for one client between ticks, further requests are refused until it drains
+INBOUND_QUEUE_SIZE = 64
+# Most requests from one client processed per tick, the rest wait for the next tick
+REQUESTS_PER_TICK = 8
+# Only the latest of these matters, one arriving while another is still queued replaces it and the response is sent
+# for both.  Within a batch only the last is processed
+COALESCED_REQUESTS = ['update_coords']
+# Bytes waiting to be sent to a client before room state pushes to it are held back, and before it is disconnected
+PUSH_BACKLOG = 64 * 1024
+OUTBOUND_LIMIT = 4 * 1024 * 1024
+
 
 # ERRORS
 # 1001  :: Gameobject not exist
 
-# TODO: Need to display enemy damage to players, both in white for other players to see, and in red for the player
-# TODO: being hit.  Also need to display '<enemy> has been slain!' message as well.
-class BroadcastQue(object):
-    """ Queues messages to be sent to individual clients """
-    def __init__(self, server):
+class MailboxQue(object):
+    """
+    Queues items for individual clients, one bounded mailbox per charactername.  Adding is O(recipients) and
+    dumping is O(items waiting for that character), a client that stops polling only fills its own mailbox.
+    """
+    def __init__(self, server, size=MAILBOX_SIZE, overflow=MAILBOX_OVERFLOW):
+        """
+        :param size: most items a mailbox holds
+        :param overflow: what to do with an item for a full mailbox, 'drop_oldest' or 'drop_newest'
+        """
+        if overflow not in ('drop_oldest', 'drop_newest'):
+            raise RuntimeError('Unknown mailbox overflow behaviour: {0}'.format(overflow))
         self.server = server
-        self.que = []
+        self.size = size
+        self.overflow = overflow
+        # Dictionary like {<charactername>: deque([<item>, <item>, ...]), ... }
+        self.mailboxes = {}
+        # Items lost to overflow, like {<charactername>: <count>, ... }
+        self.dropped = {}
+        # Called with (item, target) for recipients that may be on another room shard, see mp/shard.py
+        self.relay = None
 
-    def add(self, message, target, color=NORMAL_COLOR):
+    def _deliver(self, item, target, relay=True):
         """
-        :param message: Message to be broadcasted
+        :param item: dictionary to deliver, shared between all recipients so must not be changed afterwards
         :param target: 'ALL', 'room:uniquename', 'charactername'
-        :param color: (255, 255, 255)
+        :param relay: pass items for players this server doesn't hold on to self.relay, if set
         """
+        relay = self.relay if relay else None
         if target == 'ALL':
-            for charactername in self.characternames:
-                self.que.append({'message': message, 'charactername': charactername, 'color': color})
+            names = self.characternames
+            if relay:
+                relay(item, target)
         elif target.startswith('room:'):
             room = target.replace('room:', '')
-            names = [player.name for id, player in self.server.goc.players.items() if player.current_room == room]
-            for charactername in names:
-                self.que.append({'message': message, 'charactername': charactername, 'color': color})
+            players = self.server.goc.players
+            names = [go.name for id, go in self.server.goc.room_gameobjects(room).items() if id in players]
+        elif relay and target not in self.characternames:
+            relay(item, target)
+            return
         else:
-            self.que.append({'message': message, 'charactername': target, 'color': color})
+            names = [target]
+        for charactername in names:
+            mailbox = self.mailboxes.get(charactername)
+            if mailbox is None:
+                mailbox = self.mailboxes[charactername] = deque(maxlen=self.size)
+            if len(mailbox) == self.size:
+                self.dropped[charactername] = self.dropped.get(charactername, 0) + 1
+                if self.overflow == 'drop_newest':
+                    continue
+            mailbox.append(item)
 
     def dump(self, charactername):
-        """ Return list of all messages intended for the given charactername, and pop them from the broadcast que """
-        output_que = []
-        for i, message in enumerate(self.que):
-            if message['charactername'] == charactername:
-                output_que.append(self.que.pop(i))
+        """ Return list of all items intended for the given charactername, and empty their mailbox """
+        mailbox = self.mailboxes.get(charactername)
+        if not mailbox:
+            return []
+        output_que = list(mailbox)
+        mailbox.clear()
         return output_que
 
+    def discard(self, charactername):
+        """ Throw away the mailbox of a character that has logged out """
+        self.mailboxes.pop(charactername, None)
+        self.dropped.pop(charactername, None)
+
     @property
     def characternames(self):
-        """ List of all characternames currently connected """
-        return self.server.goc.playernames
+        """ All characternames currently connected, like {<charactername>: <gameobject>, ... } """
+        return self.server.goc.players_by_name
+
+
+# TODO: Need to display enemy damage to players, both in white for other players to see, and in red for the player
+# TODO: being hit.  Also need to display '<enemy> has been slain!' message as well.
+class BroadcastQue(MailboxQue):
+    """ Queues messages to be sent to individual clients """
+    def add(self, message, target, color=NORMAL_COLOR):
+        """
+        :param message: Message to be broadcasted
+        :param target: 'ALL', 'room:uniquename', 'charactername'
+        :param color: (255, 255, 255)
+        """
+        self._deliver({'message': message, 'color': color}, target)
 
 
 # TODO: Finish this, starting with visual equipment for remoteclients updating
-class PayloadQue(object):
+class PayloadQue(MailboxQue):
     """ Queues payloads to be sent to individual clients"""
-    def __init__(self, server):
-        self.server = server
-        self.que = []
-
     def add(self, tag, data, target):
         """
         :param tag: string, metadata so that client knows what to do with payload
         :param data: payload to be delivered to client(s)
         :param target: 'ALL', 'room:uniquename', 'charactername'
         """
-        if target == 'ALL':
-            for charactername in self.characternames:
-                self.que.append({'tag': tag, 'data': data, 'charactername': charactername})
-        elif target.startswith('room:'):
-            room = target.replace('room:', '')
-            names = [player.name for id, player in self.server.goc.players.items() if player.current_room == room]
-            for charactername in names:
-                self.que.append({'tag': tag, 'data': data, 'charactername': charactername})
-        else:
-            self.que.append({'tag': tag, 'data': data, 'charactername': target})
+        self._deliver({'tag': tag, 'data': data}, target)
 
-    def dump(self, charactername):
-        """ Return list of all messages intended for the given charactername, and pop them from the broadcast que """
-        output_que = []
-        for i, message in enumerate(self.que):
-            if message['charactername'] == charactername:
-                output_que.append(self.que.pop(i))
-        return output_que
 
-    @property
-    def characternames(self):
-        """ List of all characternames currently connected """
-        return self.server.goc.playernames
+class SnapshotHistory(object):
+    """
+    Room snapshots sent to one client that it may still build on.  get_roomdata sends each snapshot as a delta
+    against the last one the client acknowledged, so objects standing still cost nothing after the first poll.
+
+    Snapshots look like {<id>: (<sprite>, [x, y]), ... }, deltas look like:
+    {'seq': 5, 'baseline': 4, 'added': {<id>: (<sprite>, [x, y]), ... }, 'moved': {<id>: [x, y], ... },
+     'removed': [<id>, ... ]}
+    A delta with baseline None is a full snapshot, everything in it is in 'added'.
+    """
+    def __init__(self, size=SNAPSHOT_HISTORY):
+        self.size = size
+        self.seq = 0
+        # Like {<seq>: <snapshot>, ... }
+        self.snapshots = {}
+        # Sprite ids already sent to this client in compact snapshots, see mp/snapshot.py
+        self.sprites_sent = set()
+
+    def delta(self, ack, snapshot):
+        """
+        :param ack: seq of the last snapshot the client applied, None if it has nothing
+        :param snapshot: current snapshot of the client's room
+        :return: delta taking the client from snapshot ack to snapshot
+        """
+        baseline = self.snapshots.get(ack)
+        # The client will never build on anything older than what it just acknowledged
+        for seq in list(self.snapshots):
+            if ack is None or seq < ack:
+                del self.snapshots[seq]
+        while len(self.snapshots) >= self.size:
+            del self.snapshots[min(self.snapshots)]
+        self.seq += 1
+        self.snapshots[self.seq] = snapshot
+
+        if baseline is None:
+            return {'seq': self.seq, 'baseline': None, 'added': snapshot, 'moved': {}, 'removed': []}
+        added, moved = {}, {}
+        for id, spritecoords in snapshot.items():
+            if id not in baseline or baseline[id][0] != spritecoords[0]:
+                # New object, or its sprite changed, send the sprite along with it
+                added[id] = spritecoords
+            elif baseline[id][1] != spritecoords[1]:
+                moved[id] = spritecoords[1]
+        removed = [id for id in baseline if id not in snapshot]
+        return {'seq': self.seq, 'baseline': ack, 'added': added, 'moved': moved, 'removed': removed}
+
+    def discard(self, seq):
+        """ Forget a snapshot that was never sent, the client will keep building on the one before it """
+        self.snapshots.pop(seq, None)
+
+
+class Session(object):
+    """ A logged in character, found by the token handed to the client at login """
+    def __init__(self, token, playerid, username, charactername):
+        self.token = token
+        self.playerid = playerid
+        self.username = username
+        self.charactername = charactername
+        # Rate limits follow the session across reconnects
+        self.limiter = RateLimiter()
+
+
+class TokenBucket(object):
+    """ Allows rate requests per second on average and up to burst at once """
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+
+    def take(self, now):
+        """ True if a request may go ahead """
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def refund(self):
+        """ Give back the token taken for a request that should not count against the limit """
+        self.tokens = min(self.burst, self.tokens + 1)
+
+
+class RateLimiter(object):
+    """ One client's TokenBuckets, by request type """
+    def __init__(self, limits=RATE_LIMITS, default=DEFAULT_RATE_LIMIT):
+        self.limits = limits
+        self.default = default
+        # Like {<request type>: <TokenBucket>, ... }, None holds the bucket shared by unlisted request types
+        self.buckets = {}
+
+    def allow(self, name, now):
+        """ True if a request of type name may go ahead at now (seconds) """
+        if name not in self.limits:
+            name = None
+        bucket = self.buckets.get(name)
+        if bucket is None:
+            rate, burst = self.limits.get(name, self.default)
+            bucket = self.buckets[name] = TokenBucket(rate, burst, now)
+        return bucket.take(now)
+
+    def refund(self, name):
+        if name not in self.limits:
+            name = None
+        bucket = self.buckets.get(name)
+        if bucket is not None:
+            bucket.refund()
+
+
+class InboundQueue(object):
+    """ Requests from one client waiting for the next tick, at most size of them """
+    def __init__(self, size=INBOUND_QUEUE_SIZE):
+        self.size = size
+        self.requests = deque()
+
+    def __len__(self):
+        return len(self.requests)
+
+    def push(self, request):
+        """ Queue request, returns an error message if it was refused """
+        name = request.get('request')
+        if name in COALESCED_REQUESTS:
+            for queued in self.requests:
+                if queued.get('request') == name:
+                    # Superseded, it is answered with the response to this one
+                    coalesced = queued.pop('coalesced', [])
+                    if 'request_id' in queued:
+                        coalesced.append(queued['request_id'])
+                    request['coalesced'] = coalesced
+                    self.requests.remove(queued)
+                    break
+        if len(self.requests) >= self.size:
+            return 'Too many requests queued'
+        self.requests.append(request)
+        return None
+
+    def popleft(self):
+        return self.requests.popleft()
+
+
+class InterestSet(object):
+    """
+    Gameobjects in one player's area of interest.  A gameobject enters the set once it comes within radius of the
+    player and leaves once it is further than radius + hysteresis away, the player is always in their own set.
+    """
+    def __init__(self, radius=INTEREST_RADIUS, hysteresis=INTEREST_HYSTERESIS):
+        # Compare squared distances, saves a sqrt per gameobject
+        self.enter = radius ** 2
+        self.leave = (radius + hysteresis) ** 2
+        self.visible = set()
+
+    def filter(self, playerid, origin, room_map):
+        """
+        Update the set from the player's position and return the part of room_map they can see
+        :param playerid: id of the player, always visible
+        :param origin: player's coords
+        :param room_map: {<id>: (<sprite>, <coords>), ... } as returned by coords_sprite_map_for_room
+        :return: room_map restricted to the area of interest
+        """
+        x, y = origin[0], origin[1]
+        enter, leave, previous = self.enter, self.leave, self.visible
+        visible = set()
+        filtered = {}
+        for id, entry in room_map.items():
+            coords = entry[1]
+            dx, dy = coords[0] - x, coords[1] - y
+            distance = dx * dx + dy * dy
+            if distance <= enter or id == playerid or (distance <= leave and id in previous):
+                visible.add(id)
+                filtered[id] = entry
+        self.visible = visible
+        return filtered
+
+
+class Subscription(object):
+    """ A client's subscription to pushed state for whatever room its character is in """
+    def __init__(self, interval=PUSH_INTERVAL, compact=False):
+        # Milliseconds between pushes
+        self.interval = interval
+        # Push snapshots in the compact array encoding, see mp/snapshot.py
+        self.compact = compact
+        self.timer = 0
+        # seq of the last snapshot pushed, pushes are delta encoded against it
+        self.seq = None
+
+    def due(self, dt):
+        """ Advance the push timer by dt, returns True when a push should be sent """
+        self.timer -= dt if dt is not None else self.interval
+        if self.timer <= 0:
+            self.timer = self.interval
+            return True
+        return False
+
+
+class ClientConnection(object):
+    """
+    A non-blocking client socket tracked in GameServer.connections, kept open between requests for session mode
+    clients.  Bytes are only ever moved in and out of the socket when select says they can be, so one slow client
+    cannot hold up the others or the simulation.
+    """
+    def __init__(self, client, address, metrics=None):
+        self.client = client
+        self.address = address
+        # Compression ratio and time are recorded here
+        self.metrics = metrics
+        self.client.setblocking(0)
+        # Splits incoming bytes into framed requests
+        self.decoder = FrameDecoder()
+        # Framed responses waiting for the socket to become writable
+        self.outbound = bytearray()
+        # True once the client has asked for a long-lived session, the server will not close the socket after replying
+        self.session = False
+        # Close the socket once self.outbound has been sent (connect-per-request clients)
+        self.closing = False
+        # Character logged in over this connection, logged out again if the client hangs up
+        self.playerid = None
+        self.charactername = None
+        # Subscription to pushed room state, None while the client polls
+        self.subscription = None
+        # Outgoing zlib stream, created once the client says it can decompress
+        self.compressor = None
+        # Requests waiting for the tick, and rate limits for requests sent without a session token
+        self.inbound = InboundQueue()
+        self.limiter = RateLimiter()
+
+    def fileno(self):
+        return self.client.fileno()
+
+    def bind(self, playerid, charactername):
+        self.playerid = playerid
+        self.charactername = charactername
+
+    def unbind(self):
+        self.playerid = None
+        self.charactername = None
+        self.subscription = None
+
+    def receive(self):
+        """ Read whatever the client has sent, returns list of (message type, message), raises EOFError on hangup """
+        try:
+            if not self.decoder.recv_from(self.client):
+                raise EOFError('Connection closed by client')
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                raise
+        return self.decoder.read_messages()
+
+    def queue_message(self, msg_type, body):
+        """ Queue an encoded message to be sent on the next flush, compressed if it is large enough """
+        compressor = self.compressor
+        if compressor is not None and compressor.wanted(body):
+            metrics = self.metrics if self.metrics is not None and self.metrics.enabled else None
+            if metrics:
+                start = default_timer()
+            compressed = compressor.compress(body)
+            if metrics:
+                metrics.record_compression(len(body), len(compressed), (default_timer() - start) * 1000.)
+            msg_type, body = msg_type | COMPRESSED, compressed
+        self.outbound += pack_frame(msg_type, body)
+
+    def flush(self):
+        """ Send as much of self.outbound as the socket will take without blocking """
+        try:
+            sent = self.client.send(self.outbound)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise
+        del self.outbound[:sent]
 
 
 class RequestProcessor(object):
@@ -106,6 +464,15 @@ class RequestProcessor(object):
         self.server = server
         self.broadcastque = BroadcastQue(self.server)
         self.payloadque = PayloadQue(self.server)
+        # Room snapshots sent to each client, for delta encoding get_roomdata, like {<playerid>: <SnapshotHistory>}
+        self.snapshots = {}
+        # Area of interest of each client, like {<playerid>: <InterestSet>}
+        self.interest = {}
+        # Sprite paths interned for compact snapshots
+        self.sprites = SpriteTable()
+        # Player characters, cached in memory once they have logged out and written back in the background
+        self.characters = CharacterStore(CHARACTER_DB)
+        self.save_timer = CHARACTER_SAVE_INTERVAL
 
     def get_payload(self, request):
         """
@@ -117,7 +484,47 @@ class RequestProcessor(object):
         :param request: dictionary sent from client
         :return: {'status': 0, 'response': { <response object> } }
         """
-        return getattr(self, request['request'])(request)
+        name = request['request']
+        if name not in REQUESTS:
+            return {'status': -1, 'response': {'message': 'Unknown request: {0!r}'.format(name)}}
+        return getattr(self, name)(request)
+
+    def batch(self, request):
+        """ Process several sub-requests sent in one message, so everything a client frame needs is one round trip
+        Request like: {... 'request': 'batch', 'args': [{'request': 'get_roomdata', 'args': None}, ... ]}
+        Return data like: {'status': 0, 'response': [{'status': 0, 'response': ... }, ... ]}, one payload per
+        sub-request in the same order, each with its own status """
+        metrics = self.server.metrics
+        responses = []
+        # Coalesced requests only run for the last of their type, the others get the same response
+        last = dict((sub_request.get('request'), index) for index, sub_request in enumerate(request['args'])
+                    if sub_request.get('request') in COALESCED_REQUESTS and not sub_request.get('limited'))
+        superseded = {}
+        for index, sub_request in enumerate(request['args']):
+            name = sub_request.get('request')
+            if name not in REQUESTS or name in UNBATCHABLE_REQUESTS:
+                responses.append({'status': -1, 'response': {'message': 'Cannot batch request: {0}'.format(name)}})
+                continue
+            if sub_request.get('limited'):
+                # Marked by GameServer.admit
+                responses.append({'status': -1, 'response': {'message': 'Rate limit exceeded: {0}'.format(name)}})
+                continue
+            if last.get(name, index) != index:
+                superseded[index] = last[name]
+                responses.append(None)
+                continue
+            sub_request = dict(request, request=name, args=sub_request.get('args'))
+            if metrics.enabled:
+                start = default_timer()
+            try:
+                responses.append(self.get_payload(sub_request))
+            except Exception:
+                responses.append({'status': -1, 'response': {'message': 'Unable to process {0}'.format(name)}})
+            if metrics.enabled:
+                metrics.record_request(name, (default_timer() - start) * 1000., status=responses[-1].get('status'))
+        for index, latest in superseded.items():
+            responses[index] = responses[latest]
+        return {'status': 0, 'response': responses}
 
     def inventory_update(self, request):
         """ Send list of dictionaries of item data to client to update client-side RemoteInventory
@@ -171,7 +578,7 @@ class RequestProcessor(object):
         message = request['args']['message']
         target_player = request['args']['target']
         # Check if player is in remote clients, and correct for case sensitivity
-        if target_player.capitalize() not in self.goc.playernames:
+        if not self.server.player_online(target_player.capitalize()):
             return {'status': -1, 'response': {'message': 'Player not logged in'}}
         self.broadcastque.add(message=message, target=target_player.capitalize(), color=TELL_COLOR)
         return {'status': 0, 'response': 'tell message delivered to server'}
@@ -211,68 +618,217 @@ class RequestProcessor(object):
         id = request['args'][0]
         try:
             gameobject = self.goc.gameobjects[id]
-            name, stats = gameobject.name, gameobject.stats
+            # Stats may be a StatBlock view into the GOC's ComponentStore
+            name, stats = gameobject.name, dict(gameobject.stats)
             return {'status': 0, 'response': {'stats': stats, 'name': name}}
         except KeyError:
+            if self.goc.ids.is_stale(id):
+                # The target was removed, its id may since have gone to another gameobject
+                return {'status': 1001, 'response': {'message': 'Target no longer exists'}}
             return {'status': 1001, 'response': {'message': 'ID Does not exist in Gameobject controller'}}
 
     def get_roomdata(self, request):
-        """ Return Co-ords to client of all gameobjects in room, also return all broadcast messages to client """
-        # Get coordinates of only objects in the client's current room:
-        current_room = self.goc.gameobjects[request['id']].current_room
-        room_coords = self.goc.coords_sprite_map_for_room(current_room)
+        """ Return Co-ords to client of all gameobjects in room, also return all broadcast messages to client
+        Request like: {... 'request': 'get_roomdata', 'args': {'ack': <seq of last snapshot applied, or None>,
+                                                               'compact': <bool>}}
+        Return data like: {'status': 0, 'response': {'snapshot': <delta, see SnapshotHistory>, 'messages': [...],
+        'payloads': [...]}}
+        With compact the snapshot uses the array encoding in mp/snapshot.py.  If args is None the whole room is
+        returned under 'coords' instead of 'snapshot' """
         charactername = request['charactername']
+        args = request['args']
+        if args is not None:
+            return {'status': 0, 'response': self._room_state(request['id'], charactername, args.get('ack'),
+                                                             args.get('compact', False))}
+        # Get coordinates of only objects in the client's area of interest:
+        room_coords = self._visible_room_map(request['id'])
         return {'status': 0, 'response': {'coords': room_coords, 'messages': self.broadcastque.dump(charactername),
                                           'payloads': self.payloadque.dump(charactername)}}
 
+    def _push_state(self, playerid, charactername, subscription, dt=None):
+        """ Encoded room state for a subscribed player whose push timer is due, None if it isn't due or nothing
+        changed since the last push """
+        if not subscription.due(dt) or playerid not in self.goc.gameobjects:
+            return None
+        state = self._room_state(playerid, charactername, subscription.seq, subscription.compact)
+        delta = state['snapshot']
+        if is_compact(delta):
+            changed = delta['added']['ids'] or delta['moved']['ids'] or delta['removed']
+        else:
+            changed = delta['added'] or delta['moved'] or delta['removed']
+        if not (changed or state['messages'] or state['payloads']):
+            # Nothing changed, keep building on the snapshot the client already has
+            self.snapshots[playerid].discard(delta['seq'])
+            return None
+        subscription.seq = delta['seq']
+        return encode(state)
+
+    def _room_state(self, playerid, charactername, ack, compact=False):
+        """ Delta encoded snapshot of the player's room with broadcasts and payloads waiting for them, as used by
+        get_roomdata and room state pushes """
+        # Copy coords, the snapshot is kept to diff against and must not follow the gameobject around
+        snapshot = {id: (sprite, list(coords)) for id, (sprite, coords) in self._visible_room_map(playerid).items()}
+        history = self.snapshots.setdefault(playerid, SnapshotHistory())
+        delta = history.delta(ack, snapshot)
+        if compact:
+            if ack is None:
+                # Client is starting over, it may have thrown its sprite ids away too
+                history.sprites_sent.clear()
+            delta = pack_delta(delta, self.sprites, history.sprites_sent)
+        return {'snapshot': delta, 'messages': self.broadcastque.dump(charactername),
+                'payloads': self.payloadque.dump(charactername)}
+
+    def _visible_room_map(self, playerid):
+        """ coords_sprite_map_for_room for the player's room, restricted to the player's area of interest """
+        player = self.goc.gameobjects[playerid]
+        room_map = self.goc.coords_sprite_map_for_room(player.current_room)
+        if INTEREST_RADIUS is None:
+            return room_map
+        interest = self.interest.get(playerid)
+        if interest is None:
+            interest = self.interest[playerid] = InterestSet()
+        return interest.filter(playerid, player.coords, room_map)
+
+    def subscribe(self, request):
+        """ Have the server push room state to this client instead of the client polling get_roomdata
+        Request like: {... 'request': 'subscribe', 'args': {'interval': <milliseconds between pushes>,
+                                                            'compact': <bool, see get_roomdata>}}
+        Pushes arrive as MSG_PUSH frames shaped like the get_roomdata response.  Requires a session connection """
+        connection = self.server.connection_for(request['id'])
+        if connection is None:
+            return {'status': -1, 'response': {'message': 'Subscribing requires a session connection'}}
+        interval = PUSH_INTERVAL
+        args = request['args'] or {}
+        if args.get('interval') is not None:
+            interval = args['interval']
+        connection.subscription = Subscription(interval, args.get('compact', False))
+        return {'status': 0, 'response': {'message': 'Subscribed', 'interval': interval}}
+
+    def unsubscribe(self, request):
+        """ Stop room state pushes, the client goes back to polling get_roomdata """
+        connection = self.server.connection_for(request['id'])
+        if connection is not None:
+            connection.subscription = None
+        return {'status': 0, 'response': {'message': 'Unsubscribed'}}
+
     def update_coords(self, request):
         """ Update player's coords in the GOC, also return some basic player stats to client like:
-         move_time, attack_speed """
+         move_time, attack_speed
+        Args are [x, y] or {'coords': [x, y], 'seq': <n>}, seq is echoed back with the coords the server now holds so
+        the client can check its predicted position against them """
+        args = request['args']
+        seq = None
+        if isinstance(args, dict):
+            args, seq = args['coords'], args.get('seq')
         lf = self.goc.lifeforms[request['id']]
-        lf.coords = request['args']
-        return {'status': 0, 'response': {'move_time': lf.move_time, 'attack_time': lf.attack_time}}
+        lf.coords = args
+        return {'status': 0, 'response': {'move_time': lf.move_time, 'attack_time': lf.attack_time,
+                                          'coords': list(lf.coords), 'seq': seq}}
+
+    def change_room(self, request):
+        """ Move the player to another room
+        Request like: {... 'request': 'change_room', 'args': {'room': <room uniquename>, 'coords': [x, y]}}
+        Return data like: {'status': 0, 'response': {'current_room': <room uniquename>, 'coords': [x, y]}} """
+        room = request['args']['room']
+        if not self.server.room_exists(room):
+            return {'status': -1, 'response': {'message': 'No such room: {0}'.format(room)}}
+        lf = self.goc.lifeforms[request['id']]
+        lf.change_room(room, request['args'].get('coords'))
+        # Whatever the client had of the old room is no use in the new one
+        self.snapshots.pop(lf.id, None)
+        self.interest.pop(lf.id, None)
+        return {'status': 0, 'response': {'current_room': lf.current_room, 'coords': lf.coords}}
 
     def login(self, request):
         """ Login client and create Gameobject for the client-user's character """
         if self.server.authenticate_credentials(request):
-            if request['charactername'] not in self.goc.playernames:
+            if request['charactername'] not in self.goc.players_by_name:
                 print('Player logging in, adding player Lifeform to GOC')
-                print('Loading mp/users/{0}/sav'.format(request['charactername']))
-                gameobject, id = self.goc.load_gameobject('mp/users/{0}.sav'.format(request['charactername']))
-                print('Loaded, creating gameobject')
+                gameobject = self.characters.load(request['charactername'], self.goc)
+                if gameobject is None:
+                    # Not in the character store yet, it is added at the first save
+                    print('Loading mp/users/{0}.sav'.format(request['charactername']))
+                    gameobject, id = self.goc.load_gameobject('mp/users/{0}.sav'.format(request['charactername']))
+                else:
+                    id = self.goc.insert_gameobject(gameobject, gameobject.current_room, gameobject.coords)
+                self.snapshots.pop(id, None)
+                self.interest.pop(id, None)
                 print('Created gameobject with id: {0}'.format(id))
                 # If the player has no coords, he's a fresh player, and should go to the starting room
-                if not gameobject.current_room:
+                if not gameobject.current_room or not self.server.room_exists(gameobject.current_room):
                     gameobject.current_room = START_ROOM
                     gameobject.coords = START_COORDS
-                print('RETURNING!!!!!!!')
+                token = self.server.open_session(id, request['username'], request['charactername'])
                 return {'status': 0, 'response': {'id': id, 'coords': gameobject.coords, 'sprite': gameobject.graphic,
-                        'current_room': gameobject.current_room}}
+                        'current_room': gameobject.current_room, 'token': token}}
             else:
                 return {'status': -1, 'response': {'message': 'Character already logged in'}}
         else:
             return {'status': -1, 'response': {'message': 'Credentials invalid'}}
 
     def logout(self, request):
-        """ Logout client and remove their gameobject from the world """
-        if self.server.authenticate_credentials(request):
-            if request['charactername'] in self.goc.playernames:
-                print('Removing gameobject with id: {0}'.format(request['id']))
-                self.goc.remove_gameobject(request['id'])
-                return {'status': 0, 'response': {'message': 'Logout successful'}}
-            else:
-                return {'status': -1, 'response': {'message': 'Character is not logged in'}}
+        """ Logout client and remove their gameobject from the world, the request has already been authenticated by
+        GameServer.process_request through its session token or credentials """
+        if request['charactername'] in self.goc.players_by_name:
+            print('Removing gameobject with id: {0}'.format(request['id']))
+            self._remove_player(request['id'], request['charactername'])
+            return {'status': 0, 'response': {'message': 'Logout successful'}}
         else:
-            print('User had invalid credentials, halting action')
-            return {'status': -1, 'response': {'message': 'Credentials invalid'}}
+            return {'status': -1, 'response': {'message': 'Character is not logged in'}}
+
+    def _remove_player(self, playerid, charactername):
+        """ Save a player's character and take it out of the world """
+        gameobject = self.goc.gameobjects.get(playerid)
+        if gameobject is not None:
+            self.characters.save(gameobject, self.goc, logout=True)
+            self.goc.remove_gameobject(playerid)
+        self._forget_player(playerid, charactername)
+
+    def _save_characters(self, dt):
+        """ Called once per tick, saves every player in the world each CHARACTER_SAVE_INTERVAL """
+        if dt is None:
+            return
+        self.save_timer -= dt
+        if self.save_timer <= 0:
+            self.save_timer = CHARACTER_SAVE_INTERVAL
+            for gameobject in self.goc.players.values():
+                self.characters.save(gameobject, self.goc)
+
+    def _forget_player(self, playerid, charactername):
+        """ Throw away per-client state kept for a player who has logged out """
+        self.server.close_session(playerid)
+        self.snapshots.pop(playerid, None)
+        self.interest.pop(playerid, None)
+        self.broadcastque.discard(charactername)
+        self.payloadque.discard(charactername)
 
     def test(self, request):
         """ Simple socket test.  Send a message back and forth from client to server """
         playername = request['username']
         return {'status': 0, 'response': {'message': 'Hello {0}!'.format(playername)}}
 
+    def metrics(self, request):
+        """ Admin only, server statistics per request type and tick phase, see mp/metrics.py
+        Request like: {... 'request': 'metrics', 'args': {'enable': <bool>, 'reset': <bool>, 'dump': <bool>}}, every
+        key optional, args may be None
+        Return data like: {'status': 0, 'response': <Metrics.report()>} reported before any reset """
+        if request['username'] not in ADMIN_USERS:
+            return {'status': -1, 'response': {'message': 'Admin only request'}}
+        metrics = self.server.metrics
+        args = request['args'] or {}
+        if 'enable' in args:
+            metrics.enabled = bool(args['enable'])
+        report = metrics.report()
+        if args.get('dump') and metrics.dump_file:
+            metrics.dump()
+        if args.get('reset'):
+            metrics.reset()
+        return {'status': 0, 'response': report}
+
     def evaluate(self, request):
-        """ Allows client to get variable values from GOC, debugging only """
+        """ Allows client to get variable values from GOC, debugging only, admins only """
+        if request['username'] not in ADMIN_USERS:
+            return {'status': -1, 'response': {'message': 'Admin only request'}}
         result = eval('self.goc.{0}'.format(request['args']))
         return {'status': 0, 'response': {'message': result}}
 
@@ -285,6 +841,19 @@ class GameServer(object):
         self.processor = RequestProcessor(self.goc, self)
         self.server = None
 
+        # Connection table like {<client socket>: <ClientConnection>, ... }
+        self.connections = {}
+        # Session table like {<token>: <Session>, ... }, and the token each logged in player holds {<playerid>: <token>}
+        self.sessions = {}
+        self.session_tokens = {}
+
+        # Per request type / tick phase statistics
+        self.metrics = Metrics(METRICS_ENABLED, METRICS_FILE, METRICS_DUMP_INTERVAL)
+
+        # mp.shard.ShardRouter when rooms are simulated in worker processes, requests are then forwarded to the
+        # shard holding the player rather than handled against self.goc
+        self.router = None
+
         with open(USER_LIST, 'r') as f:
             self.user_data = json.load(f)
 
@@ -295,126 +864,342 @@ class GameServer(object):
     def server_start(self):
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server.bind(('', 4000))
+        server.bind(('', PORT))
         # Kill any zombie connection:
         # ps - fA | grep python
         server.listen(5)
+        server.setblocking(0)
         self.server = server
         atexit.register(self.server_stop)
 
     def server_stop(self):
+        for client in list(self.connections):
+            self.drop_connection(client)
+        self.processor.characters.close()
         if self.server:
             self.server.close()
             self.server = None
 
+    def update(self, dt=None):
+        """ Service the network once per tick, never blocks """
+        self.network_ingest(dt)
+        self.network_flush(dt)
+
+    def network_ingest(self, dt=None):
+        """ Tick phase: accept clients, read whatever has arrived and apply the queued requests, never blocks """
+        self.accept_clients()
+        self.ingest()
+        self.process_pending()
+        if self.router:
+            self.router.receive()
+
+    def network_flush(self, dt=None):
+        """ Tick phase: queue room state pushes and write out everything queued for the clients, never blocks """
+        self.push(dt)
+        self.flush()
+        self.metrics.update(dt)
+        if self.router is None:
+            self.processor._save_characters(dt)
+
     def get_clients(self):
+        """ Accept any new connections into the connection table, return every open client socket """
+        self.accept_clients()
+        return list(self.connections)
+
+    def listen(self, clients=None, timeout=0.05):
+        """
+        Service every tracked connection, waiting up to timeout for requests to arrive.  For driving the server
+        standalone (see regression.py), GameController uses update() once per tick instead.
+        :param clients: unused, every connection in the connection table is serviced
+        """
+        self.accept_clients()
+        if not self.connections:
+            # Nothing to read yet, wait for someone to connect instead
+            select.select([self.server], [], [], timeout)
+            self.accept_clients()
+        self.ingest(timeout)
+        self.process_pending()
+        if self.router:
+            self.router.receive()
+        self.push()
+        self.flush()
+
+    def accept_clients(self):
+        """ Accept every pending connection without blocking and add it to the connection table """
         if not self.server:
             self.server_start()
+        while True:
+            try:
+                client, Informations = self.server.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connections[client] = ClientConnection(client, Informations, self.metrics)
+
+    def ingest(self, timeout=0):
+        """ Read from every client with data waiting and queue decoded requests for process_pending """
+        if not self.connections:
+            return
+        try:
+            readable, wlist, xlist = select.select(list(self.connections), [], [], timeout)
+        except select.error:
+            return
+        for client in readable:
+            connection = self.connections.get(client)
+            if connection is None:
+                continue
+            try:
+                messages = connection.receive()
+            except (EOFError, socket.error, ProtocolError):
+                # Client hung up, or sent something we cannot read
+                print('Socket closed with client')
+                self.drop_connection(client)
+                continue
+            for msg_type, request in messages:
+                if msg_type != MSG_REQUEST or not isinstance(request, dict):
+                    print('--Client sent unexpected message of type {0}, disconnecting'.format(msg_type))
+                    self.drop_connection(client)
+                    break
+                if connection.compressor is None and request.get('compress'):
+                    connection.compressor = Compressor()
+                self.admit(connection, request)
+
+    def admit(self, connection, request):
+        """ Queue a request for the tick if the client is within its rate limits and queue size, otherwise answer it
+        with an error straight away """
+        now = default_timer()
+        name = request.get('request')
+        if name not in REQUESTS:
+            # Checked before rate limiting, the limiter keys its buckets by name
+            self.respond(connection, request, {'status': -1, 'response': {
+                'message': 'Unknown request: {0!r}'.format(name)}})
+            return
+        session = self.session_for(request['token']) if 'token' in request else None
+        limiter = session.limiter if session is not None else connection.limiter
+        if not limiter.allow(name, now):
+            self.respond(connection, request, {'status': -1, 'response': {
+                'message': 'Rate limit exceeded: {0}'.format(name)}})
+            return
+        if name == 'batch' and isinstance(request.get('args'), list):
+            for sub_request in request['args']:
+                # Unknown sub-requests are refused by batch itself
+                if (isinstance(sub_request, dict) and sub_request.get('request') in REQUESTS and
+                        not limiter.allow(sub_request['request'], now)):
+                    sub_request['limited'] = True
+        error = connection.inbound.push(request)
+        if error is not None:
+            self.respond(connection, request, {'status': -1, 'response': {'message': error}})
+
+    def process_pending(self):
+        """ Apply queued requests to the GOC and queue the responses, called between simulation ticks.  Each client
+        gets at most REQUESTS_PER_TICK requests processed per tick so a flood from one cannot stretch the tick """
+        for client, connection in list(self.connections.items()):
+            for i in range(min(len(connection.inbound), REQUESTS_PER_TICK)):
+                if client not in self.connections:
+                    # Dropped while its requests were queued
+                    break
+                request = connection.inbound.popleft()
+                start = default_timer() if self.metrics.enabled else None
+                try:
+                    payload = self.process_request(request, connection)
+                except Exception as e:
+                    # Whatever a client sends, it must not stop the tick
+                    print('Failed to process request {0!r}: {1!r}'.format(request.get('request'), e))
+                    payload = {'status': -1, 'response': {'message': 'Unable to process request, was it malformed?'}}
+                if payload is None:
+                    # Forwarded to a room shard, ShardRouter responds once the shard answers
+                    continue
+                self.respond(connection, request, payload, start)
 
-        clients = []
-        Connections, wlist, xlist = select.select([self.server], [], [], 0.05)
+    def respond(self, connection, request, payload, start=None):
+        """ Queue the response to a processed request
+        :param start: default_timer() when processing started, for metrics """
+        if isinstance(payload, dict):
+            self.track_session(connection, request, payload)
+            # Echo request_id so the client can match the response to its request
+            if 'request_id' in request:
+                payload['request_id'] = request['request_id']
+        size = self.send_payload(connection, payload)
+        for request_id in request.get('coalesced', ()):
+            # Requests this one replaced in the queue
+            self.send_payload(connection, dict(payload, request_id=request_id))
+        if start is not None and self.metrics.enabled:
+            self.metrics.record_request(request.get('request'), (default_timer() - start) * 1000., size,
+                                        payload.get('status') if isinstance(payload, dict) else None)
+        if not connection.session:
+            connection.closing = True
 
-        for Connection in Connections:
-            client, Informations = Connection.accept()
-            clients.append(client)
+    def push(self, dt=None):
+        """ Queue room state for every subscribed client whose push timer is due, called at the end of a tick.  Room
+        shards push for their own players, see mp/shard.py """
+        if self.router:
+            return
+        metrics = self.metrics
+        for connection in list(self.connections.values()):
+            subscription = connection.subscription
+            if subscription is None or connection.playerid is None:
+                continue
+            if len(connection.outbound) > PUSH_BACKLOG:
+                # Client is not keeping up, the next push it has room for carries the latest state anyway
+                continue
+            if metrics.enabled:
+                start = default_timer()
+            body = self.processor._push_state(connection.playerid, connection.charactername, subscription, dt)
+            if body is None:
+                continue
+            connection.queue_message(MSG_PUSH, body)
+            if metrics.enabled:
+                metrics.record_request('push', (default_timer() - start) * 1000., len(body))
 
-        return clients
+    def connection_for(self, playerid):
+        """ Session connection the given player is logged in over, None if there isn't one """
+        for connection in self.connections.values():
+            if connection.playerid == playerid and playerid is not None:
+                return connection
+        return None
+
+    def flush(self):
+        """ Write queued responses to every client that can take them without blocking """
+        pending = [client for client, connection in self.connections.items() if connection.outbound]
+        if pending:
+            try:
+                rlist, writable, xlist = select.select([], pending, [], 0)
+            except select.error:
+                writable = []
+            for client in writable:
+                try:
+                    self.connections[client].flush()
+                except socket.error:
+                    print('Socket closed with client')
+                    self.drop_connection(client)
+        for client, connection in list(self.connections.items()):
+            if connection.closing and not connection.outbound:
+                self.drop_connection(client)
+            elif len(connection.outbound) > OUTBOUND_LIMIT:
+                print('Client {0} is not reading its responses, disconnecting'.format(connection.address))
+                self.drop_connection(client)
+
+    def drop_connection(self, client):
+        """ Close client socket and remove it from the connection table, logging out any character bound to it """
+        connection = self.connections.pop(client, None)
+        if connection and connection.playerid is not None and self.router:
+            self.router.drop_player(connection.playerid)
+            connection.unbind()
+        elif connection and connection.playerid is not None:
+            if connection.charactername in self.goc.players_by_name:
+                print('Session for {0} closed, removing gameobject with id: {1}'.format(connection.charactername,
+                                                                                    connection.playerid))
+                self.processor._remove_player(connection.playerid, connection.charactername)
+            else:
+                self.processor._forget_player(connection.playerid, connection.charactername)
+            connection.unbind()
+        client.close()
+
+    def track_session(self, connection, request, payload):
+        """ Bind or unbind a character to the client's connection after a successful login / logout """
+        connection.session = bool(request.get('session'))
+        if request['request'] == 'login' and payload.get('status') == 0:
+            # Only failed logins count against the login rate limit, it is there to slow down password guessing
+            connection.limiter.refund('login')
+        if not connection.session or payload.get('status') != 0:
+            return
+        if request['request'] == 'login':
+            connection.bind(payload['response']['id'], request['charactername'])
+        elif request['request'] == 'logout':
+            connection.unbind()
 
     def logout_client(self, request):
         """
         Delete player instance from room and delete remote client instance from remote_clients dict
-        :param request: dictionary containing 'username', 'password' and 'charactername'
+        :param request: dictionary containing 'token', or 'username', 'password' and 'charactername'
         :return:
         """
-        charactername = request['charactername']
-        username = request['username']
-        password = request['password']
+        return self.process_request(dict(request, request='logout', args=None))
 
-        with open('mp/users/{0}'.format(USER_LIST), 'r') as f:
-            userdata = json.load(f)
-            f.close()
-        current_user = userdata[username]
-        if current_user['password'] != password:
-            return {'status': -1, 'response': 'Password was invalid, or character/user does not exist'}
-
-        # check that user is logged in
-        if charactername not in self.goc.playernames:
-            print('Cannot logout, user is not logged in')
-            return {'status': -1, 'response': 'User is not logged in'}
-        # save character
-        # todo All this stuff
-        # logout character
-
-    def listen(self, clients):
-        try:
-            clients_list, wlist, xlist = select.select(clients, [], [], 0.05)
-        except select.error:
-            pass
-        else:
-            for client in clients_list:
-                print('--Client conneted, listening...')
-                request = self.receive_packet(client, BUFFER_SIZE)
-                if request:
-                    if request == -1:
-                        print('--Client returned error, disconnecting')
-                        client.close()
-                    else:
-                        try:
-                            payload = self.process_request(request)
-                        except RuntimeError:
-                            payload = {'status': -1, 'response': 'Unable to process request, was it malformed?'}
-                        payload_string = str(payload)
-                        payload = pickle.dumps(payload)
-                        buffer_size = sys.getsizeof(payload)
-                        response = pickle.dumps(buffer_size)
-
-                        if VERBOSE: print('--Sending buffer size: {0}'.format(buffer_size))
-                        client.send(response)
-
-                        # Wait for confirmation from client for buffer size
-                        if VERBOSE: print('--awaiting client response to send payload')
-                        client_response = self.receive_packet(client, 128)
-
-                        if client_response:
-                            if VERBOSE: print('--client response to send payload received:{0}'.format(client_response))
-                            if client_response == buffer_size:
-                                if VERBOSE: print('--Sending payload (size): {0}'.format(buffer_size))
-                                if VERBOSE: print('--Sending payload data: {0}'.format(payload_string))
-                                client.send(payload)
-                            elif client_response == -1:
-                                print('--Received error message from client')
-
-                        # Client needs to confirm that it received payload
+    def player_online(self, charactername):
+        """ True if the character is logged in """
+        if self.router:
+            return self.router.player_online(charactername)
+        return charactername in self.goc.players_by_name
 
-                print('Socket closed with client')
-                client.close()
+    def room_exists(self, uniquename):
+        if self.router:
+            return uniquename in self.router.room_shards
+        return uniquename in self.goc.rooms
 
-    @staticmethod
-    def receive_packet(client, buffer_size):
-        packet = client.recv(buffer_size)
-        if packet:
-            data = pickle.loads(packet)
-            if data == -1:
-                return -1
-            else:
-                print('received data:\n{0}'.format(data))
-                return data
-        else:
-            return None
+    def open_session(self, playerid, username, charactername):
+        """ Start a session for a character that has just logged in, returns the token the client should send """
+        self.close_session(playerid)
+        token = binascii.hexlify(os.urandom(16)).decode('ascii')
+        self.sessions[token] = Session(token, playerid, username, charactername)
+        self.session_tokens[playerid] = token
+        return token
 
-    def process_request(self, request):
-        """ Receive client request, process and form the Payload to be returned """
-        # If request is in valid format
-        if {'username', 'charactername', 'password', 'request', 'id', 'args'} == set(request.keys()):
-            if self.authenticate_credentials(request):
+    def close_session(self, playerid):
+        """ Invalidate the token held by the given player, if any """
+        token = self.session_tokens.pop(playerid, None)
+        if token is not None:
+            del self.sessions[token]
 
-                return self.processor.get_payload(request)
+    @staticmethod
+    def send_payload(connection, payload):
+        """ Queue payload to be sent to the client as a single response frame, returns the size of the encoded body """
+        if VERBOSE: print('--Sending payload data: {0}'.format(payload))
+        try:
+            body = encode(payload)
+        except ProtocolError as e:
+            # Payload held something the codec cannot represent, tell the client rather than leaving it hanging
+            error = {'status': -1, 'response': {'message': 'Response could not be encoded: {0}'.format(e)}}
+            if isinstance(payload, dict) and 'request_id' in payload:
+                error['request_id'] = payload['request_id']
+            body = encode(error)
+        connection.queue_message(MSG_RESPONSE, body)
+        return len(body)
+
+    def process_request(self, request, connection=None):
+        """ Receive client request, process and form the Payload to be returned.  Returns None if the request was
+        forwarded to a room shard, the response is then sent when the shard answers """
+        # Requests from a logged in client carry just the token handed out at login, one lookup authenticates them
+        if 'token' in request:
+            if not {'request', 'args'} <= set(request.keys()):
+                raise RuntimeError('Request is not in valid format\n'
+                                   'should be dictionary with keys:\n '
+                                   '"token", "request", "args"')
+            session = self.session_for(request['token'])
+            if session is None:
+                return {'status': -1, 'response': {'message': 'Session token invalid, login again'}}
+            request['id'] = session.playerid
+            request['username'] = session.username
+            request['charactername'] = session.charactername
+            return self.dispatch(request, connection)
 
+        # If request is in valid format, 'request_id' and 'session' are optional
+        if {'username', 'charactername', 'password', 'request', 'id', 'args'} <= set(request.keys()):
+            if self.authenticate_credentials(request):
+                return self.dispatch(request, connection)
+            else:
+                return {'status': -1, 'response': {'message': 'Credentials invalid'}}
         else:
             raise RuntimeError('Request is not in valid format\n'
                                'should be dictionary with keys:\n '
                                '"username", "charactername", "password", "request", "args"')
 
+    def session_for(self, token):
+        """ Session holding token, None if there isn't one or token isn't something a token could be """
+        try:
+            return self.sessions.get(token)
+        except TypeError:
+            # Unhashable, a list or dict sent as the token
+            return None
+
+    def dispatch(self, request, connection=None):
+        """ Hand an authenticated request to the RequestProcessor, or to the room shard holding the player """
+        if self.router and connection is not None and request['request'] not in ROUTER_REQUESTS:
+            return self.router.forward(connection, request)
+        return self.processor.get_payload(request)
+
     def authenticate_credentials(self, request):
         username = request['username']
         password = request['password']
@@ -0,0 +1,371 @@
+"""
+Room sharding, rooms are simulated in worker processes so a server isn't held to one core by the GIL
+
+GameServer stays the only endpoint clients talk to.  With a ShardRouter set as GameServer.router it keeps
+authentication, sessions and the client sockets, and forwards every other request to the shard holding the player.
+Each shard is a ShardWorker running its own GameObjectController with some of the rooms, its own RequestProcessor
+and its own fixed timestep loop, and pushes room state for its subscribed players back through the router.
+
+When a player's change_room takes them to a room on another shard their gameobject is pickled and handed over,
+through the router, to the shard that owns the room.
+
+Messages between router and shards are tuples sent over a multiprocessing Pipe:
+    router -> shard: ('rooms', {<room>: <shard index>}), ('request', <ticket>, <request>),
+                     ('handoff', <playerid>, <state>), ('deliver', <que>, <item>, <target>),
+                     ('online', <charactername>, <bool>), ('resync', <playerid>), ('stop',)
+    shard -> router: ('ready', [<room>, ... ]), ('response', <ticket>, <payload>), ('push', <playerid>, <body>),
+                     ('handoff', <playerid>, <state>), ('deliver', <que>, <item>, <target>)
+"""
+import multiprocessing
+import pickle
+from timeit import default_timer
+
+from mp.metrics import Metrics
+from mp.protocol import MSG_PUSH
+from mp.server import RequestProcessor, Subscription, START_ROOM, PUSH_BACKLOG
+from scheduler import TickScheduler, TICK_RATE
+
+
+# Id slots each shard hands out, shard n allocates from slot n * SHARD_ID_RANGE, room for 16 shards
+SHARD_ID_RANGE = 1 << 20
+# Seconds to wait for a shard to exit when stopping before it is terminated
+SHARD_STOP_TIMEOUT = 5
+
+
+def run_shard(index, pipe, templates, tick_rate=TICK_RATE):
+    """ Entry point of a shard process """
+    ShardWorker(index, pipe, templates, tick_rate).run()
+
+
+class PlayerLink(object):
+    """ Stands in for a player's ClientConnection inside a shard, holds their push subscription """
+    def __init__(self, playerid, charactername):
+        self.playerid = playerid
+        self.charactername = charactername
+        self.subscription = None
+
+
+class ShardWorker(object):
+    """
+    Simulates some of the rooms in its own process and answers requests forwarded by ShardRouter.  Stands in for
+    GameServer as the RequestProcessor's server: the router has already authenticated every request and owns the
+    session tokens, so those parts are no-ops here.
+    """
+    def __init__(self, index, pipe, templates, tick_rate=TICK_RATE):
+        from gameobjects.gameobject import GameObjectController
+        from gameobjects.idallocator import IdAllocator
+        self.index = index
+        self.pipe = pipe
+        self.goc = GameObjectController(None)
+        self.goc.ids = IdAllocator(index * SHARD_ID_RANGE, SHARD_ID_RANGE)
+        for template in templates:
+            self.goc.add_room(template)
+
+        self.processor = RequestProcessor(self.goc, self)
+        self.processor.broadcastque.relay = self.relay_broadcast
+        self.processor.payloadque.relay = self.relay_payload
+        # Batch reads this, requests are measured by the router
+        self.metrics = Metrics()
+
+        # Players simulated here, like {<playerid>: <PlayerLink>, ... }
+        self.players = {}
+        # Characters logged in on any shard
+        self.online = set()
+        # Every room on every shard, like {<room uniquename>: <shard index>, ... }
+        self.rooms = {}
+
+        self.scheduler = TickScheduler(tick_rate)
+        self.scheduler.add_phase('requests', self.receive)
+        self.scheduler.add_phase('simulation', self.goc.update)
+        self.scheduler.add_phase('push', self.push)
+        self.scheduler.add_phase('characters', self.processor._save_characters)
+
+    def run(self):
+        self.pipe.send(('ready', list(self.goc.rooms)))
+        try:
+            self.scheduler.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # Players still here are saved, the character store is shared by every shard
+            for gameobject in self.goc.players.values():
+                self.processor.characters.save(gameobject, self.goc)
+            self.processor.characters.close()
+
+    def receive(self, dt=None):
+        """ Tick phase: handle everything the router has sent """
+        while self.pipe.poll():
+            message = self.pipe.recv()
+            getattr(self, 'on_{0}'.format(message[0]))(*message[1:])
+
+    def push(self, dt=None):
+        """ Tick phase: send room state for every subscribed player whose push timer is due """
+        for link in list(self.players.values()):
+            if link.subscription is None:
+                continue
+            body = self.processor._push_state(link.playerid, link.charactername, link.subscription, dt)
+            if body is not None:
+                self.pipe.send(('push', link.playerid, body))
+
+    def relay_broadcast(self, item, target):
+        """ Broadcast for players on other shards """
+        self.pipe.send(('deliver', 'broadcast', item, target))
+
+    def relay_payload(self, item, target):
+        self.pipe.send(('deliver', 'payload', item, target))
+
+    # Messages from the router
+
+    def on_rooms(self, rooms):
+        self.rooms = rooms
+
+    def on_request(self, ticket, request):
+        try:
+            payload = self.processor.get_payload(request)
+        except Exception as e:
+            # A broken request must not take the whole shard down
+            print('Shard {0} failed to process {1}: {2!r}'.format(self.index, request.get('request'), e))
+            payload = {'status': -1, 'response': {'message': 'Unable to process request'}}
+        self.pipe.send(('response', ticket, payload))
+        playerid = request.get('id')
+        if playerid in self.players:
+            room = self.goc.gameobjects[playerid].current_room
+            if room not in self.goc.rooms and room in self.rooms:
+                self.hand_off(playerid)
+
+    def on_handoff(self, playerid, state):
+        """ A player arriving from another shard """
+        gameobject = pickle.loads(state['gameobject'])
+        self.goc.insert_gameobject(gameobject, gameobject.current_room, gameobject.coords, id=playerid)
+        link = self.players[playerid] = PlayerLink(playerid, state['charactername'])
+        if state['subscribed']:
+            link.subscription = Subscription(state['interval'], state['compact'])
+        for item in state['messages']:
+            self.processor.broadcastque._deliver(item, link.charactername, relay=False)
+        for item in state['payloads']:
+            self.processor.payloadque._deliver(item, link.charactername, relay=False)
+
+    def on_deliver(self, que, item, target):
+        que = self.processor.broadcastque if que == 'broadcast' else self.processor.payloadque
+        que._deliver(item, target, relay=False)
+
+    def on_online(self, charactername, online):
+        if online:
+            self.online.add(charactername)
+        else:
+            self.online.discard(charactername)
+
+    def on_resync(self, playerid):
+        """ The router dropped a push to this player, the next one must be a full snapshot """
+        link = self.players.get(playerid)
+        if link is not None and link.subscription is not None:
+            link.subscription.seq = None
+
+    def on_stop(self):
+        self.scheduler.stop()
+
+    def hand_off(self, playerid):
+        """ Send a player who has moved to a room this shard doesn't have to the router """
+        link = self.players[playerid]
+        gameobject = self.goc.gameobjects[playerid]
+        subscription = link.subscription
+        state = {'charactername': link.charactername, 'room': gameobject.current_room,
+                 'subscribed': subscription is not None,
+                 'interval': subscription.interval if subscription is not None else None,
+                 'compact': subscription.compact if subscription is not None else False,
+                 'messages': self.processor.broadcastque.dump(link.charactername),
+                 'payloads': self.processor.payloadque.dump(link.charactername)}
+        # The id stays taken here, so it can't be given to anyone else while the player is on another shard
+        self.goc.remove_gameobject(playerid, release=False)
+        self.processor._forget_player(playerid, link.charactername)
+        # The receiving shard has its own GOC
+        gameobject.goc = None
+        state['gameobject'] = pickle.dumps(gameobject, protocol=pickle.HIGHEST_PROTOCOL)
+        self.pipe.send(('handoff', playerid, state))
+
+    # GameServer interface used by RequestProcessor
+
+    def authenticate_credentials(self, request):
+        return True
+
+    def open_session(self, playerid, username, charactername):
+        """ The router opens the real session once the login response reaches it """
+        self.players[playerid] = PlayerLink(playerid, charactername)
+        return None
+
+    def close_session(self, playerid):
+        self.players.pop(playerid, None)
+
+    def connection_for(self, playerid):
+        return self.players.get(playerid)
+
+    def player_online(self, charactername):
+        return charactername in self.online
+
+    def room_exists(self, uniquename):
+        return uniquename in self.rooms
+
+
+class ShardHandle(object):
+    """ The router's end of one shard """
+    def __init__(self, index, process, pipe):
+        self.index = index
+        self.process = process
+        self.pipe = pipe
+
+
+class ShardRouter(object):
+    """
+    Runs in the GameServer process, set as GameServer.router.  Starts the shards, forwards requests to the shard
+    holding the player and sends the answers back through GameServer.respond.
+    """
+    def __init__(self, server, templates, shards, tick_rate=TICK_RATE):
+        """
+        :param server: GameServer the clients connect to
+        :param templates: room templates, shared out round robin between the shards
+        :param shards: number of shard processes
+        """
+        self.server = server
+        self.shards = []
+        for index in range(shards):
+            pipe, child_pipe = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=run_shard, name='RoomShard{0}'.format(index),
+                                              args=(index, child_pipe, templates[index::shards], tick_rate))
+            process.daemon = True
+            process.start()
+            self.shards.append(ShardHandle(index, process, pipe))
+
+        # Like {<room uniquename>: <shard index>, ... }
+        self.room_shards = {}
+        for shard in self.shards:
+            kind, rooms = shard.pipe.recv()
+            for room in rooms:
+                self.room_shards[room] = shard.index
+        for shard in self.shards:
+            shard.pipe.send(('rooms', self.room_shards))
+
+        # Shard each logged in player is on, like {<playerid>: <shard index>, ... }
+        self.player_shards = {}
+        # Logged in characters, like {<charactername>: <playerid>, ... } and {<playerid>: <charactername>, ... }
+        self.online = {}
+        self.characternames = {}
+        # Requests waiting on a shard, like {<ticket>: (<ClientConnection>, <request>, <start time or None>), ... }
+        self.forwarded = {}
+        self.ticket = 0
+
+    @property
+    def default_shard(self):
+        """ Shard new players log in to """
+        return self.room_shards.get(START_ROOM, 0)
+
+    def forward(self, connection, request):
+        """ Send a request to the shard holding the player, returns an error payload or None once forwarded """
+        name = request['request']
+        if name == 'login':
+            if request['charactername'] in self.online:
+                return {'status': -1, 'response': {'message': 'Character already logged in'}}
+            index = self.default_shard
+        else:
+            index = self.player_shards.get(request.get('id'), self.default_shard)
+        if name == 'subscribe' and self.server.connection_for(request['id']) is None:
+            return {'status': -1, 'response': {'message': 'Subscribing requires a session connection'}}
+        self.ticket += 1
+        start = default_timer() if self.server.metrics.enabled else None
+        self.forwarded[self.ticket] = (connection, request, start)
+        self.shards[index].pipe.send(('request', self.ticket, request))
+        return None
+
+    def receive(self):
+        """ Handle everything the shards have sent, called once per tick """
+        for shard in self.shards:
+            while shard.pipe.poll():
+                message = shard.pipe.recv()
+                getattr(self, 'on_{0}'.format(message[0]))(shard, *message[1:])
+
+    def on_response(self, shard, ticket, payload):
+        connection, request, start = self.forwarded.pop(ticket, (None, None, None))
+        if request is None:
+            # Answer to a request the router made itself, e.g. logging out a dropped client
+            return
+        if isinstance(payload, dict) and payload.get('status') == 0:
+            if request['request'] == 'login':
+                playerid = payload['response']['id']
+                self.player_shards[playerid] = shard.index
+                self.set_online(request['charactername'], playerid)
+                payload['response']['token'] = self.server.open_session(playerid, request['username'],
+                                                                        request['charactername'])
+                if connection.client not in self.server.connections:
+                    # Client went away while logging in
+                    self.drop_player(playerid)
+                    return
+            elif request['request'] == 'logout':
+                self.forget_player(request['id'])
+        if connection.client in self.server.connections:
+            self.server.respond(connection, request, payload, start)
+
+    def on_push(self, shard, playerid, body):
+        # The subscription itself is kept by the shard
+        connection = self.server.connection_for(playerid)
+        if connection is None:
+            return
+        if len(connection.outbound) > PUSH_BACKLOG:
+            # Client is not keeping up, later deltas would build on this one so ask for a full snapshot next
+            shard.pipe.send(('resync', playerid))
+            return
+        connection.queue_message(MSG_PUSH, body)
+
+    def on_handoff(self, shard, playerid, state):
+        index = self.room_shards[state['room']]
+        self.player_shards[playerid] = index
+        self.shards[index].pipe.send(('handoff', playerid, state))
+
+    def on_deliver(self, shard, que, item, target):
+        if target == 'ALL':
+            indexes = [other.index for other in self.shards if other is not shard]
+        elif target in self.online:
+            indexes = [self.player_shards[self.online[target]]]
+        else:
+            return
+        for index in indexes:
+            self.shards[index].pipe.send(('deliver', que, item, target))
+
+    def drop_player(self, playerid):
+        """ Log out a player whose client went away """
+        charactername = self.characternames.get(playerid)
+        index = self.player_shards.get(playerid)
+        if charactername is not None and index is not None:
+            print('Session for {0} closed, logging out id: {1}'.format(charactername, playerid))
+            request = {'request': 'logout', 'args': None, 'id': playerid, 'charactername': charactername}
+            self.shards[index].pipe.send(('request', None, request))
+        self.forget_player(playerid)
+
+    def forget_player(self, playerid):
+        charactername = self.characternames.get(playerid)
+        if charactername is not None:
+            self.set_online(charactername, None)
+        self.player_shards.pop(playerid, None)
+        self.server.close_session(playerid)
+
+    def set_online(self, charactername, playerid):
+        """ Tell every shard a character logged in (playerid) or out (None) """
+        if playerid is None:
+            self.characternames.pop(self.online.pop(charactername, None), None)
+        else:
+            self.online[charactername] = playerid
+            self.characternames[playerid] = charactername
+        for shard in self.shards:
+            shard.pipe.send(('online', charactername, playerid is not None))
+
+    def player_online(self, charactername):
+        return charactername in self.online
+
+    def stop(self):
+        for shard in self.shards:
+            try:
+                shard.pipe.send(('stop',))
+            except (IOError, OSError):
+                pass
+        for shard in self.shards:
+            shard.process.join(SHARD_STOP_TIMEOUT)
+            if shard.process.is_alive():
+                shard.process.terminate()
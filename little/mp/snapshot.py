@@ -0,0 +1,106 @@
+"""
+Compact room snapshot encoding
+
+A delta from SnapshotHistory holds a tuple and a coords list per gameobject.  The compact form packs the same delta
+into a few contiguous typed arrays, sent as byte strings, and replaces sprite paths with small integers:
+    {'seq': 5, 'baseline': 4,
+     'sprites': {<sprite id>: <sprite path>, ... },   only sprites this client has not been sent before
+     'added': {'ids': <int32 ids>, 'sprites': <uint16 sprite ids>, 'coords': <int32 x, y, x, y, ...>},
+     'moved': {'ids': <int32 ids>, 'coords': <int32 x, y, x, y, ...>},
+     'removed': <int32 ids>}
+Arrays are little endian on the wire, coordinates are whole pixels.  unpack_delta turns the byte strings back into
+arrays, the client indexes into them directly rather than rebuilding a dictionary per gameobject.
+"""
+import sys
+from array import array
+
+
+ID_TYPE = 'i'
+COORD_TYPE = 'i'
+SPRITE_TYPE = 'H'
+
+# The wire is little endian, swap on big endian machines
+_SWAP = sys.byteorder == 'big'
+
+
+def pack_array(typecode, values):
+    """ Byte string holding values as a typed array """
+    packed = array(typecode, values)
+    if _SWAP:
+        packed.byteswap()
+    if hasattr(packed, 'tobytes'):
+        return packed.tobytes()
+    return packed.tostring()
+
+
+def unpack_array(typecode, data):
+    """ Typed array from a byte string created by pack_array """
+    unpacked = array(typecode)
+    if hasattr(unpacked, 'frombytes'):
+        unpacked.frombytes(data)
+    else:
+        unpacked.fromstring(data)
+    if _SWAP:
+        unpacked.byteswap()
+    return unpacked
+
+
+class SpriteTable(object):
+    """ Interns sprite paths to small integer ids, shared by every client of one RequestProcessor """
+    def __init__(self):
+        # Like {<sprite path>: <sprite id>, ... }
+        self.ids = {}
+        self.paths = []
+
+    def intern(self, path):
+        id = self.ids.get(path)
+        if id is None:
+            id = self.ids[path] = len(self.paths)
+            self.paths.append(path)
+        return id
+
+
+def pack_delta(delta, sprites, sent):
+    """
+    Compact form of a SnapshotHistory delta
+    :param delta: delta as returned by SnapshotHistory.delta
+    :param sprites: SpriteTable
+    :param sent: set of sprite ids this client has already been sent, updated in place
+    """
+    new_sprites = {}
+    added_ids, added_sprites, added_coords = [], [], []
+    for id, (sprite, coords) in delta['added'].items():
+        sprite_id = sprites.intern(sprite)
+        if sprite_id not in sent:
+            sent.add(sprite_id)
+            new_sprites[sprite_id] = sprite
+        added_ids.append(id)
+        added_sprites.append(sprite_id)
+        added_coords.append(int(coords[0]))
+        added_coords.append(int(coords[1]))
+    moved_ids, moved_coords = [], []
+    for id, coords in delta['moved'].items():
+        moved_ids.append(id)
+        moved_coords.append(int(coords[0]))
+        moved_coords.append(int(coords[1]))
+    return {'seq': delta['seq'], 'baseline': delta['baseline'], 'sprites': new_sprites,
+            'added': {'ids': pack_array(ID_TYPE, added_ids), 'sprites': pack_array(SPRITE_TYPE, added_sprites),
+                      'coords': pack_array(COORD_TYPE, added_coords)},
+            'moved': {'ids': pack_array(ID_TYPE, moved_ids), 'coords': pack_array(COORD_TYPE, moved_coords)},
+            'removed': pack_array(ID_TYPE, delta['removed'])}
+
+
+def unpack_delta(delta):
+    """ Replace the byte strings in a compact delta with typed arrays, in place, returns the delta """
+    added, moved = delta['added'], delta['moved']
+    added['ids'] = unpack_array(ID_TYPE, added['ids'])
+    added['sprites'] = unpack_array(SPRITE_TYPE, added['sprites'])
+    added['coords'] = unpack_array(COORD_TYPE, added['coords'])
+    moved['ids'] = unpack_array(ID_TYPE, moved['ids'])
+    moved['coords'] = unpack_array(COORD_TYPE, moved['coords'])
+    delta['removed'] = unpack_array(ID_TYPE, delta['removed'])
+    return delta
+
+
+def is_compact(delta):
+    return 'sprites' in delta
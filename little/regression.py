@@ -1,13 +1,35 @@
 from gameobjects.gameobject import *
 
+import json
+import math
 import multiprocessing
+import os
+import pickle
+import shutil
+import socket
+import tempfile
+import threading
 import time
 import pprint
+import random
+import select
+from checkpoint import Checkpointer, CheckpointError, read_checkpoint, snapshot, write_checkpoint
 from gamecontroller import GameController
-from mp import client, server
+from gameobjects.idallocator import IdAllocator, ID_GENERATION_STRIDE, ID_GENERATIONS
+from gameobjects.spatialhash import SpatialHash
+from local.interpolation import InterpolationBuffer, MAX_EXTRAPOLATION, SNAP_DISTANCE
+from local.remote_gameobject import Hero, RemoteSpriteController
+from mp import client, metrics, protocol, server
+from mp.snapshot import SpriteTable, is_compact, pack_delta, unpack_delta
+from scheduler import TickScheduler
 from little import *
 
 from mp.client import ServerResponseError
+from mp.shard import ShardRouter
+
+# Characters the tests log in and out are saved to a scratch database rather than the player database
+SCRATCH_DIR = tempfile.mkdtemp()
+server.CHARACTER_DB = os.path.join(SCRATCH_DIR, 'characters.db')
 
 
 def time_command(function, args):
@@ -62,7 +84,7 @@ def gameobjectcontroller_test():
         except AttributeError:
             print(None)
 
-    print(' Creating 30 More Lifeforms from template, should fill gaps, and id on class should match id in hash table')
+    print(' Creating 30 More Lifeforms from template, should reuse ids, and id on class should match id in hash table')
     for i in range(0, 30):
         instance, id = GOC.add_gameobject('gameobjects/lifeform/template.lfm', 'template_room', [5, 5])
 
@@ -80,8 +102,7 @@ def gameobjectcontroller_test():
     print('STRESS TEST!!! CREATING 10000 Lifeforms')
 
     def add_gameobjects(template):
-        for i in range(0, 1000):
-            GOC.add_gameobject(template)
+        GOC.add_gameobjects([(template, None, None)] * 1000)
     time_command(add_gameobjects, 'gameobjects/lifeform/template.lfm')
 
 
@@ -150,8 +171,11 @@ def client_server_test():
     # Constants:
     # Amount of times to loop through each client sending test request
     amount = 1000
+    # Each client is held to the server's rate limit for "test" requests, stay just under it
+    rate, burst = server.RATE_LIMITS.get('test', server.DEFAULT_RATE_LIMIT)
 
-    print('Attempting to create 6 clients, and spam {0} "test" requests per client'.format(amount))
+    print('Attempting to create 6 clients, and send {0} "test" requests per client at {1} a second'.format(amount,
+                                                                                                          rate))
     gameserver = server.GameServer()
     s = multiprocessing.Process(target=server_listen, name="Listen", args=())
     s.start()
@@ -161,6 +185,7 @@ def client_server_test():
         clients.append(client.GameClient(charactername='Test{0}'.format(i), username='test{0}'.format(i)))
     error_messages = []
     for i in range(0, amount):
+        started = time.time()
         for gameclient in clients:
             response = gameclient.send('test')
             if 'Hello' not in response['response']['message']:
@@ -169,7 +194,18 @@ def client_server_test():
                     error_messages.append(response['response']['message'])
                 else:
                     raise RuntimeError('Did not get hello response from server or error msg')
+        time.sleep(max(0, 1.1 / rate - (time.time() - started)))
     print('Errors that occured:\n{0}'.format(error_messages))
+    print('Sending {0} "test" requests at once from one client, those past the burst should be refused'.format(
+        2 * burst))
+    refused = 0
+    for i in range(0, 2 * burst):
+        try:
+            clients[0].send('test')
+        except ServerResponseError:
+            refused += 1
+    print('{0} refused'.format(refused))
+    assert refused > 0
     time.sleep(2)
     s.terminate()
     s.join()
@@ -179,7 +215,7 @@ def gamecontroller_test_basic():
     print('-----------------------')
     print('Test 1 - Create GC, Add a room, Login player and verify player is added properly')
     print('Instantiating GameController')
-    gc = GameController()
+    gc = GameController(checkpoint_dir=None)
     # Start server on GC
     s = multiprocessing.Process(target=gc.run, name="Run", args=())
     s.start()
@@ -238,8 +274,8 @@ def gamecontroller_test_basic():
     # Constants #
     amount = 200
 
-    gc = GameController()
-    gc.goc._gameobjects = {}
+    gc = GameController(checkpoint_dir=None)
+    gc.goc.replace_gameobjects({})
     s = multiprocessing.Process(target=gc.run, name="Run", args=())
     s.start()
     time.sleep(2)
@@ -258,7 +294,7 @@ def gamecontroller_test_basic():
     print('-----------------------')
     print('Test 4 - Coordinates, verify coordinate updates')
     print('Instantiating GameController')
-    gc = GameController()
+    gc = GameController(checkpoint_dir=None)
     gc.goc.add_room('gameobjects/room/template.rm')
     # Start server on GC
     s = multiprocessing.Process(target=gc.run, name="Run", args=())
@@ -272,7 +308,7 @@ def gamecontroller_test_basic():
 
 
 def current_room_test():
-    gc = GameController()
+    gc = GameController(checkpoint_dir=None)
     gc.goc.add_room('gameobjects/room/template.rm')
     # Start server on GC
     for id, lf in gc.goc.lifeforms.items():
@@ -291,7 +327,7 @@ def current_room_test():
 def ai_gambits():
     print('-------------------------')
     print('Parse simple precondition: stat HP>10')
-    gc = GameController()
+    gc = GameController(checkpoint_dir=None)
     go, id = gc.goc.add_gameobject('gameobjects/regression/dummy.lfm')
     print(go.ai)
     print(go.aic.data)
@@ -313,6 +349,1382 @@ def ai_gambits():
     assert r is True
 
 
+def login_sav_test():
+    print('-------------------------')
+    print('Login a character from its .sav, the unpickled lifeform still refers to the GOC it was saved from')
+    character_db = server.CHARACTER_DB
+    directory = tempfile.mkdtemp()
+    server.CHARACTER_DB = os.path.join(directory, 'characters.db')
+    try:
+        goc = GameObjectController(None)
+        gameserver = server.GameServer(goc)
+        request = {'username': 'ken', 'password': 'mypw', 'charactername': 'Zaxim', 'id': None, 'request': 'login',
+                   'args': None}
+        response = gameserver.processor.login(dict(request))
+        print(response)
+        assert response['status'] == 0
+        id = response['response']['id']
+        player = goc.gameobjects[id]
+        assert player.goc is goc
+        assert goc.players_by_name['Zaxim'] is player
+        assert id in goc.room_gameobjects(player.current_room)
+        assert player in goc.spatial_hash(player.current_room)
+        player.coords = [24, 24]
+        response = gameserver.processor.logout(dict(request, id=id, request='logout'))
+        assert response['status'] == 0
+        assert id not in goc.gameobjects
+        gameserver.processor.characters.close()
+    finally:
+        server.CHARACTER_DB = character_db
+        shutil.rmtree(directory)
+    print('Logged in and out from the .sav')
+
+
+def checkpoint_test():
+    print('-------------------------')
+    print('Checkpoint a world whose AI has run, restore it into a new GOC')
+    directory = tempfile.mkdtemp()
+    try:
+        goc = GameObjectController(None)
+        goc.add_room(START_ROOM)
+        for i in range(0, 3):
+            goc.update(16)
+        assert [lf for lf in goc.lifeforms.values() if lf.aic and lf.aic.state]
+        checkpointer = Checkpointer(directory, None)
+        assert checkpointer.start(goc)
+        checkpointer.wait()
+        assert checkpointer.failures == 0
+
+        restored = GameObjectController(None)
+        restored.add_room(START_ROOM)
+        restored.replace_gameobjects(read_checkpoint(directory, restored))
+        assert sorted(restored.gameobjects) == sorted(goc.gameobjects)
+        for id, lifeform in restored.lifeforms.items():
+            print(id, lifeform.coords, lifeform.aic.state)
+            assert lifeform.coords == goc.gameobjects[id].coords
+            assert dict(lifeform.stats) == dict(goc.gameobjects[id].stats)
+            assert lifeform.goc is restored and lifeform.aic.lifeform is lifeform
+            if lifeform.aic.state is not None:
+                assert lifeform.aic.state.__self__ is lifeform.aic
+        restored.update(16)
+
+        print('Only changed gameobjects are written again')
+        number, written, size = write_checkpoint(directory, snapshot(goc))
+        assert written == 0
+        lifeform = list(goc.lifeforms.values())[0]
+        lifeform.coords = [lifeform.coords[0] + 8, lifeform.coords[1]]
+        number, written, size = write_checkpoint(directory, snapshot(goc))
+        assert written == 1
+        assert read_checkpoint(directory, restored)[lifeform.id].coords == lifeform.coords
+
+        failed = False
+        try:
+            read_checkpoint(os.path.join(directory, 'missing'), restored)
+        except CheckpointError:
+            failed = True
+        assert failed is True
+    finally:
+        shutil.rmtree(directory)
+    print('Checkpoint restored')
+
+
+def protocol_test():
+    print('-------------------------')
+    print('Encode and decode every type the protocol carries')
+    values = [None, True, False, 0, -1, 127, -128, 128, 32767, -32769, 2 ** 31 - 1, -2 ** 31 - 1, 2 ** 63 - 1, 1.5,
+              -0.25, b'bytes', u'text \u00e9', [], (), {}, [1, [2, (3, u'four')]],
+              {'status': 0, 'response': {'coords': [160, 160], 'sprite': u'human_0.png', 'ids': (1, 2)}}]
+    for value in values:
+        decoded = protocol.decode(protocol.encode(value))
+        # int and long both come back as whichever fits on Python 2
+        same_type = type(decoded) is type(value) or (isinstance(value, protocol.integer_types) and
+                                                     not isinstance(value, bool))
+        assert decoded == value and same_type, (value, decoded)
+    for value in (2 ** 64, object(), set([1])):
+        failed = False
+        try:
+            protocol.encode(value)
+        except protocol.ProtocolError:
+            failed = True
+        assert failed is True
+    data = protocol.encode([1, 2, 3])
+    for broken in (data[:-1], data + b'N'):
+        failed = False
+        try:
+            protocol.decode(broken)
+        except protocol.ProtocolError:
+            failed = True
+        assert failed is True
+    assert protocol.decode(b'xx' + data + b'yy', 2, 2 + len(data)) == [1, 2, 3]
+
+    print('Malformed bodies raise ProtocolError rather than whatever decoding them ran into')
+    nested = []
+    for i in range(0, protocol.MAX_DEPTH - 1):
+        nested = [nested]
+    assert protocol.decode(protocol.encode(nested)) == nested
+    deep = b'l' + b'\x00\x00\x00\x01'
+    # A list key, text that isn't utf-8, nesting just past MAX_DEPTH and nesting far past the recursion limit
+    for broken in (b'm\x00\x00\x00\x01' + protocol.encode([1]) + protocol.encode(2),
+                   b'u\x00\x00\x00\x02\xff\xfe', protocol.encode([nested]), deep * 100000 + b'N'):
+        failed = False
+        try:
+            protocol.decode(broken)
+        except protocol.ProtocolError:
+            failed = True
+        assert failed is True
+
+    print('FrameDecoder splits a stream arriving a few bytes at a time into whole frames')
+    messages = [{'request_id': i, 'request': 'test', 'args': [u'x' * (i * 500)]} for i in range(0, 20)]
+    stream = b''.join(protocol.pack_frame(protocol.MSG_REQUEST, protocol.encode(message)) for message in messages)
+    a, b = socket.socketpair()
+    try:
+        b.setblocking(False)
+        decoder = protocol.FrameDecoder(buffer_size=64)
+        received = []
+        for offset in range(0, len(stream), 97):
+            a.sendall(stream[offset:offset + 97])
+            while True:
+                try:
+                    if not decoder.recv_from(b):
+                        break
+                except socket.error:
+                    break
+            received.extend(decoder.read_messages())
+        assert received == [(protocol.MSG_REQUEST, message) for message in messages]
+        assert decoder.size == 0
+
+        print('FrameReader reads frames, compressed or not, off a blocking socket')
+        b.setblocking(True)
+        compressor = protocol.Compressor()
+        reader = protocol.FrameReader(b, buffer_size=16)
+        for message in messages:
+            body = protocol.encode(message)
+            if compressor.wanted(body):
+                a.sendall(protocol.pack_frame(protocol.MSG_RESPONSE | protocol.COMPRESSED, compressor.compress(body)))
+            else:
+                a.sendall(protocol.pack_frame(protocol.MSG_RESPONSE, body))
+            assert reader.read_message() == (protocol.MSG_RESPONSE, message)
+        a.sendall(protocol.HEADER.pack(protocol.MAX_FRAME_SIZE + 1, protocol.MSG_REQUEST))
+        failed = False
+        try:
+            reader.read_frame()
+        except protocol.ProtocolError:
+            failed = True
+        assert failed is True
+        a.close()
+        failed = False
+        try:
+            reader.read_frame()
+        except protocol.ConnectionClosed:
+            failed = True
+        assert failed is True
+    finally:
+        a.close()
+        b.close()
+    print('Protocol round trips')
+
+
+def persistent_connection_test():
+    print('-------------------------')
+    print('A persistent GameClient sends every request over one connection')
+    gameserver = server.GameServer()
+    gameserver.server_start()
+    running = [True]
+
+    def serve():
+        while running:
+            gameserver.update(16)
+            time.sleep(0.005)
+    thread = threading.Thread(target=serve)
+    thread.start()
+    try:
+        gameclient = client.GameClient(verbose=False)
+        assert 'Hello' in gameclient.send('test')['response']['message']
+        connection = gameclient.server
+        for i in range(0, 20):
+            assert 'Hello' in gameclient.send('test')['response']['message']
+            assert gameclient.server is connection
+        assert len(gameserver.connections) == 1
+
+        print('A non-persistent GameClient connects for each request')
+        bouncing = client.GameClient(charactername='Test1', username='test1', persistent=False, verbose=False)
+        for i in range(0, 3):
+            assert 'Hello' in bouncing.send('test')['response']['message']
+            assert bouncing.server is None
+
+        print('The server forgets a connection once the client hangs up')
+        gameclient.disconnect()
+        waited = 0
+        while gameserver.connections and waited < 2:
+            time.sleep(0.05)
+            waited += 0.05
+        assert not gameserver.connections
+    finally:
+        running.pop()
+        thread.join()
+        gameserver.server_stop()
+    print('Connections kept and dropped as expected')
+
+
+def dispatch_test():
+    print('-------------------------')
+    print('Requests for anything but a request handler are refused, and a failing handler does not stop the server')
+    character_db = server.CHARACTER_DB
+    directory = tempfile.mkdtemp()
+    server.CHARACTER_DB = os.path.join(directory, 'characters.db')
+    a, b = socket.socketpair()
+    try:
+        goc = GameObjectController(None)
+        gameserver = server.GameServer(goc)
+        gameserver.connections[b] = server.ClientConnection(b, 'socketpair')
+        credentials = {'username': 'ken', 'password': 'mypw', 'charactername': 'Zaxim', 'id': None, 'session': True}
+        requests = [dict(credentials, request=name, args=args, request_id=i) for i, (name, args) in
+                    enumerate([('nonexistent', None), ('_save_characters', 16), ('_remove_player', None),
+                               ('save_characters', 16), ('remove_player', None), ('get_payload', None),
+                               ('__init__', None), ('inventory_equip', None), ('test', None)])]
+        requests.append({'request': 'test', 'request_id': len(requests), 'session': True})
+        for request in requests:
+            a.sendall(protocol.pack_frame(protocol.MSG_REQUEST, protocol.encode(request)))
+        gameserver.ingest(0.5)
+        # REQUESTS_PER_TICK are answered each tick
+        for tick in range(0, len(requests) // server.REQUESTS_PER_TICK + 1):
+            gameserver.process_pending()
+            gameserver.flush()
+        a.settimeout(5)
+        reader = protocol.FrameReader(a)
+        responses = {}
+        while len(responses) < len(requests):
+            msg_type, payload = reader.read_message()
+            responses[payload.pop('request_id')] = payload
+        print(responses)
+        assert b in gameserver.connections
+        for i, request in enumerate(requests):
+            expected = 0 if request['request'] == 'test' and 'username' in request else -1
+            assert responses[i]['status'] == expected, (request, responses[i])
+        gameserver.processor.characters.close()
+    finally:
+        server.CHARACTER_DB = character_db
+        a.close()
+        b.close()
+        shutil.rmtree(directory)
+    print('Only request handlers answered')
+
+
+def rate_limit_test():
+    print('-------------------------')
+    print('TokenBucket allows its burst at once, then refills at its rate up to the burst again')
+    bucket = server.TokenBucket(2, 3, 0)
+    assert [bucket.take(0) for i in range(0, 4)] == [True, True, True, False]
+    assert bucket.take(0.25) is False
+    assert [bucket.take(0.5), bucket.take(0.5)] == [True, False]
+    assert [bucket.take(100) for i in range(0, 4)] == [True, True, True, False]
+    bucket.refund()
+    assert [bucket.take(100), bucket.take(100)] == [True, False]
+
+    print('RateLimiter keeps a bucket per listed request type, unlisted types share one')
+    limiter = server.RateLimiter({'say': (1, 2)}, (1, 1))
+    assert [limiter.allow('say', 0) for i in range(0, 3)] == [True, True, False]
+    assert [limiter.allow('test', 0), limiter.allow('tell', 0)] == [True, False]
+    assert limiter.allow('say', 1) is True
+    limiter.refund('say')
+    assert limiter.allow('say', 1) is True
+
+    print('Requests over the limit, and requests for no handler at all, are answered with an error')
+    character_db = server.CHARACTER_DB
+    directory = tempfile.mkdtemp()
+    server.CHARACTER_DB = os.path.join(directory, 'characters.db')
+    a, b = socket.socketpair()
+    try:
+        gameserver = server.GameServer(GameObjectController(None))
+        gameserver.connections[b] = server.ClientConnection(b, 'socketpair')
+        credentials = {'username': 'ken', 'password': 'mypw', 'charactername': 'Zaxim', 'id': None, 'args': None,
+                       'session': True}
+        burst = server.RATE_LIMITS['metrics'][1]
+        requests = [dict(credentials, request='metrics') for i in range(0, burst + 2)]
+        requests += [dict(credentials, request=[1, 2]), dict(credentials, request={'test': 1}),
+                     dict(credentials, request='test', token=[1, 2]),
+                     dict(credentials, request='batch', args=[{'request': [1]}, {'request': 'test'}])]
+        for i, request in enumerate(requests):
+            request['request_id'] = i
+            a.sendall(protocol.pack_frame(protocol.MSG_REQUEST, protocol.encode(request)))
+        gameserver.ingest(0.5)
+        for tick in range(0, len(requests) // server.REQUESTS_PER_TICK + 1):
+            gameserver.process_pending()
+            gameserver.flush()
+        a.settimeout(5)
+        reader = protocol.FrameReader(a)
+        responses = {}
+        while len(responses) < len(requests):
+            msg_type, payload = reader.read_message()
+            responses[payload.pop('request_id')] = payload
+        print(responses)
+        assert b in gameserver.connections
+        for i in range(0, burst):
+            assert 'Rate limit exceeded' not in str(responses[i]['response'])
+        for i in range(burst, burst + 2):
+            assert responses[i] == {'status': -1, 'response': {'message': 'Rate limit exceeded: metrics'}}
+        for i in range(burst + 2, burst + 5):
+            assert responses[i]['status'] == -1, responses[i]
+        batch = responses[burst + 5]
+        assert batch['status'] == 0
+        assert [response['status'] for response in batch['response']] == [-1, 0]
+        gameserver.processor.characters.close()
+    finally:
+        server.CHARACTER_DB = character_db
+        a.close()
+        b.close()
+        shutil.rmtree(directory)
+    print('Rate limits applied as expected')
+
+
+def batch_test():
+    print('-------------------------')
+    print('Requests queued on a GameClient go out as one batch, each callback gets its own payload')
+    character_db = server.CHARACTER_DB
+    directory = tempfile.mkdtemp()
+    server.CHARACTER_DB = os.path.join(directory, 'characters.db')
+    gameserver = server.GameServer(GameObjectController(None))
+    gameserver.server_start()
+    running = [True]
+
+    def serve():
+        while running:
+            gameserver.update(16)
+            time.sleep(0.005)
+        # The character store's database connection belongs to this thread
+        gameserver.server_stop()
+    thread = threading.Thread(target=serve)
+    thread.start()
+    try:
+        gameclient = client.GameClient(verbose=False)
+        gameclient.login()
+        called = []
+        for request, args in [('test', None), ('get_target', None), ('login', None), ('nonexistent', None),
+                              ('test', None)]:
+            gameclient.queue(request, args, callback=called.append)
+        payloads = gameclient.flush()
+        assert called == payloads
+        assert [payload['status'] for payload in payloads] == [0, -1, -1, -1, 0]
+        assert 'Hello' in payloads[0]['response']['message']
+        assert gameclient.flush() == [] and gameclient.batch == []
+
+        print('A batch the server refuses as a whole fails every callback instead of raising')
+        token, gameclient.token = gameclient.token, 'not a token'
+        del called[:]
+        gameclient.queue('test', callback=called.append)
+        gameclient.queue('test', callback=called.append)
+        payloads = gameclient.flush()
+        assert called == payloads and len(payloads) == 2
+        assert all(payload['status'] == -1 and 'token' in payload['response']['message'] for payload in payloads)
+        gameclient.token = token
+
+        gameclient.disconnect()
+
+        print('A GameClient registers its exit handler once, however often it reconnects')
+        registered = []
+        register, client.atexit.register = client.atexit.register, registered.append
+        try:
+            reconnecting = client.GameClient(verbose=False)
+            for i in range(0, 3):
+                reconnecting.connect(reconnecting.ip)
+                reconnecting.disconnect()
+        finally:
+            client.atexit.register = register
+        assert registered == [reconnecting.disconnect]
+    finally:
+        running.pop()
+        thread.join()
+        server.CHARACTER_DB = character_db
+        shutil.rmtree(directory)
+    print('Batches answered as expected')
+
+
+def session_test():
+    print('-------------------------')
+    print('A login hands out a session token that works from any connection until the character logs out')
+    gameserver = server.GameServer(GameObjectController(None))
+    connections = []
+
+    def connect():
+        a, b = socket.socketpair()
+        gameserver.connections[b] = server.ClientConnection(b, 'socketpair')
+        a.settimeout(5)
+        connections.append((a, b))
+        return a, protocol.FrameReader(a)
+
+    def send(connection, request):
+        a, reader = connection
+        a.sendall(protocol.pack_frame(protocol.MSG_REQUEST, protocol.encode(dict(request, session=True))))
+        gameserver.ingest(0.5)
+        gameserver.process_pending()
+        gameserver.flush()
+        msg_type, payload = reader.read_message()
+        return payload
+
+    try:
+        credentials = {'username': 'ken', 'password': 'mypw', 'charactername': 'Zaxim', 'id': None, 'args': None}
+        first = connect()
+        response = send(first, dict(credentials, request='login'))
+        assert response['status'] == 0
+        token = response['response']['token']
+        playerid = response['response']['id']
+        assert isinstance(token, protocol.text_type) and len(token) == 32
+        response = send(first, {'token': token, 'request': 'test', 'args': None})
+        assert response == {'status': 0, 'response': {'message': 'Hello ken!'}}
+
+        print('The token carries over to a new connection')
+        second = connect()
+        assert send(second, {'token': token, 'request': 'test', 'args': None})['status'] == 0
+        assert gameserver.sessions[token].playerid == playerid
+
+        print('Logging out ends the session, logging in again hands out a new token')
+        assert send(second, {'token': token, 'request': 'logout', 'args': None})['status'] == 0
+        assert token not in gameserver.sessions and playerid not in gameserver.session_tokens
+        response = send(first, {'token': token, 'request': 'test', 'args': None})
+        assert response == {'status': -1, 'response': {'message': 'Session token invalid, login again'}}
+        response = send(first, dict(credentials, request='login'))
+        assert response['status'] == 0 and response['response']['token'] != token
+        token = response['response']['token']
+
+        print('Hanging up logs the character out and ends its session')
+        a, b = connections[0]
+        a.close()
+        gameserver.ingest(0.5)
+        assert b not in gameserver.connections
+        assert token not in gameserver.sessions and not gameserver.session_tokens
+        assert 'Zaxim' not in gameserver.goc.playernames
+        gameserver.processor.characters.close()
+    finally:
+        for a, b in connections:
+            a.close()
+            b.close()
+    print('Sessions opened and closed as expected')
+
+
+def scheduler_test():
+    print('-------------------------')
+    print('TickScheduler pays out elapsed time as whole ticks, catching up at most max_catchup ticks at once')
+    now = [0.]
+    slept = []
+
+    def sleep(seconds):
+        slept.append(seconds)
+        # Like a real clock, time moves on however short the sleep
+        now[0] += max(seconds, 0.000001)
+    scheduler = TickScheduler(tick_rate=100, max_catchup=3, clock=lambda: now[0], sleep=sleep)
+    calls = []
+    # Seconds the next tick's work phase takes
+    cost = [0.]
+    scheduler.add_phase('a', calls.append)
+
+    def work(dt):
+        now[0] += cost[0]
+    scheduler.add_phase('work', work)
+    assert scheduler.dt == 10.
+    assert scheduler.advance(5) == 0 and scheduler.accumulator == 5
+    assert scheduler.advance(20) == 2 and scheduler.accumulator == 5
+    assert calls == [10., 10.]
+
+    print('A backlog beyond max_catchup ticks is skipped rather than run')
+    assert scheduler.advance(100) == 3
+    assert scheduler.skipped == 7 and scheduler.accumulator == 5 and scheduler.ticks == 5
+
+    print('Ticks slower than the timestep are counted as overruns')
+    cost[0] = 0.015
+    assert scheduler.advance(5) == 1 and scheduler.overruns == 1
+    timings = scheduler.stats()['phases']
+    assert timings['work']['last'] == 15. and timings['tick']['max'] == 15. and timings['a']['count'] == 6
+    scheduler.reset_stats()
+    assert scheduler.stats()['ticks'] == 0 and scheduler.stats()['phases']['tick']['count'] == 0
+
+    print('run sleeps off what is left of each timestep and keeps the fixed rate')
+    cost[0] = 0.002
+
+    def stop(dt):
+        # ticks counts the ticks finished before this one
+        if scheduler.ticks == 49:
+            scheduler.stop()
+    scheduler.add_phase('stop', stop)
+    start = now[0]
+    scheduler.run()
+    assert scheduler.ticks == 50 and scheduler.overruns == 0 and scheduler.skipped == 0
+    assert all(seconds <= 0.01 for seconds in slept)
+    # 50 timesteps, give or take the last tick's work and a sleep not yet slept off
+    assert abs((now[0] - start) - 0.5) < 0.015
+    print('Ticks scheduled as expected')
+
+
+def push_subscription_test():
+    print('-------------------------')
+    print('Subscribed clients are pushed their room state when their interval is up and something changed')
+    gameserver = server.GameServer(GameObjectController(None))
+    a, b = socket.socketpair()
+    connection = gameserver.connections[b] = server.ClientConnection(b, 'socketpair')
+    a.settimeout(5)
+    reader = protocol.FrameReader(a)
+
+    def send(request):
+        a.sendall(protocol.pack_frame(protocol.MSG_REQUEST, protocol.encode(dict(request, session=True))))
+        gameserver.ingest(0.5)
+        gameserver.process_pending()
+        gameserver.flush()
+        msg_type, payload = reader.read_message()
+        assert msg_type == protocol.MSG_RESPONSE
+        return payload
+
+    def push(dt):
+        """ Push for one tick, returns what was pushed or None """
+        gameserver.push(dt)
+        gameserver.flush()
+        if not select.select([a], [], [], 0.05)[0]:
+            return None
+        msg_type, payload = reader.read_message()
+        assert msg_type == protocol.MSG_PUSH
+        return payload
+
+    try:
+        response = send({'username': 'ken', 'password': 'mypw', 'charactername': 'Zaxim', 'id': None, 'args': None,
+                         'request': 'login'})
+        token, playerid = response['response']['token'], response['response']['id']
+        assert push(16) is None
+        response = send({'token': token, 'request': 'subscribe', 'args': {'interval': 50}})
+        assert response['response'] == {'message': 'Subscribed', 'interval': 50}
+
+        state = push(16)
+        snapshot = state['snapshot']
+        assert snapshot['baseline'] is None and list(snapshot['added']) == [playerid]
+        assert [push(16), push(16), push(16)] == [None, None, None]
+        # Due, but nothing changed
+        assert push(16) is None
+
+        print('Pushes are deltas against the last push, and carry messages waiting for the character')
+        coords = list(gameserver.goc.gameobjects[playerid].coords)
+        send({'token': token, 'request': 'update_coords', 'args': [coords[0] + 8, coords[1]]})
+        pushed = [push(16) for i in range(0, 4)]
+        assert pushed[:3] == [None, None, None]
+        assert pushed[3]['snapshot']['baseline'] == snapshot['seq']
+        assert pushed[3]['snapshot']['moved'] == {playerid: [coords[0] + 8, coords[1]]}
+        gameserver.processor.broadcastque.add('hello', 'Zaxim')
+        pushed = [push(16) for i in range(0, 4)]
+        assert pushed[3]['snapshot']['moved'] == {} and pushed[3]['messages'][0]['message'] == 'hello'
+
+        print('Clients with a backlog of unsent bytes are skipped until they catch up')
+        connection.outbound = bytearray(server.PUSH_BACKLOG + 1)
+        gameserver.processor.broadcastque.add('held back', 'Zaxim')
+        for i in range(0, 8):
+            gameserver.push(16)
+        assert len(connection.outbound) == server.PUSH_BACKLOG + 1
+        connection.outbound = bytearray()
+        state = push(50)
+        assert state['messages'][0]['message'] == 'held back'
+
+        print('Unsubscribing stops the pushes')
+        assert send({'token': token, 'request': 'unsubscribe', 'args': None})['status'] == 0
+        gameserver.processor.broadcastque.add('too late', 'Zaxim')
+        assert push(50) is None and connection.subscription is None
+
+        print('Compact subscriptions push compact snapshots, starting over from a full one')
+        send({'token': token, 'request': 'subscribe', 'args': {'interval': 50, 'compact': True}})
+        state = push(16)
+        assert is_compact(state['snapshot']) and state['snapshot']['baseline'] is None
+        assert list(unpack_delta(state['snapshot'])['added']['ids']) == [playerid]
+        gameserver.processor.characters.close()
+    finally:
+        a.close()
+        b.close()
+    print('Pushed as expected')
+
+
+def compression_test():
+    print('-------------------------')
+    print('Large messages to clients that ask for it are compressed, as one zlib stream per connection')
+    compressor = protocol.Compressor(threshold=64)
+    decompressor = protocol.Decompressor()
+    room = dict((id, ('graphics/sprites/player_sprites/human_0.png', [id * 8, id * 16])) for id in range(0, 50))
+    assert not compressor.wanted(protocol.encode({'status': 0}))
+    sizes = []
+    for step in range(0, 20):
+        room[step] = (room[step][0], [step, step])
+        body = protocol.encode({'coords': room, 'step': step})
+        assert compressor.wanted(body)
+        data = compressor.compress(body)
+        sizes.append(len(data))
+        # Each message can be decompressed as soon as it arrives
+        assert protocol.decode(decompressor.decompress(data)) == {'coords': room, 'step': step}
+    assert sizes[0] < len(body) / 2
+    # Later messages build on the window of the ones before
+    assert max(sizes[1:]) < sizes[0] / 2
+
+    print('A connection whose traffic does not compress stops compressing')
+    rng = random.Random(3)
+    compressor = protocol.Compressor()
+
+    def noise():
+        # Fresh every time, a repeat would compress against the window
+        return bytes(bytearray(rng.randint(0, 255) for i in range(0, 4096)))
+    while compressor.wanted(noise()) and compressor.raw < 2 * protocol.COMPRESS_SAMPLE:
+        compressor.compress(noise())
+    assert protocol.COMPRESS_SAMPLE <= compressor.raw < 2 * protocol.COMPRESS_SAMPLE
+    try:
+        protocol.Decompressor().decompress(b'not zlib at all')
+    except protocol.ProtocolError:
+        pass
+    else:
+        raise AssertionError('Corrupt compressed data decompressed')
+
+    print('The server compresses what it sends once a request asks for it, small messages go out as they are')
+    gameserver = server.GameServer(GameObjectController(None))
+    gameserver.metrics.enabled = True
+    a, b = socket.socketpair()
+    connection = gameserver.connections[b] = server.ClientConnection(b, 'socketpair', gameserver.metrics)
+    a.settimeout(5)
+    reader = protocol.FrameReader(a)
+    try:
+        a.sendall(protocol.pack_frame(protocol.MSG_REQUEST, protocol.encode(
+            {'username': 'ken', 'password': 'mypw', 'charactername': 'Zaxim', 'id': None, 'request': 'test',
+             'args': None, 'session': True, 'compress': True})))
+        gameserver.ingest(0.5)
+        gameserver.process_pending()
+        assert connection.compressor is not None
+        body = protocol.encode({'coords': room})
+        connection.queue_message(protocol.MSG_PUSH, body)
+        gameserver.flush()
+        assert reader.read_message() == (protocol.MSG_RESPONSE, {'status': 0, 'response': {'message': 'Hello ken!'}})
+        assert reader.decompressor is None
+        assert reader.read_message() == (protocol.MSG_PUSH, {'coords': room})
+        assert reader.decompressor is not None
+        stats = gameserver.metrics.report()['compression']
+        assert stats['count'] == 1 and stats['raw_bytes'] == len(body) and 0 < stats['ratio'] < 0.5
+    finally:
+        a.close()
+        b.close()
+    print('Compressed as expected')
+
+
+def metrics_test():
+    print('-------------------------')
+    print('Histograms bucket samples and report percentiles by bucket')
+    histogram = metrics.Histogram(bounds=[1, 10, 100])
+    for value in [0.5] * 50 + [5] * 40 + [50] * 9 + [5000]:
+        histogram.record(value)
+    report = histogram.as_dict()
+    assert report['count'] == 100 and report['max'] == 5000 and report['overflow'] == 1
+    assert report['buckets'] == {'<=1': 50, '<=10': 40, '<=100': 9}
+    assert (report['p50'], report['p90'], report['p99']) == (1, 10, 100)
+    assert histogram.percentile(100) == 5000 and metrics.Histogram().percentile(50) == 0.
+    histogram = metrics.Histogram(bounds=[1, 10, 100])
+    histogram.record(3)
+    # Never above the largest sample
+    assert histogram.percentile(50) == 3
+
+    print('Requests are counted per type with their errors and bytes, dumped as JSON while enabled')
+    now = [100.]
+    directory = tempfile.mkdtemp()
+    dump_file = os.path.join(directory, 'metrics.json')
+    recorder = metrics.Metrics(dump_file=dump_file, dump_interval=1000, clock=lambda: now[0])
+    recorder.record_request('test', 0.2, 120, 0)
+    recorder.record_request('test', 0.4, None, -1)
+    recorder.record_phase('ingest', 3)
+    now[0] += 2
+    report = recorder.report()
+    assert report['seconds'] == 2 and report['phases']['ingest']['count'] == 1
+    assert (report['requests']['test']['count'], report['requests']['test']['errors'],
+            report['requests']['test']['bytes']) == (2, 1, 120)
+    recorder.update(5000)
+    assert not os.path.exists(dump_file)
+    recorder.enabled = True
+    try:
+        recorder.update(600)
+        assert not os.path.exists(dump_file)
+        recorder.update(600)
+        with open(dump_file) as f:
+            assert json.load(f)['requests']['test']['count'] == 2
+        assert os.listdir(directory) == ['metrics.json']
+        recorder.reset()
+        assert recorder.report()['requests'] == {} and recorder.report()['seconds'] == 0
+    finally:
+        shutil.rmtree(directory)
+
+    print('The server records each request it answers, the metrics request is for admins only')
+    gameserver = server.GameServer(GameObjectController(None))
+    gameserver.metrics.dump_file = None
+    a, b = socket.socketpair()
+    gameserver.connections[b] = server.ClientConnection(b, 'socketpair', gameserver.metrics)
+    a.settimeout(5)
+    reader = protocol.FrameReader(a)
+
+    def send(username, request, args=None):
+        charactername = {'ken': 'Zaxim', 'test1': 'Test1'}[username]
+        a.sendall(protocol.pack_frame(protocol.MSG_REQUEST, protocol.encode(
+            {'username': username, 'password': 'mypw', 'charactername': charactername, 'id': None,
+             'request': request, 'args': args, 'session': True})))
+        gameserver.ingest(0.5)
+        gameserver.process_pending()
+        gameserver.flush()
+        return reader.read_message()[1]
+
+    try:
+        assert send('test1', 'metrics', {'enable': True}) == {'status': -1,
+                                                             'response': {'message': 'Admin only request'}}
+        assert not gameserver.metrics.enabled
+        send('ken', 'test')
+        assert send('ken', 'metrics', {'enable': True})['response']['requests'] == {}
+        send('ken', 'test')
+        send('ken', 'get_target')
+        report = send('ken', 'metrics', {'reset': True})['response']
+        assert report['enabled'] and report['requests']['test']['count'] == 1
+        assert report['requests']['test']['bytes'] > 0 and report['requests']['get_target']['errors'] == 1
+        assert 'test' not in send('ken', 'metrics', {'enable': False})['response']['requests']
+    finally:
+        a.close()
+        b.close()
+    print('Metrics as expected')
+
+
+def interpolation_test():
+    print('-------------------------')
+    print('Remote sprite positions are interpolated between snapshots, and extrapolated a little when one is late')
+    buffer = InterpolationBuffer()
+    assert buffer.sample(0) is None
+    buffer.push(0, [0, 0])
+    buffer.push(100, [8, 0])
+    assert buffer.sample(-10) == [0, 0] and buffer.sample(50) == [4, 0] and buffer.sample(100) == [8, 0]
+    assert buffer.sample(150, 100) == [12, 0]
+    assert buffer.sample(1000, 100) == [8 + 8 * MAX_EXTRAPOLATION / 100., 0]
+    # Not in the newest snapshot, so it did not move in it
+    assert buffer.sample(1000, 200) == [8, 0]
+
+    print('A sprite that stood still moves over the last snapshot gap only, and jumps are not interpolated')
+    buffer = InterpolationBuffer()
+    buffer.push(0, [0, 0])
+    buffer.hold(900)
+    buffer.push(1000, [8, 0])
+    assert buffer.sample(500) == [0, 0] and buffer.sample(950) == [4, 0]
+    buffer.push(1000, [16, 0])
+    assert list(buffer.samples)[-1] == (1000, [16, 0])
+    buffer.push(1100, [16 + SNAP_DISTANCE + 1, 0])
+    assert len(buffer.samples) == 1 and buffer.sample(1050) == [16 + SNAP_DISTANCE + 1, 0]
+
+    class Sprite(object):
+        """ Only what RemoteSpriteController and Hero use, a RemoteSprite needs a display to load its image """
+        def __init__(self, id, sprite, coords):
+            self.id = id
+            self.sprite = sprite
+            self.coords = list(coords)
+            self.buffer = InterpolationBuffer()
+
+    print('Snapshots every 100ms move a remote sprite a little every frame, drawn two snapshots behind')
+    rsc = RemoteSpriteController(None)
+    rsc.id = 1
+    rsc.group = set()
+
+    def add_remotesprite(id, sprite, coords):
+        sprite = rsc.remotesprites[id] = Sprite(id, sprite, coords)
+        return sprite
+    rsc.add_remotesprite = add_remotesprite
+    rsc.apply_snapshot({'seq': 1, 'baseline': None, 'added': {1: ('human_0.png', [0, 0]), 2: ('orc_0.png', [0, 0])},
+                        'moved': {}, 'removed': []})
+    assert list(rsc.remotesprites) == [2] and len(rsc.group) == 1
+    orc = rsc.remotesprites[2]
+    drawn = []
+    for seq in range(2, 30):
+        for frame in range(0, 4):
+            rsc.update(25)
+            drawn.append(orc.coords[0])
+        rsc.apply_snapshot({'seq': seq, 'baseline': seq - 1, 'added': {}, 'moved': {2: [8 * (seq - 1), 0]},
+                            'removed': []})
+    assert rsc.delay == 200
+    steps = [after - before for before, after in zip(drawn[20:], drawn[21:])]
+    assert steps == [2] * len(steps)
+    assert 8 * 28 - drawn[-1] == 8 * 200 / 100
+
+    print('Once snapshots stop the sprite carries on for at most MAX_EXTRAPOLATION')
+    for frame in range(0, 100):
+        rsc.update(25)
+    assert orc.coords == [8 * 28 + 8 * MAX_EXTRAPOLATION / 100, 0]
+    rsc.apply_snapshot({'seq': 40, 'baseline': 35, 'added': {}, 'moved': {2: [0, 0]}, 'removed': []})
+    assert rsc.seq is None and orc.buffer.samples[-1][1] != [0, 0]
+    rsc.apply_snapshot({'seq': 41, 'baseline': None, 'added': {}, 'moved': {}, 'removed': []})
+    assert rsc.remotesprites == {} and rsc.group == set()
+
+    print('Predicted hero moves are dropped once acknowledged, and snapped back when the server disagrees')
+    hero = Hero.__new__(Hero)
+    hero.remotesprite = Sprite(1, 'human_0.png', [0, 0])
+    hero.move_seq = 0
+    hero.pending_moves = []
+    hero.moving, hero.target_coords = True, [24, 0]
+    assert hero.predict_move([8, 0]) == {'coords': [8, 0], 'seq': 1}
+    hero.predict_move([16, 0])
+    hero.predict_move([24, 0])
+    hero.coords = [24, 0]
+    hero.reconcile(2, [16, 0])
+    assert hero.pending_moves == [(3, [24, 0])] and hero.coords == [24, 0] and hero.moving
+    hero.reconcile(2, [16, 0])
+    assert hero.pending_moves == [(3, [24, 0])]
+    hero.reconcile(3, [16, 0])
+    assert hero.pending_moves == [] and hero.coords == [16, 0] and not hero.moving and hero.target_coords is None
+    print('Interpolated and reconciled as expected')
+
+
+def mailbox_test():
+    print('-------------------------')
+    print('Mailboxes hold items for their own character only, and overflow without holding up anyone else')
+
+    class Player(object):
+        def __init__(self, id, name, current_room):
+            self.id = id
+            self.name = name
+            self.current_room = current_room
+
+    class Goc(object):
+        """ Only what MailboxQue looks at """
+        def __init__(self, players):
+            self.players = dict((go.id, go) for go in players)
+            self.players_by_name = dict((go.name, go) for go in players)
+
+        def room_gameobjects(self, room):
+            return dict((id, go) for id, go in self.players.items() if go.current_room == room)
+
+    class Server(object):
+        goc = Goc([Player(1, 'Zaxim', 'template_room'), Player(2, 'Madaar', 'template_room'),
+                   Player(3, 'Idle', 'second_room')])
+
+    que = server.BroadcastQue(Server(), size=3)
+    que.add('hello everyone', 'ALL')
+    que.add('hello room', 'room:template_room')
+    que.add('hello zaxim', 'Zaxim')
+    assert [item['message'] for item in que.dump('Zaxim')] == ['hello everyone', 'hello room', 'hello zaxim']
+    assert [item['message'] for item in que.dump('Madaar')] == ['hello everyone', 'hello room']
+    assert que.dump('Zaxim') == [] and que.dump('Nobody') == []
+
+    print('A character that stops polling only loses its own oldest items')
+    for i in range(0, 5):
+        que.add(str(i), 'room:second_room')
+        que.add('z' + str(i), 'Zaxim')
+        assert [item['message'] for item in que.dump('Zaxim')] == ['z' + str(i)]
+    assert [item['message'] for item in que.dump('Idle')] == ['2', '3', '4']
+    assert que.dropped == {'Idle': 3}
+    que.discard('Idle')
+    assert 'Idle' not in que.mailboxes and que.dropped == {}
+
+    print('Or its newest items, if asked to')
+    que = server.PayloadQue(Server(), size=3, overflow='drop_newest')
+    for i in range(0, 5):
+        que.add('count', i, 'Madaar')
+    assert [item['data'] for item in que.dump('Madaar')] == [0, 1, 2] and que.dropped == {'Madaar': 2}
+    try:
+        server.MailboxQue(Server(), overflow='drop_everything')
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError('Unknown overflow behaviour accepted')
+
+    print('Items for characters this server does not hold are relayed, once')
+    relayed = []
+    que.relay = lambda item, target: relayed.append((item['tag'], target))
+    que.add('everyone', None, 'ALL')
+    que.add('elsewhere', None, 'Faraway')
+    que.add('here', None, 'Zaxim')
+    que._deliver({'tag': 'from another shard'}, 'Nowhere', relay=False)
+    assert relayed == [('everyone', 'ALL'), ('elsewhere', 'Faraway')]
+    assert [item['tag'] for item in que.dump('Zaxim')] == ['everyone', 'here']
+    assert 'Faraway' not in que.mailboxes
+    print('Mailboxes as expected')
+
+
+def interest_set_test():
+    print('-------------------------')
+    print('Interest sets only pass on gameobjects near the player, with hysteresis at the edge')
+    interest = server.InterestSet(radius=10, hysteresis=5)
+    room_map = {1: ('human_0.png', [0, 0]), 2: ('orc_0.png', [6, 8]), 3: ('orc_0.png', [12, 0]),
+                4: ('slime_0.png', [100, 100])}
+    assert sorted(interest.filter(1, [0, 0], room_map)) == [1, 2]
+
+    print('Stepping past the radius keeps a gameobject until it is past radius + hysteresis')
+    room_map[2] = ('orc_0.png', [12, 8])
+    room_map[3] = ('orc_0.png', [9, 0])
+    assert sorted(interest.filter(1, [0, 0], room_map)) == [1, 2, 3]
+    room_map[2] = ('orc_0.png', [15, 0])
+    assert sorted(interest.filter(1, [0, 0], room_map)) == [1, 2, 3]
+    room_map[2] = ('orc_0.png', [15, 1])
+    assert sorted(interest.filter(1, [0, 0], room_map)) == [1, 3]
+    room_map[2] = ('orc_0.png', [12, 0])
+    assert sorted(interest.filter(1, [0, 0], room_map)) == [1, 3]
+
+    print('The player always sees themselves, and the set follows them')
+    assert sorted(interest.filter(1, [200, 200], room_map)) == [1]
+    assert sorted(interest.filter(1, [100, 95], {1: room_map[1], 4: room_map[4]})) == [1, 4]
+
+    print('Gameobjects leaving the area reach the client as removed in the snapshot delta')
+    interest = server.InterestSet(radius=10, hysteresis=5)
+    history = server.SnapshotHistory()
+    room_map = {1: ('human_0.png', [0, 0]), 2: ('orc_0.png', [5, 0])}
+    delta = history.delta(None, interest.filter(1, [0, 0], room_map))
+    assert sorted(delta['added']) == [1, 2]
+    room_map[2] = ('orc_0.png', [50, 0])
+    delta = history.delta(delta['seq'], interest.filter(1, [0, 0], room_map))
+    assert delta['removed'] == [2] and delta['moved'] == {}
+    room_map[2] = ('orc_0.png', [5, 0])
+    delta = history.delta(delta['seq'], interest.filter(1, [0, 0], room_map))
+    assert delta['added'] == {2: room_map[2]}
+    print('Interest sets as expected')
+
+
+def snapshot_delta_test():
+    print('-------------------------')
+    print('Room deltas applied to what the client last acknowledged rebuild the server\'s snapshot, lost ones included')
+    rng = random.Random(11)
+    history = server.SnapshotHistory(size=4)
+    sprites = ['human_0.png', 'orc_0.png', 'slime_0.png']
+    world = dict((id, (rng.choice(sprites), [id * 8, 16])) for id in range(0, 20))
+    client_snapshot, ack = {}, None
+    removed = full = 0
+    for step in range(0, 300):
+        for id in rng.sample(sorted(world), 5):
+            world[id] = (world[id][0], [world[id][1][0] + rng.randint(-8, 8), world[id][1][1]])
+        if rng.random() < 0.3:
+            del world[rng.choice(sorted(world))]
+        if rng.random() < 0.3:
+            world[max(world) + 1] = (rng.choice(sprites), [0, 0])
+        if rng.random() < 0.1:
+            id = rng.choice(sorted(world))
+            world[id] = (rng.choice(sprites), world[id][1])
+        snapshot = dict((id, (sprite, list(coords))) for id, (sprite, coords) in world.items())
+        delta = history.delta(ack, snapshot)
+        if rng.random() < 0.25:
+            # Lost on the way, the client keeps acknowledging the snapshot before
+            continue
+        if delta['baseline'] is None:
+            full += 1
+            client_snapshot = {}
+        else:
+            assert delta['baseline'] == ack
+        for id, (sprite, coords) in delta['added'].items():
+            client_snapshot[id] = (sprite, list(coords))
+        for id, coords in delta['moved'].items():
+            client_snapshot[id] = (client_snapshot[id][0], list(coords))
+        for id in delta['removed']:
+            del client_snapshot[id]
+            removed += 1
+        assert client_snapshot == snapshot
+        ack = delta['seq']
+    assert removed and full > 1
+
+    print('Deltas only carry what changed')
+    delta = history.delta(ack, dict(snapshot))
+    assert delta['baseline'] == ack and delta['added'] == {} and delta['moved'] == {} and delta['removed'] == []
+
+    print('Acknowledging a snapshot that was discarded, or is too old, gets a full snapshot')
+    history.discard(delta['seq'])
+    assert history.delta(delta['seq'], snapshot)['baseline'] is None
+    ack = history.seq
+    for i in range(0, 4):
+        history.delta(ack, snapshot)
+    assert history.delta(ack - 1, snapshot)['baseline'] is None
+    print('Snapshot deltas as expected')
+
+
+def compact_snapshot_test():
+    print('-------------------------')
+    print('Compact snapshots carry the same delta as typed arrays, sprite paths are sent to each client once')
+    sprites = SpriteTable()
+    sent = set()
+    delta = {'seq': 7, 'baseline': 6, 'added': {3: ('human_0.png', [16, -8]), 2 ** 31 - 1: ('orc_0.png', [0, 40.75])},
+             'moved': {5: [320, 320], 6: [-1, 2]}, 'removed': [9, 16777216]}
+    packed = protocol.decode(protocol.encode(pack_delta(delta, sprites, sent)))
+    assert is_compact(packed) and not is_compact(delta)
+    assert sorted(packed['sprites'].values()) == ['human_0.png', 'orc_0.png']
+    unpacked = unpack_delta(packed)
+    assert (unpacked['seq'], unpacked['baseline']) == (7, 6)
+    added = unpacked['added']
+    assert dict((id, (packed['sprites'][added['sprites'][i]], list(added['coords'][2 * i:2 * i + 2])))
+                for i, id in enumerate(added['ids'])) == {3: ('human_0.png', [16, -8]),
+                                                          2 ** 31 - 1: ('orc_0.png', [0, 40])}
+    moved = unpacked['moved']
+    assert dict((id, list(moved['coords'][2 * i:2 * i + 2])) for i, id in enumerate(moved['ids'])) == delta['moved']
+    assert list(unpacked['removed']) == [9, 16777216]
+
+    print('Sprites already sent are left out, other clients still get them')
+    delta = {'seq': 8, 'baseline': 7, 'added': {4: ('orc_0.png', [8, 8]), 8: ('slime_0.png', [0, 0])}, 'moved': {},
+             'removed': []}
+    packed = unpack_delta(pack_delta(delta, sprites, sent))
+    assert list(packed['sprites'].values()) == ['slime_0.png']
+    assert [sprites.paths[id] for id in packed['added']['sprites']] == [delta['added'][id][0]
+                                                                        for id in packed['added']['ids']]
+    assert len(pack_delta(delta, sprites, set())['sprites']) == 2
+    empty = unpack_delta(pack_delta({'seq': 9, 'baseline': 8, 'added': {}, 'moved': {},
+                                                       'removed': []}, sprites, sent))
+    assert len(empty['added']['ids']) == len(empty['moved']['ids']) == len(empty['removed']) == 0
+    print('Compact snapshots as expected')
+
+
+def shard_test():
+    print('-------------------------')
+    print('A player changing to a room on another shard is handed over with their id, subscription and messages')
+    gameserver = server.GameServer()
+    router = gameserver.router = ShardRouter(gameserver, [START_ROOM, 'gameobjects/room/regression/second_room.rm'], 2)
+    gameserver.server_start()
+    running = [True]
+
+    def serve():
+        while running:
+            gameserver.update(16)
+            time.sleep(0.005)
+        # Connections first, logging out a dropped client goes through its shard
+        gameserver.server_stop()
+        router.stop()
+    thread = threading.Thread(target=serve)
+    thread.start()
+
+    def wait_for(condition, timeout=5):
+        """ True once condition() is, it is only called until then as it may drain what it looks at """
+        waited = 0
+        while waited < timeout:
+            if condition():
+                return True
+            time.sleep(0.05)
+            waited += 0.05
+        return False
+
+    try:
+        zaxim = client.GameClient(verbose=False)
+        madaar = client.GameClient(charactername='Madaar', username='nat', verbose=False)
+        zaxim.login()
+        madaar.login()
+        first, second = router.room_shards['template_room'], router.room_shards['second_room']
+        assert first != second
+        assert router.player_shards == {zaxim.id: first, madaar.id: first}
+        assert sorted(zaxim.send('evaluate', 'playernames')['response']['message']) == ['Madaar', 'Zaxim']
+        zaxim.subscribe(20)
+        assert wait_for(lambda: zaxim.receive_pushes())
+
+        response = zaxim.send('change_room', {'room': 'second_room', 'coords': [16, 16]})
+        assert response['response']['current_room'] == 'second_room'
+        assert wait_for(lambda: router.player_shards.get(zaxim.id) == second)
+        assert zaxim.send('evaluate', 'playernames')['response']['message'] == ['Zaxim']
+        assert zaxim.send('evaluate', 'gameobjects[{0}].coords'.format(zaxim.id))['response']['message'] == [16, 16]
+        assert madaar.send('evaluate', 'playernames')['response']['message'] == ['Madaar']
+
+        print('Pushes carry on from the new shard, starting over with a full snapshot')
+        pushes = []
+        assert wait_for(lambda: pushes.extend(zaxim.receive_pushes()) or any(
+            push['snapshot']['baseline'] is None and zaxim.id in push['snapshot']['added'] for push in pushes))
+        assert not any(madaar.id in push['snapshot']['added'] for push in pushes
+                       if push['snapshot']['baseline'] is None and zaxim.id in push['snapshot']['added'])
+
+        print('Tells reach a player on another shard')
+        madaar.send('tell', {'message': 'over here', 'target': 'zaxim'})
+        told = []
+        assert wait_for(lambda: told.extend(message['message'] for push in zaxim.receive_pushes()
+                                            for message in push.get('messages', [])) or 'over here' in told)
+
+        print('Changing back hands the player back to the first shard')
+        zaxim.send('change_room', {'room': 'template_room', 'coords': [24, 24]})
+        assert wait_for(lambda: router.player_shards.get(zaxim.id) == first)
+        assert sorted(zaxim.send('evaluate', 'playernames')['response']['message']) == ['Madaar', 'Zaxim']
+        zaxim.logout()
+        madaar.logout()
+        assert router.online == {} and router.player_shards == {}
+        zaxim.disconnect()
+        madaar.disconnect()
+    finally:
+        running.pop()
+        thread.join()
+    print('Handed over as expected')
+
+
+def gameobject_index_test():
+    print('-------------------------')
+    print('GOC indexes match a scan of every gameobject as gameobjects move, change room, die and leave')
+    goc = GameObjectController(None)
+
+    def check():
+        rooms = {}
+        for id, gameobject in goc.gameobjects.items():
+            rooms.setdefault(gameobject.current_room, {})[id] = gameobject
+        lifeforms = dict((id, go) for id, go in goc.gameobjects.items() if isinstance(go, LifeForm))
+        assert goc._room_gameobjects == rooms
+        for uniquename, gameobjects in rooms.items():
+            assert goc.room_gameobjects(uniquename) == gameobjects
+            placed = set(id for id, go in gameobjects.items() if id in lifeforms and go.coords is not None)
+            spatial_hash = goc.spatial_hash(uniquename)
+            assert set(spatial_hash.positions if spatial_hash else []) == placed
+        assert goc.lifeforms == lifeforms
+        assert goc.players == dict((id, lf) for id, lf in lifeforms.items() if lf.player)
+        assert goc.npcs == dict((id, lf) for id, lf in lifeforms.items() if not lf.player)
+        assert sorted(goc.playernames) == sorted(lf.name for lf in lifeforms.values() if lf.player)
+        assert goc.players_by_name == dict((lf.name, lf) for lf in lifeforms.values() if lf.player)
+        assert goc.destroyed == dict((id, go) for id, go in goc.gameobjects.items() if go.destroyed)
+
+    npcs = [goc.add_gameobject('gameobjects/lifeform/template.lfm', 'room_a' if i % 2 else 'room_b', [i * 8, 16])[0]
+            for i in range(0, 10)]
+    player, playerid = goc.load_gameobject('mp/users/Zaxim.sav', 'room_a', [40, 40])
+    unplaced, unplacedid = goc.add_gameobject('gameobjects/lifeform/template.lfm')
+    check()
+    npcs[0].change_room('room_a', [200, 200])
+    npcs[1].coords = [300, 8]
+    npcs[2].current_room = 'room_c'
+    player.change_room('room_c')
+    unplaced.coords = [8, 8]
+    check()
+    npcs[3].destroyed = True
+    npcs[4].destroyed = True
+    check()
+    npcs[4].destroyed = False
+    goc.remove_gameobject(npcs[3].id)
+    goc.remove_gameobject(npcs[5].id)
+    check()
+    goc.remove_gameobject(playerid)
+    assert 'Zaxim' not in goc.playernames
+    goc.remove_gameobject(playerid)
+    check()
+    goc.replace_gameobjects(dict((id, go) for id, go in goc.gameobjects.items() if id != npcs[6].id))
+    check()
+    npcs[6].coords = [0, 0]
+    npcs[7].change_room('room_b', [64, 64])
+    check()
+    print('Indexes consistent')
+
+
+def spatial_hash_test():
+    print('-------------------------')
+    print('SpatialHash queries against a scan of every gameobject')
+    rng = random.Random(7)
+    spatial_hash = SpatialHash()
+    gameobjects = [GameObject(id, coords=[rng.randint(-400, 400), rng.randint(-400, 400)]) for id in range(0, 300)]
+    for gameobject in gameobjects:
+        spatial_hash.insert(gameobject)
+
+    def scan(coords, radius):
+        found = []
+        for gameobject in gameobjects:
+            if gameobject in spatial_hash:
+                distance = math.sqrt((gameobject.coords[0] - coords[0]) ** 2 + (gameobject.coords[1] - coords[1]) ** 2)
+                if distance < radius:
+                    found.append((distance, gameobject))
+        return sorted(found, key=lambda item: (item[0], item[1].id))
+
+    for step in range(0, 3):
+        for i in range(0, 100):
+            coords = [rng.randint(-450, 450), rng.randint(-450, 450)]
+            radius = rng.choice([1, 10, 47, 48, 100, 250, 2000])
+            expected = scan(coords, radius)
+            found = sorted(spatial_hash.query(coords, radius), key=lambda item: (item[0], item[1].id))
+            assert found == expected, (coords, radius)
+        print('Moving and removing gameobjects')
+        for gameobject in rng.sample(gameobjects, 100):
+            gameobject.coords = [rng.randint(-400, 400), rng.randint(-400, 400)]
+            spatial_hash.move(gameobject)
+        for gameobject in rng.sample(gameobjects, 30):
+            spatial_hash.remove(gameobject)
+    assert len(spatial_hash) == sum(len(members) for members in spatial_hash.cells.values())
+    assert all(members for members in spatial_hash.cells.values())
+
+    print('Lifeforms only see the lifeforms in their room and in sight')
+    goc = GameObjectController(None)
+    lifeforms = [goc.add_gameobject('gameobjects/lifeform/template.lfm', rng.choice(['room_a', 'room_b']),
+                                    [rng.randint(0, 320), rng.randint(0, 320)])[0] for i in range(0, 40)]
+    for step in range(0, 3):
+        goc.perception.advance()
+        for lifeform in lifeforms:
+            expected = set(other.id for other in lifeforms if other is not lifeform and
+                           other.current_room == lifeform.current_room and
+                           point_distance(lifeform.coords, other.coords) < lifeform.sight)
+            assert set(lifeform.nearby_lifeforms) == expected
+            nearest = lifeform.nearest_lifeform
+            if expected:
+                assert point_distance(lifeform.coords, nearest.coords) == min(
+                    point_distance(lifeform.coords, goc.gameobjects[id].coords) for id in expected)
+            else:
+                assert nearest == {}
+        for lifeform in rng.sample(lifeforms, 15):
+            lifeform.change_room(rng.choice(['room_a', 'room_b']), [rng.randint(0, 320), rng.randint(0, 320)])
+    print('Spatial queries match')
+
+
+def perception_test():
+    print('-------------------------')
+    print('Perception is worked out once per tick, again when sight or room change, and thrown away each tick')
+    goc = GameObjectController(None)
+    a, aid = goc.add_gameobject('gameobjects/lifeform/template.lfm', 'room_a', [0, 0])
+    b, bid = goc.add_gameobject('gameobjects/lifeform/template.lfm', 'room_a', [40, 0])
+    c, cid = goc.add_gameobject('gameobjects/lifeform/template.lfm', 'room_a', [150, 0])
+    a.sight = 100
+    perception = a.perception
+    assert a.nearby_lifeforms == {bid: b}
+    assert a.nearest_lifeform is b and a.farthest_lifeform is b
+    assert a.perception is perception
+
+    print('Within a tick lifeforms are seen where they were when first asked')
+    b.coords = [500, 0]
+    assert a.nearby_lifeforms == {bid: b}
+    assert a.perception is perception
+
+    print('A new sight range or room is checked again straight away')
+    a.sight = 200
+    assert a.perception is not perception
+    assert a.nearby_lifeforms == {cid: c}
+    perception = a.perception
+    a.change_room('room_b', [0, 0])
+    assert a.perception is not perception
+    assert a.nearby_lifeforms == {}
+    a.change_room('room_a', [0, 0])
+    assert a.nearby_lifeforms == {cid: c}
+
+    print('The next tick starts from scratch')
+    tick = goc.perception.tick
+    b.coords = [10, 0]
+    goc.update(16)
+    assert goc.perception.tick == tick + 1
+    # The AI puts sight back to its idle range as it runs
+    a.sight = 200
+    assert set(a.nearby_lifeforms) == set([bid, cid])
+    assert a.nearest_lifeform is b and a.farthest_lifeform is c
+    assert goc.perception.primary_faction(b) == b.primary_faction
+    assert goc.perception.hated_factions(b) == frozenset(b.hated_factions)
+    assert a.is_enemy(b) == (b.primary_faction in a.hated_factions)
+    goc.remove_gameobject(bid)
+    goc.replace_gameobjects(dict(goc.gameobjects))
+    assert goc.perception.perceptions == {}
+    assert a.nearby_lifeforms == {cid: c}
+    print('Perception cache kept up to date')
+
+
+def component_store_test():
+    print('-------------------------')
+    print('ComponentStore keeps its slots dense and each lifeform\'s values as lifeforms come and go')
+    goc = GameObjectController(None, components=True)
+    store = goc.components
+    lifeforms = [goc.add_gameobject('gameobjects/lifeform/template.lfm', 'room_a' if i % 3 else 'room_b',
+                                    [i * 8, i * 4])[0] for i in range(0, 12)]
+    for i, lifeform in enumerate(lifeforms):
+        lifeform.stats['HP'] = 10 + i
+        lifeform.stats['LUCK'] = i
+    expected = dict((lf.id, (lf.coords, dict(lf.stats))) for lf in lifeforms)
+
+    def check():
+        assert len(store) == len(goc.lifeforms)
+        for slot, lifeform in enumerate(store.lifeforms):
+            assert lifeform._slot == slot and goc.lifeforms[lifeform.id] is lifeform
+            assert (lifeform.coords, dict(lifeform.stats)) == expected[lifeform.id]
+
+    check()
+    print('Removing the first, a middle and the last lifeform')
+    for lifeform in (store.lifeforms[0], store.lifeforms[5], store.lifeforms[-1]):
+        goc.remove_gameobject(lifeform.id)
+        assert isinstance(lifeform.stats, dict) and '_slot' not in lifeform.__dict__
+        assert (lifeform.coords, lifeform.stats) == expected[lifeform.id]
+        check()
+    lifeforms = list(store.lifeforms)
+
+    print('Writes go to the arrays')
+    lifeforms[0].coords = [100, 100]
+    lifeforms[1].stats['HP'] = 0
+    del lifeforms[2].stats['LUCK']
+    expected[lifeforms[0].id] = ([100, 100], expected[lifeforms[0].id][1])
+    expected[lifeforms[1].id][1]['HP'] = 0
+    del expected[lifeforms[2].id][1]['LUCK']
+    check()
+    assert store.dead() == [lifeforms[1]]
+
+    print('Fractional coords and stats are kept as they are, whole ones come back as ints')
+    lifeforms[3].coords = [10.5, -20.25]
+    lifeforms[3].stats['SPD'] = 2.75
+    expected[lifeforms[3].id] = ([10.5, -20.25], dict(expected[lifeforms[3].id][1], SPD=2.75))
+    check()
+    assert all(type(value) is int for value in lifeforms[0].coords + [lifeforms[0].stats['HP']])
+    assert store.within([10.5, -19.5], 1, lifeforms[3].current_room) == [lifeforms[3]]
+    assert store.within([10.5, -19.25], 1, lifeforms[3].current_room) == []
+    found = sorted((lf.id, distance) for distance, lf in goc.distances_from([0, 0], 'room_a'))
+    in_room = [lf for lf in lifeforms if lf.current_room == 'room_a']
+    assert found == sorted((lf.id, point_distance([0, 0], lf.coords)) for lf in in_room)
+
+    print('Pickled lifeforms take their values with them')
+    restored = pickle.loads(pickle.dumps(lifeforms[0], pickle.HIGHEST_PROTOCOL))
+    assert '_components' not in restored.__dict__ and '_slot' not in restored.__dict__
+    assert (restored.coords, restored.stats) == expected[lifeforms[0].id]
+    assert lifeforms[0]._components is store
+    other = GameObjectController(None, components=True)
+    other.insert_gameobject(restored, 'room_a', [8, 8])
+    assert other.components.lifeforms == [restored]
+    assert dict(restored.stats) == expected[lifeforms[0].id][1] and other.components.get_coords(0) == [8, 8]
+
+    goc.dead_check()
+    assert lifeforms[1].id not in goc.gameobjects
+    del expected[lifeforms[1].id]
+    check()
+    goc.replace_gameobjects(dict(goc.gameobjects))
+    check()
+    print('Component store consistent')
+
+
+def id_allocator_test():
+    print('-------------------------')
+    print('Freed ids come back oldest first with the next generation')
+    ids = IdAllocator()
+    assert ids.allocate_many(5) == [0, 1, 2, 3, 4]
+    ids.release(3)
+    ids.release(1)
+    ids.release(1)
+    assert ids.is_stale(1) and ids.is_stale(3) and not ids.is_stale(0)
+    assert ids.allocate() == ID_GENERATION_STRIDE + 3
+    assert ids.allocate() == ID_GENERATION_STRIDE + 1
+    assert ids.allocate() == 5
+    # Releasing an id from before its slot was reused leaves the slot alone
+    ids.release(1)
+    assert not ids.is_stale(ID_GENERATION_STRIDE + 1)
+
+    print('Generations wrap around')
+    id = 2
+    for i in range(0, ID_GENERATIONS):
+        ids.release(id)
+        id = ids.allocate()
+        assert id < 2 ** 31
+    assert id == 2
+
+    print('Reserved ids are taken, the slots skipped over are free')
+    ids.reserve(9)
+    ids.reserve(ID_GENERATION_STRIDE + 7)
+    assert ids.allocate_many(3) == [6, 8, 10]
+
+    print('A shard\'s allocator only hands out and takes back its own slots')
+    shard = IdAllocator(1 << 20, 4)
+    assert shard.allocate_many(4) == [1 << 20, (1 << 20) + 1, (1 << 20) + 2, (1 << 20) + 3]
+    shard.release(2)
+    shard.reserve(5)
+    assert not shard.is_stale(2)
+    failed = False
+    try:
+        shard.allocate()
+    except RuntimeError:
+        failed = True
+    assert failed is True
+    for base, size in ((-1, 4), (0, 0), (ID_GENERATION_STRIDE - 2, 4)):
+        failed = False
+        try:
+            IdAllocator(base, size)
+        except ValueError:
+            failed = True
+        assert failed is True
+
+    print('A GOC never gives a removed gameobject\'s id to another')
+    goc = GameObjectController(None)
+    first, firstid = goc.add_gameobject('gameobjects/lifeform/template.lfm', 'room_a', [0, 0])
+    goc.remove_gameobject(firstid)
+    added = goc.add_gameobjects([('gameobjects/lifeform/template.lfm', 'room_a', [8 * i, 0]) for i in range(0, 5)])
+    assert firstid not in goc.gameobjects and goc.ids.is_stale(firstid)
+    assert [id for gameobject, id in added] == [ID_GENERATION_STRIDE] + list(range(1, 5))
+    assert all(goc.gameobjects[id] is gameobject and gameobject.id == id for gameobject, id in added)
+    assert added[0][0].stats is not added[1][0].stats
+    handed_off = added[1][1]
+    goc.remove_gameobject(handed_off, release=False)
+    assert goc.add_gameobject('gameobjects/lifeform/template.lfm')[1] == 5
+    goc.insert_gameobject(added[1][0], 'room_a', [0, 0], id=handed_off)
+    goc.replace_gameobjects(dict(goc.gameobjects))
+    assert goc.add_gameobject('gameobjects/lifeform/template.lfm')[1] == 6
+    print('Ids allocated as expected')
+
+
 # UNIT TESTS:
 templateparser_test()
 gameobjectcontroller_test()
@@ -320,6 +1732,30 @@ client_server_test()
 gamecontroller_test_basic()
 current_room_test()
 ai_gambits()
+login_sav_test()
+checkpoint_test()
+protocol_test()
+persistent_connection_test()
+dispatch_test()
+rate_limit_test()
+batch_test()
+session_test()
+push_subscription_test()
+compression_test()
+metrics_test()
+mailbox_test()
+scheduler_test()
+snapshot_delta_test()
+compact_snapshot_test()
+interest_set_test()
+interpolation_test()
+shard_test()
+gameobject_index_test()
+spatial_hash_test()
+perception_test()
+component_store_test()
+id_allocator_test()
+shutil.rmtree(SCRATCH_DIR)
 
 # SYSTEM TESTS:
 
@@ -0,0 +1,154 @@
+from __future__ import division
+
+import time
+from timeit import default_timer
+
+
+# Simulation ticks per second
+TICK_RATE = 60
+# Most ticks run back to back to catch up after a slow tick, any further backlog is skipped
+MAX_CATCHUP_TICKS = 5
+
+
+class PhaseTiming(object):
+    """ Running duration statistics for one phase of the tick, all times in milliseconds """
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0.
+        self.last = 0.
+        self.max = 0.
+
+    def record(self, duration):
+        self.count += 1
+        self.total += duration
+        self.last = duration
+        if duration > self.max:
+            self.max = duration
+
+    @property
+    def mean(self):
+        if not self.count:
+            return 0.
+        return self.total / self.count
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.
+        self.last = 0.
+        self.max = 0.
+
+    def as_dict(self):
+        return {'count': self.count, 'mean': self.mean, 'last': self.last, 'max': self.max, 'total': self.total}
+
+
+class TickScheduler(object):
+    """
+    Headless fixed timestep loop, every tick runs each phase in order with the same dt.
+
+    Wall clock time is accumulated and paid out in whole ticks.  When a tick takes longer than the timestep the
+    following ticks run back to back to catch up, up to max_catchup ticks, anything beyond that is skipped so an
+    overloaded server degrades to running slower instead of falling further and further behind.
+    """
+    def __init__(self, tick_rate=TICK_RATE, max_catchup=MAX_CATCHUP_TICKS, clock=default_timer, sleep=time.sleep):
+        """
+        :param tick_rate: ticks per second
+        :param max_catchup: most ticks run in a row without sleeping when behind
+        :param clock: returns wall clock time in seconds
+        :param sleep: sleeps for the given number of seconds
+        """
+        # Timestep in milliseconds, the same unit pygame's Clock.tick returned
+        self.dt = 1000. / tick_rate
+        self.max_catchup = max_catchup
+        self.clock = clock
+        self.sleep = sleep
+
+        # [(<name>, <function(dt)>), ... ] in the order they run each tick
+        self.phases = []
+        # {<name>: <PhaseTiming>, ... }, includes 'tick' for the whole tick
+        self.timings = {'tick': PhaseTiming('tick')}
+        # Optional mp.metrics.Metrics, phase durations are also recorded there as histograms while it is enabled
+        self.metrics = None
+
+        self.ticks = 0
+        # Ticks that took longer than the timestep
+        self.overruns = 0
+        # Ticks dropped because the loop fell more than max_catchup ticks behind
+        self.skipped = 0
+        # Wall clock milliseconds owed to the simulation but not yet run
+        self.accumulator = 0.
+        self.running = False
+
+    def add_phase(self, name, function):
+        """ Run function(dt) every tick, after the phases already added """
+        self.phases.append((name, function))
+        self.timings[name] = PhaseTiming(name)
+
+    def tick(self):
+        """ Run every phase once, recording how long each took """
+        clock = self.clock
+        metrics = self.metrics if self.metrics is not None and self.metrics.enabled else None
+        tick_start = start = clock()
+        for name, function in self.phases:
+            function(self.dt)
+            end = clock()
+            duration = (end - start) * 1000.
+            self.timings[name].record(duration)
+            if metrics:
+                metrics.record_phase(name, duration)
+            start = end
+        duration = (start - tick_start) * 1000.
+        self.timings['tick'].record(duration)
+        if metrics:
+            metrics.record_phase('tick', duration)
+        self.ticks += 1
+        if duration > self.dt:
+            self.overruns += 1
+
+    def advance(self, elapsed):
+        """
+        Pay out elapsed wall clock time as whole ticks
+        :param elapsed: milliseconds since the last call
+        :return: number of ticks run
+        """
+        self.accumulator += elapsed
+        ticks = 0
+        while self.accumulator >= self.dt and ticks < self.max_catchup:
+            self.tick()
+            self.accumulator -= self.dt
+            ticks += 1
+        if self.accumulator >= self.dt:
+            # Too far behind to catch up, drop the backlog
+            skipped = int(self.accumulator // self.dt)
+            self.skipped += skipped
+            self.accumulator -= skipped * self.dt
+        return ticks
+
+    def run(self):
+        """ Run ticks at the fixed rate until stop() is called """
+        self.running = True
+        last = self.clock()
+        while self.running:
+            now = self.clock()
+            self.advance((now - last) * 1000.)
+            last = now
+            # Sleep off whatever is left of the timestep
+            wait = (self.dt - self.accumulator) / 1000. - (self.clock() - now)
+            if wait > 0:
+                self.sleep(wait)
+
+    def stop(self):
+        self.running = False
+
+    def stats(self):
+        """ Snapshot of the tick counters and per-phase timings, all times in milliseconds """
+        return {'tick_rate': 1000. / self.dt, 'dt': self.dt, 'ticks': self.ticks, 'overruns': self.overruns,
+                'skipped': self.skipped, 'phases': dict((name, timing.as_dict())
+                                                         for name, timing in self.timings.items())}
+
+    def reset_stats(self):
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        for timing in self.timings.values():
+            timing.reset()